@@ -1,3 +1,14 @@
 from .helper_funcs import Helper_funcs
+from .profiling import Profiler
+from .shared import Shared_csr
 from .nv_system import NV_system
+from .program import Program, Noise_stream
 from .nv_dynamics import NV_dynamics
+from .out_of_core import Out_of_core_dynamics, Chunked_state
+from .planner import Run_planner
+from .sweep import Parameter_sweep
+from .quasi_periodic import Quasi_periodic_drive, fibonacci_sequence, thue_morse_sequence
+from .mpi import Distributed_state, MPI_dynamics
+from .cce import Cluster_dynamics, Cluster_expansion
+from .dtwa import Wigner_ensemble, DTWA_dynamics
+from .mps import MPS_state, MPS_dynamics
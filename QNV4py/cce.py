@@ -0,0 +1,276 @@
+import os, io, contextlib, tempfile, itertools
+import numpy as np
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from QNV4py import Profiler
+from QNV4py.nv_dynamics import NV_dynamics
+
+
+##
+# @file cce.py Contains the classes Cluster_dynamics and Cluster_expansion
+#
+
+
+# expansion and run inputs of a worker process (see Cluster_expansion.cluster_signals)
+_worker = {}
+
+
+
+def _init_worker(expansion,run_inputs):
+	_worker['expansion'] = expansion
+	_worker['run_inputs'] = run_inputs
+
+
+def _run_worker_cluster(cluster):
+	return (cluster,) + _worker['expansion'].cluster_signal(cluster,*_worker['run_inputs'])
+
+
+
+class Cluster_dynamics(NV_dynamics):
+	"""! NV_dynamics of a single cluster of a Cluster_expansion: the evolve_* methods return their data without saving it """
+
+	def save_data_tuple(self,data_tuple,file_name,save_dir,folder,sub_directories,
+					overwrite=False,extra_save_parameters=None):
+		return folder
+
+
+
+class Cluster_expansion(NV_dynamics):
+	"""! Cluster-correlation expansion (CCE) of the magnetization of systems of hundreds of spins (e.g. NV_system(...,matrix_free=True)).
+		Clusters of up to max_order spins connected by couplings above a threshold are enumerated by coupling strength and evolved exactly
+		(NV_dynamics of NV_system.subsystem) under the same drive. The correlation of a cluster is its signal minus the correlations of its
+		enumerated subclusters, the magnetization is the sum of all correlations. Product initial states only, no noise """
+
+	def __init__(self,nv_instance,rabi_freq,kick_building_blocks,max_order=2,coupling_threshold=0.1,max_clusters=None,
+					detuning=None,AC_function=None,engine='auto',tol=None,profile=False):
+
+		##
+		# @param nv_instance NV_system object (can be matrix free)
+		# @param rabi_freq, kick_building_blocks, detuning, AC_function drive (see NV_dynamics)
+		# @param max_order largest cluster size k. Default is 2
+		# @param coupling_threshold clusters are connected by couplings max(|J^xy|,|J^z|) of at least coupling_threshold times the largest one. Default is 0.1
+		# @param max_clusters maximal number of clusters per order above 1 (the strongest ones). Clusters of order n+1 are grown from the kept clusters of order n.
+		# Default is None (all clusters)
+		# @param engine engine of the cluster evolutions (see NV_dynamics). Default is 'auto'
+		# @param tol tolerance of the cluster propagators (see NV_dynamics). Default is None
+		# @param profile see NV_dynamics. Default is False
+
+		self.__dict__.update(nv_instance.__dict__)
+		self.__system = nv_instance
+
+		self.profiler = None
+		if profile:
+			self.profiler = Profiler()
+			if nv_instance.__dict__.get('profiler') != None:
+				self.profiler.merge(nv_instance.profiler)
+
+		if type(detuning)==list:
+			assert len(detuning)==self.L, 'not enough elements given in detuning: L={0:d}, length of detuning ={1:d}'.format(self.L,len(detuning))
+		assert max_order >= 1, 'max_order must be at least 1'
+
+		self.detuning = detuning
+		self.rabi_freq = rabi_freq
+		self.kick_building_blocks = kick_building_blocks
+		self.AC_function = AC_function
+		self.noise = None
+		self.noise_bins = None
+		self.engine = 'cce'
+		self.precision = 'double'
+		self.dtype = np.complex128
+		if tol != None:
+			self.tol = tol
+
+		## engine of the cluster evolutions
+		self.cluster_engine = engine
+
+		## largest cluster size
+		self.max_order = max_order
+
+		## relative coupling threshold of the cluster graph
+		self.coupling_threshold = coupling_threshold
+
+		## maximal number of clusters per order above 1 (None: all)
+		self.max_clusters = max_clusters
+
+		with self.phase('cce/clusters'):
+			self.__enumerate_clusters()
+
+		## correlations {cluster: array (observables, times)} of the last run (summed over the spins of the cluster)
+		self.correlations = {}
+
+
+	def __enumerate_clusters(self):
+		pairs, J_xy, J_z, h = self.dd_terms()
+		strength = np.maximum(np.abs(J_xy),np.abs(J_z))
+		threshold = self.coupling_threshold*np.max(strength) if len(strength)>0 else 0.0
+		self.__neighbours = [{} for _ in range(self.L)]
+		for (i,j), s in zip(pairs.tolist(),strength):
+			if s >= threshold and s > 0:
+				self.__neighbours[i][j] = s
+				self.__neighbours[j][i] = s
+
+		## clusters (sorted tuples of sites), by order and decreasing strength
+		self.clusters = []
+
+		## strength of the clusters: weakest coupling of their maximum spanning tree (strongest coupling for single spins)
+		self.cluster_strength = {}
+
+		order = [(j,) for j in range(self.L)]
+		for n in range(1,self.max_order+1):
+			if n > 1:
+				grown = set()
+				for cluster in order:
+					for site in cluster:
+						for neighbour in self.__neighbours[site]:
+							if neighbour not in cluster:
+								grown.add(tuple(sorted(cluster+(neighbour,))))
+				order = list(grown)
+			for cluster in order:
+				self.cluster_strength[cluster] = self.__strength(cluster)
+			order.sort(key=lambda cluster: (-self.cluster_strength[cluster],cluster))
+			if self.max_clusters != None and n > 1:
+				order = order[:self.max_clusters]
+			self.clusters += order
+
+
+	def __strength(self,cluster):
+		# Kruskal: the coupling connecting the last two components of the maximum spanning tree
+		if len(cluster) == 1:
+			return max(self.__neighbours[cluster[0]].values(),default=0.0)
+		edges = sorted(((self.__neighbours[i][j],i,j) for i, j in itertools.combinations(cluster,2) if j in self.__neighbours[i]),reverse=True)
+		component = {site: site for site in cluster}
+		def find(site):
+			while component[site] != site:
+				site = component[site]
+			return site
+		n_components = len(cluster)
+		for s, i, j in edges:
+			a, b = find(i), find(j)
+			if a != b:
+				component[a] = b
+				n_components -= 1
+				if n_components == 1:
+					return s
+		return 0.0
+
+
+	def orders(self):
+		"""! Number of enumerated clusters of each order 1, ..., max_order """
+		return [sum(1 for cluster in self.clusters if len(cluster)==n) for n in range(1,self.max_order+1)]
+
+
+	def cluster_dynamics(self,cluster):
+		"""! Cluster_dynamics object of the cluster (sorted tuple of sites) under the drive of the expansion """
+		detuning = self.detuning
+		if type(detuning)==list:
+			detuning = [detuning[j] for j in cluster]
+		return Cluster_dynamics(self.__system.subsystem(cluster),self.rabi_freq,self.kick_building_blocks,detuning=detuning,
+							AC_function=self.AC_function,engine=self.cluster_engine,tol=self.tol)
+
+
+	def cluster_signal(self,cluster,driver,initial_state,n_steps,observable,driver_kwargs):
+		"""! Runs driver for the cluster (output suppressed, nothing saved). Returns the observables summed over the spins of the cluster, times """
+		with contextlib.redirect_stdout(io.StringIO()):
+			dynamics = self.cluster_dynamics(cluster)
+			data, times = getattr(dynamics,driver)(dynamics.initial_state(initial_state),n_steps,dynamics.SP_observable(observable),
+													file_name='cluster',save_every=n_steps+1,save_dir=tempfile.gettempdir()+'/',**driver_kwargs)
+		return len(cluster)*data, times
+
+
+	def cluster_signals(self,driver,initial_state,n_steps,observable,driver_kwargs,n_workers=1):
+		"""! Generator over (cluster, signal, times) of all clusters (see cluster_signal), computed by n_workers processes """
+		run_inputs = (driver,initial_state,n_steps,observable,driver_kwargs)
+		if n_workers == 1:
+			for cluster in self.clusters:
+				yield (cluster,) + self.cluster_signal(cluster,*run_inputs)
+			return
+		chunksize = max(1,len(self.clusters)//(4*n_workers))
+		with ProcessPoolExecutor(max_workers=n_workers,mp_context=mp.get_context('fork'),
+									initializer=_init_worker,initargs=(self,run_inputs)) as executor:
+			yield from executor.map(_run_worker_cluster,self.clusters,chunksize=chunksize)
+
+
+	def expand(self,driver,initial_state,n_steps,observable,file_name,save_dir='./data/',folder='new_data_set',
+				extra_save_parameters=None,n_workers=1,**driver_kwargs):
+
+		"""! Cluster expansion of driver (an evolve_* method of NV_dynamics without noise). The correlations are stored in correlations """
+
+		##
+		# @param driver name of the evolve_* method, e.g. 'evolve_periodic' or 'evolve_sequential'
+		# @param initial_state direction 'x', 'y' or 'z' of the polarized initial (product) state
+		# @param observable list of directions 'x', 'y', 'z' of the magnetizations sum_j sigma^a_j / L
+		# @param n_workers number of worker processes evolving the clusters. Default is 1
+		# @param driver_kwargs further inputs of driver, e.g. sequence
+		#
+		# @return data, times
+
+		if not os.path.exists(save_dir):
+			os.mkdir(save_dir)
+		for char in observable:
+			assert char in ['x','y','z'], 'input not understood'
+
+		signals = {}
+		times = None
+		with self.profiling(), self.phase('cce/clusters'):
+			for cluster, signal, times in self.cluster_signals(driver,initial_state,n_steps,observable,driver_kwargs,n_workers=n_workers):
+				signals[cluster] = signal
+
+		# correlation of a cluster: its signal minus the correlations of its enumerated subclusters (the clusters are ordered by size)
+		self.correlations = {}
+		for cluster in self.clusters:
+			correlation = signals[cluster].copy()
+			for n in range(1,len(cluster)):
+				for subcluster in itertools.combinations(cluster,n):
+					if subcluster in self.correlations:
+						correlation -= self.correlations[subcluster]
+			self.correlations[cluster] = correlation
+
+		data = sum(self.correlations.values())/self.L
+
+		save_parameters = {'max_order':self.max_order,'coupling_threshold':self.coupling_threshold,
+							'max_clusters':'None' if self.max_clusters == None else self.max_clusters,
+							'nr_of_clusters':self.orders(),'cluster_engine':self.cluster_engine,'driver':driver}
+		if extra_save_parameters!=None:
+			save_parameters.update(extra_save_parameters)
+		self.save_data_tuple((data,times),file_name,save_dir,folder,('observables','times'),overwrite=False,
+								extra_save_parameters=save_parameters)
+		return data, times
+
+
+	def evolve_periodic(self,initial_state,n_steps,observable,file_name,save_dir='./data/',folder='new_data_set',
+						extra_save_parameters=None,n_workers=1):
+
+		"""! Cluster expansion of NV_dynamics.evolve_periodic (see expand) """
+
+		return self.expand('evolve_periodic',initial_state,n_steps,observable,file_name,save_dir=save_dir,folder=folder,
+							extra_save_parameters=extra_save_parameters,n_workers=n_workers)
+
+
+	def evolve_sequential(self,initial_state,n_steps,observable,sequence,file_name,save_dir='./data/',folder='new_data_set',
+							extra_save_parameters=None,n_workers=1):
+
+		"""! Cluster expansion of NV_dynamics.evolve_sequential (see expand) """
+
+		return self.expand('evolve_sequential',initial_state,n_steps,observable,file_name,save_dir=save_dir,folder=folder,
+							extra_save_parameters=extra_save_parameters,n_workers=n_workers,sequence=sequence)
+
+
+	def convergence_report(self):
+		"""! Convergence of the expansion of the last run, order by order and cluster by cluster """
+		##
+		# @return dict with, per order n = 1, ..., max_order, the number of clusters, the signal up to order n, the largest change of the signal by order n
+		# and the largest correlation of a single cluster of order n. 'clusters' lists (cluster, strength, largest correlation) in the order of the clusters
+
+		assert len(self.correlations)>0, 'run an expansion first'
+		report = {'orders':list(range(1,self.max_order+1)),'nr_of_clusters':self.orders(),'signal':[],'max_change':[],'max_cluster_correlation':[],'clusters':[]}
+		signal = 0.0
+		for n in report['orders']:
+			correlations = [self.correlations[cluster] for cluster in self.clusters if len(cluster)==n]
+			change = sum(correlations)/self.L if len(correlations)>0 else 0.0*signal
+			signal = signal + change
+			report['signal'] += [signal]
+			report['max_change'] += [np.max(np.abs(change))]
+			report['max_cluster_correlation'] += [max((np.max(np.abs(correlation)) for correlation in correlations),default=0.0)/self.L]
+		for cluster in self.clusters:
+			report['clusters'] += [(cluster,self.cluster_strength[cluster],np.max(np.abs(self.correlations[cluster]))/self.L)]
+		return report
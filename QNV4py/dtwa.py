@@ -0,0 +1,307 @@
+import os
+import numpy as np
+from scipy.linalg import expm
+from QNV4py import Helper_funcs
+from QNV4py import Profiler
+from QNV4py.nv_dynamics import NV_dynamics
+from QNV4py.program import Program
+from QNV4py.out_of_core import PAULI
+
+hlp = Helper_funcs()
+
+
+##
+# @file dtwa.py Contains the classes Wigner_ensemble, Rotation_propagator, Mean_field_propagator and DTWA_dynamics
+#
+
+
+
+def rotation_matrix(U):
+	"""! SO(3) matrix R of the single spin unitary U: U^dagger sigma^a U = sum_b R[a,b] sigma^b """
+	R = np.zeros((3,3))
+	for a, label_a in enumerate('xyz'):
+		for b, label_b in enumerate('xyz'):
+			R[a,b] = 0.5*np.trace(PAULI[label_b].dot(U.conj().T).dot(PAULI[label_a]).dot(U)).real
+	return R
+
+
+
+class Wigner_ensemble():
+	"""! Classical Bloch vectors (sigma^x, sigma^y, sigma^z) of L spins for n_trajectories samples of the discrete Wigner distribution of a product state.
+		Expectation values are averages over the trajectories """
+
+	def __init__(self,L,n_trajectories):
+
+		##
+		# @param L system size
+		# @param n_trajectories number of trajectories
+
+		## system size
+		self.L = L
+
+		## number of trajectories
+		self.n_trajectories = n_trajectories
+
+		## Bloch vectors, array (n_trajectories, 3, L)
+		self.s = np.zeros((n_trajectories,3,L))
+
+
+	def polarized(self,direction,seed=1):
+		"""! Samples the state polarized along direction ('x', 'y' or 'z', see NV_system.initial_state): the component along direction is 1,
+			the two transverse components are +1 or -1 with equal probability """
+		assert direction in ['x','y','z'], "input not understood: direction should be 'x', 'y' or 'z'"
+		a = 'xyz'.index(direction)
+		generator = np.random.default_rng(seed)
+		self.s[...] = 2.0*generator.integers(0,2,size=self.s.shape) - 1.0
+		self.s[:,a,:] = 1.0
+		return self
+
+
+	def expectation(self,directions):
+		"""! Expectation values of sum_j sigma^a_j / L for a in directions ('x', 'y' or 'z') """
+		return [np.mean(self.s[:,'xyz'.index(direction),:]) for direction in directions]
+
+
+	def standard_error(self,directions):
+		"""! Statistical error of expectation(directions) """
+		return [np.std(np.mean(self.s[:,'xyz'.index(direction),:],axis=1))/np.sqrt(self.n_trajectories) for direction in directions]
+
+
+	def copy(self):
+		"""! Copy of the ensemble """
+		ensemble = Wigner_ensemble(self.L,self.n_trajectories)
+		ensemble.s[...] = self.s
+		return ensemble
+
+
+
+class Rotation_propagator():
+	"""! Kick applied to a Wigner_ensemble: exact rotation of the Bloch vector of every spin """
+
+	def __init__(self,U):
+
+		##
+		# @param U single spin unitaries of all sites, array (L,2,2)
+
+		## rotation matrices of the sites, array (L,3,3)
+		self.R = np.array([rotation_matrix(U_j) for U_j in U])
+
+
+	def dot(self,psi,work_array=None,overwrite_v=True):
+		"""! Propagator interface (see expm_multiply_parallel.dot): rotates the Bloch vectors of the Wigner_ensemble psi (in-place) """
+		assert overwrite_v, 'Wigner ensembles are evolved in-place'
+		psi.s[...] = np.einsum('jab,tbj->taj',self.R,psi.s)
+		return psi
+
+
+
+class Mean_field_propagator():
+	"""! 'dd' element applied to a Wigner_ensemble: mean-field equations ds_j/dt = 2 B_j x s_j of H_dd with the fields
+		B_j = (sum_k J^xy_jk s^x_k, sum_k J^xy_jk s^y_k, sum_k J^z_jk s^z_k + h_j), integrated with fourth order Runge-Kutta steps for all
+		trajectories at once. The uniform AC field commutes with H_dd and is applied as an exact rotation about z """
+
+	def __init__(self,J_xy,J_z,h,time,time_step=0.01,AC_angle=0.0):
+
+		##
+		# @param J_xy, J_z symmetric coupling matrices (L,L)
+		# @param h fields of the sites (including the detuning)
+		# @param time duration of the element
+		# @param time_step maximal Runge-Kutta step. Default is 0.01
+		# @param AC_angle integral of the AC field over the element. Default is 0
+
+		self.__J_xy = J_xy
+		self.__J_z = J_z
+		self.__h = h
+
+		## number of Runge-Kutta steps
+		self.n_steps = max(1,int(np.ceil(time/time_step-1e-12)))
+
+		## duration of a Runge-Kutta step
+		self.dt = time/self.n_steps
+
+		## integral of the AC field over the element
+		self.AC_angle = AC_angle
+
+
+	def derivative(self,s):
+		"""! ds/dt of the Bloch vectors s (n_trajectories, 3, L) """
+		B_x = s[:,0,:].dot(self.__J_xy)
+		B_y = s[:,1,:].dot(self.__J_xy)
+		B_z = s[:,2,:].dot(self.__J_z) + self.__h
+		return 2*np.stack((B_y*s[:,2,:]-B_z*s[:,1,:],B_z*s[:,0,:]-B_x*s[:,2,:],B_x*s[:,1,:]-B_y*s[:,0,:]),axis=1)
+
+
+	def dot(self,psi,work_array=None,overwrite_v=True):
+		"""! Propagator interface (see expm_multiply_parallel.dot): evolves the Wigner_ensemble psi (in-place) """
+		assert overwrite_v, 'Wigner ensembles are evolved in-place'
+		s, dt = psi.s, self.dt
+		for _ in range(self.n_steps):
+			k1 = self.derivative(s)
+			k2 = self.derivative(s+0.5*dt*k1)
+			k3 = self.derivative(s+0.5*dt*k2)
+			k4 = self.derivative(s+dt*k3)
+			s += dt/6*(k1+2*k2+2*k3+k4)
+		if self.AC_angle != 0:
+			phi = 2*self.AC_angle
+			s[:,0,:], s[:,1,:] = np.cos(phi)*s[:,0,:]-np.sin(phi)*s[:,1,:], np.sin(phi)*s[:,0,:]+np.cos(phi)*s[:,1,:]
+		return psi
+
+
+
+class DTWA_dynamics(NV_dynamics):
+	"""! Discrete truncated Wigner approximation (DTWA) of the drives of NV_dynamics for large L: every spin is a classical Bloch vector sampled from
+		the discrete Wigner distribution of the initial product state (see Wigner_ensemble). Kicks are exact rotations, the 'dd' elements follow the
+		mean-field equations of H_dd (see Mean_field_propagator). All trajectories are evolved at once. No noise """
+
+	def __init__(self,nv_instance,rabi_freq,kick_building_blocks,detuning=None,AC_function=None,time_step=0.01,n_trajectories=1000,profile=False):
+
+		##
+		# @param nv_instance NV_system object (can be matrix free)
+		# @param rabi_freq, kick_building_blocks, detuning, AC_function drive (see NV_dynamics)
+		# @param time_step maximal Runge-Kutta step of the 'dd' elements (in units of 1/energy_scale). Default is 0.01
+		# @param n_trajectories number of trajectories of the initial states. Default is 1000
+		# @param profile see NV_dynamics. Default is False
+
+		self.__dict__.update(nv_instance.__dict__)
+
+		self.profiler = None
+		if profile:
+			self.profiler = Profiler()
+			if nv_instance.__dict__.get('profiler') != None:
+				self.profiler.merge(nv_instance.profiler)
+
+		self.detuning = detuning
+		self.rabi_freq = rabi_freq
+		self.noise = None
+		self.noise_bins = None
+		self.AC_function = AC_function
+		self.engine = 'dtwa'
+		self.precision = 'double'
+		self.dtype = np.float64
+		self.renormalize_every = None
+		self.async_measure = False
+
+		## maximal Runge-Kutta step of the 'dd' elements
+		self.time_step = time_step
+
+		## number of trajectories of the initial states
+		self.n_trajectories = n_trajectories
+
+		assert type(kick_building_blocks)==list, 'kick_squence must be  of type list'
+		for block in kick_building_blocks:
+			for element in block[0]:
+				assert type(element)==tuple and len(element)==2 and element[0] in ['x','y','z','dd'], 'element {0} not understood'.format(element)
+
+		if detuning == None:
+			detuning_list = np.zeros(self.L)
+		elif type(detuning)==list:
+			assert len(detuning)==self.L, 'not enough elements given in detuning: L={0:d}, length of detuning ={1:d}'.format(self.L,len(detuning))
+			detuning_list = np.array(detuning,dtype=np.float64)
+		else:
+			detuning_list = detuning*np.ones(self.L)
+
+		# coupling matrices of the mean-field equations
+		pairs, J_xy, J_z, h = self.dd_terms()
+		J_xy_matrix = np.zeros((self.L,self.L))
+		J_z_matrix = np.zeros((self.L,self.L))
+		J_xy_matrix[pairs[:,0],pairs[:,1]] = J_xy
+		J_z_matrix[pairs[:,0],pairs[:,1]] = J_z
+		J_xy_matrix += J_xy_matrix.T
+		J_z_matrix += J_z_matrix.T
+
+		## building blocks of the sequences to be applied (with Rotation_propagator and Mean_field_propagator objects)
+		self.building_blocks = []
+		with self.profiling(), self.phase('build/setup'):
+			for block in kick_building_blocks:
+				current_time = 0.0
+				sequence = []
+				for label, time in block[0]:
+					if label=='dd':
+						AC_angle = 0.0
+						if AC_function != None:
+							AC_angle = hlp.integrate_AC(AC_function,current_time,current_time+time)
+						propagator = Mean_field_propagator(J_xy_matrix,J_z_matrix,h+detuning_list,time,time_step,AC_angle)
+					else:
+						# kick (rabi_freq*time*sigma^label + detuning*time*sigma^z) on every site
+						propagator = Rotation_propagator([expm(-1j*(rabi_freq*time*PAULI[label] + detuning_list[j]*time*PAULI['z'])) for j in range(self.L)])
+					sequence += [(label,time,propagator)]
+					current_time += time
+				self.building_blocks += [[sequence,block[1]]]
+
+		## compact representation of the building blocks (see Program)
+		self.program = Program(self.building_blocks)
+
+
+	def work_array(self,psi):
+		# the propagators work on the Bloch vectors
+		return None
+
+
+	def initial_state(self,direction,seed=1):
+		"""! Wigner_ensemble of n_trajectories samples of the state polarized along direction ('x', 'y' or 'z'), see NV_system.initial_state """
+		return Wigner_ensemble(self.L,self.n_trajectories).polarized(direction,seed)
+
+
+	def SP_observable(self,directions):
+		"""! Observables sum_j sigma^a_j of the directions, evaluated on the trajectories (the directions themselves) """
+		for char in directions:
+			assert char in ['x','y','z'], 'input not understood'
+		return list(directions)
+
+
+	def measure_function(self,observable):
+		def measure(psi,out):
+			out[:] = psi.expectation(observable)
+		return measure
+
+
+	def evolve_periodic(self,initial_state,n_steps,observable,file_name,save_every=1000,save_dir='./data/',
+						folder='new_data_set',extra_save_parameters=None):
+
+		"""! Floquet evolution of the Wigner_ensemble initial_state (see NV_dynamics.evolve_periodic). The final ensemble is stored in final_state """
+
+		##
+		# @param observable list of directions 'x', 'y', 'z' (see SP_observable)
+		#
+		# @return data, times
+
+		return self.evolve_sequential(initial_state,n_steps,observable,None,file_name,save_every=save_every,save_dir=save_dir,
+										folder=folder,extra_save_parameters=extra_save_parameters)
+
+
+	def evolve_sequential(self,initial_state,n_steps,observable,sequence,file_name,save_every=1000,save_dir='./data/',
+						folder='new_data_set',extra_save_parameters=None):
+
+		"""! Evolution of the Wigner_ensemble initial_state with the blocks sequence[step] (see NV_dynamics.evolve_sequential).
+			sequence=None applies all blocks at every step. The final ensemble is stored in final_state """
+
+		##
+		# @param observable list of directions 'x', 'y', 'z' (see SP_observable)
+		#
+		# @return data, times
+
+		if not os.path.exists(save_dir):
+			os.mkdir(save_dir)
+		assert isinstance(initial_state,Wigner_ensemble) and initial_state.L==self.L, 'initial_state must be a Wigner_ensemble of initial_state()'
+		self.SP_observable(observable)
+
+		if sequence == None:
+			blocks_of_step = lambda step: self.program.blocks
+			points = sum(self.data_points())*n_steps
+		else:
+			assert len(sequence)>=n_steps, 'sequence is too short'
+			blocks_of_step = lambda step: [self.program.blocks[sequence[step]]]
+			points = sum(self.data_points()[sequence[step]] for step in range(n_steps))
+
+		data = np.zeros((len(observable),points+1))
+		times = np.zeros(points+1)
+
+		save_parameters = {'time_step':self.time_step,'n_trajectories':initial_state.n_trajectories}
+		if extra_save_parameters!=None:
+			save_parameters.update(extra_save_parameters)
+
+		## ensemble after the last evolution (Wigner_ensemble)
+		self.final_state = initial_state.copy()
+
+		return self.execute_program(blocks_of_step,n_steps,self.final_state,observable,data,times,None,
+										file_name,save_every,save_dir,folder,save_parameters,'finished step {0:d}')
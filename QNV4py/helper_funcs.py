@@ -9,6 +9,7 @@ import time
 import statistics as stat
 import scipy.integrate as integrate
 import contextlib
+import hashlib
 import matplotlib.pyplot as plt
 from scipy.linalg import logm, expm
 
@@ -24,9 +25,26 @@ def temp_seed(seed):
 
 class Helper_funcs():
 
+	## global tolerance of all propagators (expm_multiply_parallel objects) built by the package. 
+	# None keeps the default of expm_multiply_parallel (machine precision). Overridden by the tol input of NV_system and NV_dynamics
+	tol = None
+
 	def __init__(self):
 		self.description = 'Contains all functionalities used in NV_system and NV_dynamics'
 
+		## Profiler accumulating the time spent in integrate_AC (None: no profiling)
+		self.profiler = None
+
+
+	def integrate_AC(self,AC_function,t_start,t_end):
+		"""! Integral of the AC function AC_function=[function, parameter1, ...] from t_start to t_end """
+		function = AC_function[0]
+		params = tuple(AC_function[1:]) # all parameters of interest such as amplitude, frequency etc
+		if self.profiler == None:
+			return integrate.quad(lambda x: function(x,*params),t_start,t_end)[0]
+		with self.profiler.phase('quad'):
+			return integrate.quad(lambda x: function(x,*params),t_start,t_end)[0]
+
 
 	def sampling_points(self,B_field_dir,min_dist,max_dist,L,seed):
 		np.random.seed(seed)
@@ -102,6 +120,36 @@ class Helper_funcs():
 
 
 
+	def truncate_couplings(self,spin_positions,interactions_x_y,interactions_z,couplings,
+							coupling_cutoff=None,distance_cutoff=None):
+		"""! Drops pair couplings below a relative threshold or beyond a distance cutoff.
+			Returns the kept interactions/couplings and the list of discarded couplings"""
+
+		##
+		# @param coupling_cutoff couplings with |J| < coupling_cutoff*max|J| are dropped. Default is None (no threshold)
+		# @param distance_cutoff couplings between spins further apart than distance_cutoff are dropped. Default is None (no cutoff)
+		#
+		# @return interactions_x_y, interactions_z, couplings, discarded
+
+		couplings = np.array(couplings)
+		keep = np.ones(len(couplings),dtype=bool)
+
+		if coupling_cutoff != None and len(couplings)>0:
+			keep &= np.abs(couplings) >= coupling_cutoff*np.max(np.abs(couplings))
+
+		if distance_cutoff != None:
+			# interactions_z and couplings are appended pairwise in sampling_points, i.e. entries share the site indices
+			for c,(coupling,k,ell) in enumerate(interactions_z):
+				if np.linalg.norm(spin_positions[k]-spin_positions[ell]) > distance_cutoff:
+					keep[c] = False
+
+		interactions_x_y = [interactions_x_y[c] for c in range(len(keep)) if keep[c]]
+		interactions_z = [interactions_z[c] for c in range(len(keep)) if keep[c]]
+		discarded = list(couplings[~keep])
+		couplings = list(couplings[keep])
+
+		return interactions_x_y, interactions_z, couplings, discarded
+
 
 
 	def construct_Hamiltonian(self,basis,coupling_terms):
@@ -112,6 +160,12 @@ class Helper_funcs():
 
 
 
+	def renormalize(self,psi):
+		"""! Normalizes psi (in-place). For 2d arrays every column (state) is normalized"""
+		psi /= np.linalg.norm(psi,axis=0)
+		return psi
+
+
 	def compute_observables(self,j,psi,L,obs,O):
 		# updates variables in-place
 		for k in range(len(obs)):
@@ -119,9 +173,21 @@ class Helper_funcs():
 
 
 
-	def estimate_scales(self,basis,L,H,delta_t=0.0005,time_steps=1000):	
+	def estimate_scales(self,basis,L,H,delta_t=0.0005,time_steps=1000,tol=None):
 		"""! estimates relevant time scales via decay of spins using the fully polarized state as init state """
-		
+
+		observable = self.free_induction_decay(basis,L,H,delta_t=delta_t,time_steps=time_steps,tol=tol)
+
+		intersect=np.abs(np.abs(observable[0]) - np.exp(-1)).argmin()
+		median_coupling = 1/(intersect*delta_t)
+
+		return median_coupling
+
+
+
+	def free_induction_decay(self,basis,L,H,delta_t=0.0005,time_steps=1000,tol=None):
+		"""! x-magnetization of the initially x-polarized state evolved with H at times j*delta_t, j=0,...,time_steps """
+
 		psi_i = np.zeros(basis.Ns)
 		psi_i[basis.index('1'*L)]=1
 
@@ -131,23 +197,20 @@ class Helper_funcs():
 		work_array=np.zeros((2*len(psi),), dtype=psi.dtype)
 		
 		Oy=hamiltonian([['y',[[1.0,j] for j in range(L)] ],],[],basis=basis,dtype=np.complex128,check_symm=False)	
-		init_rotation = expm_multiply_parallel(Oy.tocsr(),a=-1j*np.pi*0.25)
+		init_rotation = self.set_tol(expm_multiply_parallel(Oy.tocsr(),a=-1j*np.pi*0.25),tol)
 		init_rotation.dot(psi,work_array=work_array,overwrite_v=True)
 
 		observable=np.zeros((1,time_steps+1),dtype=np.float64)
 
 		self.compute_observables(-1,psi,L,observable,[Ox])
 			
-		expH = expm_multiply_parallel(H.tocsr(),a=-1j*delta_t)
+		expH = self.set_tol(expm_multiply_parallel(H.tocsr(),a=-1j*delta_t),tol)
 		for j in range(time_steps):
 			expH.dot(psi,work_array=work_array,overwrite_v=True)
 					
 			self.compute_observables(j,psi,L,observable,[Ox])
 
-		intersect=np.abs(np.abs(observable[0]) - np.exp(-1)).argmin()
-		median_coupling = 1/(intersect*delta_t)
-
-		return median_coupling 
+		return observable
 
 
 
@@ -177,6 +240,66 @@ class Helper_funcs():
 
 
 
+	def magnetization_sectors(self,basis,L):
+		"""! Returns the number of up spins of every basis state """
+		states = np.asarray(basis.states)
+		n_up = np.zeros(len(states),dtype=np.int64)
+		for j in range(L):
+			n_up += (states >> j) & 1
+		return n_up
+
+
+
+	def conserves_magnetization(self,H,basis,L):
+		"""! Checks if the sparse matrix H only couples basis states with equal number of up spins """
+		n_up = self.magnetization_sectors(basis,L)
+		H = H.tocoo()
+		return np.all(n_up[H.row]==n_up[H.col])
+
+
+
+	def diagonalize(self,H,k=None,sigma=None,which='SA'):
+		"""! Diagonalizes the hermitian sparse matrix H, either fully (k=None) or partially with eigsh """
+		if k == None or k >= H.shape[0]-1:
+			# eigsh needs k < dimension: use dense diagonalization for small blocks
+			e, v = np.linalg.eigh(H.toarray())
+			if k != None:
+				order = self.eigenpair_selection(e,k,sigma,which)
+				e, v = e[order], v[:,order]
+			return e, v
+
+		if sigma != None:
+			e, v = eigsh(H,k=k,sigma=sigma,which='LM')
+		else:
+			e, v = eigsh(H,k=k,which=which)
+		order = np.argsort(e,kind='stable')
+		return e[order], v[:,order]
+
+
+
+	def eigenpair_selection(self,e,k,sigma=None,which='SA'):
+		"""! Indices of the k eigenvalues e which eigsh(k=k,sigma=sigma,which=which) returns, in increasing order of the eigenvalues """
+		if sigma != None:
+			distance = np.abs(e-sigma)
+		else:
+			assert which in ['SA','LA','SM','LM'], "which must be 'SA', 'LA', 'SM' or 'LM'"
+			distance = {'SA':e,'LA':-e,'SM':np.abs(e),'LM':-np.abs(e)}[which]
+		order = np.argsort(distance,kind='stable')[:k]
+		return order[np.argsort(e[order],kind='stable')]
+
+
+
+	def spectrum_cache_key(self,H,key):
+		"""! Hash of the sparse matrix H and the spectrum parameters key, used as file name for cached spectra """
+		H = H.tocsr()
+		h = hashlib.sha1()
+		for arr in (H.data,H.indices,H.indptr):
+			h.update(np.ascontiguousarray(arr).tobytes())
+		h.update(repr(key).encode())
+		return h.hexdigest()
+
+
+
 	def yes_no(self,message):
 		# raw_input returns the empty string for "enter"
 		yes = {'yes','y', 'ye', ''}
@@ -195,8 +318,43 @@ class Helper_funcs():
 				sys.stdout.write("Please respond with 'yes' or 'no'\n")
 
 
-	def setup_expH(self,L,basis,H_dd,kick_building_blocks,rabi_freq,detuning,AC_function,noise):
-		"""! Constructs all the matrix exponentials from the building block inputs of the sequence"""
+	def to_real(self,H):
+		"""! Returns the sparse matrix H with real dtype if its imaginary part vanishes (e.g. H_dd, which is real symmetric in the \f$ \sigma^z \f$ basis), otherwise H"""
+		if np.iscomplexobj(H.data) and not np.any(H.data.imag):
+			# copy: the real part is a strided view of the complex data, expm_multiply_parallel requires contiguous arrays
+			return H.real.copy()
+		return H
+
+
+	def set_tol(self,expH,tol=None):
+		"""! Sets the tolerance of the expm_multiply_parallel object expH to tol (None: the global Helper_funcs.tol) and recomputes
+			the number of Taylor terms and substeps accordingly. If both are None, the default (machine precision) is kept """
+		if tol == None:
+			tol = Helper_funcs.tol
+		if tol != None:
+			expH._tol = np.array(tol,dtype=expH._tol.dtype)
+			expH._calculate_partition()
+		return expH
+
+
+	def expm(self,H,dtype=np.complex128,tol=None):
+		"""! expm_multiply_parallel object of exp(-iH) with the propagator in dtype (np.complex128 or np.complex64).
+			Real Hamiltonians ('dd' elements, 'x' and 'z' kicks) are stored as real matrices (float64 or float32), i.e. with half the memory 
+			and a real-matrix times complex-vector product """
+		H = self.to_real(H)
+		if not np.iscomplexobj(H.data):
+			return self.set_tol(expm_multiply_parallel(H.astype(np.finfo(dtype).dtype,copy=False),a=-1j,dtype=dtype),tol)
+		return self.set_tol(expm_multiply_parallel(H.astype(dtype,copy=False),a=-1j,dtype=dtype),tol)
+
+
+	def expm_reference(self,H,time,dtype=np.complex128,tol=None):
+		"""! expm_multiply_parallel object of exp(-i*time*H) which stores the real matrix H (e.g. H_dd) by reference instead of the scaled copy H*time.
+			H is only copied if its dtype differs from the real dtype of the propagator (single precision) """
+		return self.set_tol(expm_multiply_parallel(H.astype(np.finfo(dtype).dtype,copy=False),a=-1j*time,dtype=dtype),tol)
+
+
+	def setup_expH(self,L,basis,H_dd,kick_building_blocks,rabi_freq,detuning,AC_function,noise,dtype=np.complex128,tol=None,zero_copy=False):
+		"""! Constructs all the matrix exponentials (in precision dtype) from the building block inputs of the sequence"""
 
 		# initialize the kick sequence according to the specific case under consideration
 		# building blocks [[building_block1],[building_block2]] with building_block1 = [[('x',0.4),('dd',0.2),()...],n_times],
@@ -221,6 +379,12 @@ class Helper_funcs():
 						# time is given in units of 1/self.energy_scale
 						time = sequence_brick[1] 
 
+						if zero_copy and detuning == None and AC_function == None:
+							# propagator referencing H_dd itself instead of the copy H_dd*time (see NV_system.share)
+							sequence_expH += [(sequence_brick[0],time,self.expm_reference(H_dd,time,dtype,tol))]
+							current_time += time
+							continue
+
 						# H_dd is alread rescaled in units of self.energy_scale
 						H=H_dd*time 
 						
@@ -242,20 +406,15 @@ class Helper_funcs():
 						# amplitudes appearing in AC function are assumed to be given in units of self.energy_scale
 						if AC_function != None:
 														
-							function = AC_function[0]
-							if len(AC_function)>1:
-								params = tuple(AC_function[1:]) # all parameters of interest such as amplitude, frequency etc
-								#integrate the AC function from current_time to current_time + time
-								AC_coupling=integrate.quad(lambda x: function(x,*params),current_time,current_time+time)[0]
-							else:
-								AC_coupling=integrate.quad(lambda x: function(x),current_time,current_time+time)[0]
+							#integrate the AC function from current_time to current_time + time
+							AC_coupling=self.integrate_AC(AC_function,current_time,current_time+time)
 
 							kick_list = [[AC_coupling,j] for j in range(L)]
 							static_z = [['z',kick_list]]
 							H += self.construct_Hamiltonian(basis, static_z).tocsr()
 
 
-						expH = expm_multiply_parallel(H,a=-1j)
+						expH = self.expm(H,dtype,tol)
 						sequence_expH += [(sequence_brick[0],time,expH)]
 						
 						current_time += time
@@ -289,7 +448,7 @@ class Helper_funcs():
 						
 
 						H = self.construct_Hamiltonian(basis, static )
-						expH = expm_multiply_parallel(H.tocsr(),a=-1j)
+						expH = self.expm(H.tocsr(),dtype,tol)
 						sequence_expH += [(sequence_brick[0],time,expH)]
 
 						current_time += time
@@ -343,7 +502,7 @@ class Helper_funcs():
 						
 
 						H = self.construct_Hamiltonian(basis, static )
-						expH = expm_multiply_parallel(H.tocsr(),a=-1j)
+						expH = self.expm(H.tocsr(),dtype,tol)
 						sequence_expH += [(sequence_brick[0],time,expH)]
 
 						current_time += time
@@ -358,168 +517,129 @@ class Helper_funcs():
 		output = inpt.copy()
 		return output
 
-	def update_building_blocks(self,element,L,basis,H_dd,rabi_freq,detuning,AC_function,noise):
-
-		
-		if noise==None:
-
-			current_time = 0.0
-				
-			#construct list to store the corresponding exp(H)
-			sequence_expH = []
-			for sequence_brick in element[0]:
-				#sequence_brick[0] ~ 'x', 'y', 'z', 'dd'
-				#sequence_brick[1] ~ correspnding times in units of the energy scale J in case of 'dd', corresponding angles in case 'x','y','z'
-				
-				# the sequence part is given by the dipolar Hamiltonian
-				if sequence_brick[0]=='dd':
-
-					# time is given in units of 1/self.energy_scale
-					time = sequence_brick[1] 
-
-					# H_dd is alread rescaled in units of self.energy_scale
-					H=H_dd*time 
-						
-
-					# check for detuning 
-					# detuning , in units of self.energy_scale
-					if detuning != None:
-						if type(detuning)==list:
-							assert len(detuning)==L, "not enough elements given in detuning:\
-							 						L={0:d}, length of detuning ={1:d}".format(*(L,len(detuning)))
-							detuing_list=[[detuning[j]*time,j] for j in range(L)]
-						else:
-							detuing_list=[[detuning*time,j] for j in range(L)]
-
-						H +=  self.construct_Hamiltonian(basis,[['z',detuing_list]]).tocsr()
-
+	def element_expH(self,sequence_brick,current_time,L,basis,H_dd,rabi_freq,detuning,AC_function,dtype=np.complex128,tol=None,zero_copy=False):
+		"""! Propagator of a single (noise free) sequence element ('x',time), ('dd',time), ... starting at current_time"""
 
+		#sequence_brick[0] ~ 'x', 'y', 'z', 'dd'
+		#sequence_brick[1] ~ correspnding times in units of the energy scale J in case of 'dd', corresponding angles in case 'x','y','z'
+		time = sequence_brick[1]
 
-					# check for AC
-					# amplitudes appearing in AC function are assumed to be given in units of self.energy_scale
-					if AC_function != None:
-								
-						function = AC_function[0]
-						if len(AC_function)>1:
-							params = tuple(AC_function[1:]) # all parameters of interest such as amplitude, frequency etc
-							#integrate the AC function from current_time to current_time + time
-							AC_coupling=integrate.quad(lambda x: function(x,*params),current_time,current_time+time)[0]
-						else:
-							AC_coupling=integrate.quad(lambda x: function(x),current_time,current_time+time)[0]
-
-						kick_list = [[AC_coupling,j] for j in range(L)]
-						static_z = [['z',kick_list]]
-						H += self.construct_Hamiltonian(basis, static_z).tocsr()
+		# the sequence part is given by the dipolar Hamiltonian
+		if sequence_brick[0]=='dd':
 
+			if zero_copy and detuning == None and AC_function == None:
+				# propagator referencing H_dd itself instead of the copy H_dd*time (see NV_system.share)
+				return self.expm_reference(H_dd,time,dtype,tol)
 
-					expH = expm_multiply_parallel(H,a=-1j)
-					sequence_expH += [(sequence_brick[0],time,expH)]
-						
-					current_time += time
-					
+			# H_dd is alread rescaled in units of self.energy_scale
+			H=H_dd*time 
 
-				# the sequence part is given by a kick
+			# check for detuning 
+			# detuning , in units of self.energy_scale
+			if detuning != None:
+				if type(detuning)==list:
+					assert len(detuning)==L, "not enough elements given in detuning:\
+					 						L={0:d}, length of detuning ={1:d}".format(*(L,len(detuning)))
+					detuing_list=[[detuning[j]*time,j] for j in range(L)]
 				else:
+					detuing_list=[[detuning*time,j] for j in range(L)]
 
-					# rabi_frequency is given in units of self.energy_scale
-					# the kick_time is given in units of the 1/energy_scale
-					# kick_amplitude = rabi_frequency * kick_time
-
-					time = sequence_brick[1]
-
-					kick_amplitude = time*rabi_freq
-					kick_direction = sequence_brick[0]
+				H +=  self.construct_Hamiltonian(basis,[['z',detuing_list]]).tocsr()
 
-					kick_coupling = [[kick_amplitude,j] for j in range(L)]
-					static = [[kick_direction,kick_coupling]]
+			# check for AC
+			# amplitudes appearing in AC function are assumed to be given in units of self.energy_scale
+			if AC_function != None:
 
+				#integrate the AC function from current_time to current_time + time
+				AC_coupling=self.integrate_AC(AC_function,current_time,current_time+time)
 
-					#check for detuning
-					if detuning != None:
-						if type(detuning)==list:
-							assert len(detuning)==L, "not enough elements given in detuning:\
-									 L={0:d}, length of detuning ={1:d}".format(*(L,len(detuning)))
-							detuing_list=[[detuning[j]*time,j] for j in range(L)]
-						else:
-							detuing_list=[[detuning*time,j] for j in range(L)]
+				kick_list = [[AC_coupling,j] for j in range(L)]
+				static_z = [['z',kick_list]]
+				H += self.construct_Hamiltonian(basis, static_z).tocsr()
 
-						static += [['z',detuing_list]]
-						
+			return self.expm(H,dtype,tol)
 
-					H = self.construct_Hamiltonian(basis, static )
-					expH = expm_multiply_parallel(H.tocsr(),a=-1j)
-					sequence_expH += [(sequence_brick[0],time,expH)]
-					current_time += time
+		# the sequence part is given by a kick
+		# rabi_frequency is given in units of self.energy_scale
+		# the kick_time is given in units of the 1/energy_scale
+		# kick_amplitude = rabi_frequency * kick_time
+		kick_amplitude = time*rabi_freq
+		kick_direction = sequence_brick[0]
 
-				element = [sequence_expH,element[1]]
-			
-			return element
-			
-		
-		# noise != None
-		else:
+		kick_coupling = [[kick_amplitude,j] for j in range(L)]
+		static = [[kick_direction,kick_coupling]]
 
-			current_time = 0.0
-			
-			#construct list to store the corresponding exp(H)
-			sequence_expH = []
-			for sequence_brick in element[0]:
-				#sequence_brick[0] ~ 'x', 'y', 'z', 'dd'
-				#sequence_brick[1] ~ correspnding times in units of the energy scale J in case of 'dd', corresponding angles in case 'x','y','z'
-
-				# the sequence part is given by the dipolar Hamiltonian
-				if sequence_brick[0]=='dd':
-
-					time = sequence_brick[1] 
-					sequence_expH += [('dd',time,None)]
-					current_time += time
-				
-				# the sequence part is given by a kick
-				else:
+		#check for detuning
+		if detuning != None:
+			if type(detuning)==list:
+				assert len(detuning)==L, "not enough elements given in detuning:\
+						 L={0:d}, length of detuning ={1:d}".format(*(L,len(detuning)))
+				detuing_list=[[detuning[j]*time,j] for j in range(L)]
+			else:
+				detuing_list=[[detuning*time,j] for j in range(L)]
 
-					# rabi_frequency is given in units of self.energy_scale
-					# the kick_time is given in units of the 1/energy_scale
-					# kick_amplitude = rabi_frequency * kick_time
+			static += [['z',detuing_list]]
 
-					time = sequence_brick[1]
+		H = self.construct_Hamiltonian(basis, static )
+		return self.expm(H.tocsr(),dtype,tol)
 
-					kick_amplitude = time*rabi_freq
 
-					kick_direction = sequence_brick[0]
+	def element_cache_key(self,sequence_brick,current_time,detuning,AC_function,rabi_freq=None):
+		"""! Key (label, duration, detuning, AC window, rabi_freq) identifying the propagator of a sequence element (see element_expH)"""
+		if type(detuning)==list:
+			detuning = tuple(detuning)
+		# only 'dd' elements depend on the AC field, through the window [current_time, current_time+time] it is integrated over
+		AC_window = None
+		if AC_function != None and sequence_brick[0]=='dd':
+			AC_window = (current_time,current_time+sequence_brick[1])
+		# only kicks depend on the Rabi frequency
+		if sequence_brick[0]=='dd':
+			rabi_freq = None
+		return (sequence_brick[0],sequence_brick[1],detuning,AC_window,rabi_freq)
 
-					kick_coupling = [[kick_amplitude,j] for j in range(L)]
-					static = [[kick_direction,kick_coupling]]
 
+	def update_building_blocks(self,element,L,basis,H_dd,rabi_freq,detuning,AC_function,noise,cache=None,dtype=np.complex128,tol=None,zero_copy=False):
+		"""! Builds the propagators of the block element=[[(label,time),...],n_times]. Noisy 'dd' elements are built during the evolution (None)"""
 
-					#check for detuning
-					if detuning != None:
-						if type(detuning)==list:
-							assert len(detuning)==L, "not enough elements given in detuning:\
-										 L={0:d}, length of detuning ={1:d}".format(*(L,len(detuning)))
-							detuing_list=[[detuning[j]*time,j] for j in range(L)]
-						else:
-							detuing_list=[[detuning*time,j] for j in range(L)]
+		##
+		# @param cache optional Propagator_cache (of a fixed H_dd, precision and tolerance). Elements whose key (see element_cache_key) is cached
+		# are not rebuilt, new propagators are added to the cache
+		# @param dtype precision of the propagators. Default is np.complex128
+		# @param tol tolerance of the propagators (see set_tol). Default is None
 
-						static += [['z',detuing_list]]
-					
+		current_time = 0.0
 
-					H = self.construct_Hamiltonian(basis, static )
-					expH = expm_multiply_parallel(H.tocsr(),a=-1j)
-					sequence_expH += [(sequence_brick[0],time,expH)]
+		#construct list to store the corresponding exp(H)
+		sequence_expH = []
+		for sequence_brick in element[0]:
+			time = sequence_brick[1]
 
-					current_time += time
+			if sequence_brick[0]=='dd' and noise != None:
+				expH = None
+			else:
+				key = self.element_cache_key(sequence_brick,current_time,detuning,AC_function,rabi_freq)
+				expH = cache.get(key) if cache != None else None
+				if expH is None:
+					expH = self.element_expH(sequence_brick,current_time,L,basis,H_dd,rabi_freq,detuning,AC_function,dtype,tol,zero_copy)
+					if cache != None:
+						expH = cache.put(key,expH)
 
-				element= [sequence_expH,element[1]] 
+			sequence_expH += [(sequence_brick[0],time,expH)]
+			current_time += time
 
-			return element
+		return [sequence_expH,element[1]]
 	
 
 
 
-	def build_noisy_expH(self,L,basis,H_dd,rabi_freq,detuning,AC_function,current_time,time,noise,random_num):
+	def build_noisy_expH(self,L,basis,H_dd,rabi_freq,detuning,AC_function,current_time,time,noise,random_num,dtype=np.complex128,tol=None,zero_copy=False):
 		# time is given in units of 1/self.energy_scale
 		# H_dd is alread rescaled in units of self.energy_scale
 		time += time*noise*random_num
+
+		if zero_copy and detuning == None and AC_function == None:
+			# propagator referencing H_dd itself instead of the copy H_dd*time (see NV_system.share)
+			return self.expm_reference(H_dd,time,dtype,tol)
 		
 		H=H_dd*time 
 						
@@ -541,20 +661,15 @@ class Helper_funcs():
 		# amplitudes appearing in AC function are assumed to be given in units of self.energy_scale
 		if AC_function != None:
 						
-			function = AC_function[0]
-			if len(AC_function)>1:
-				params = tuple(AC_function[1:]) # all parameters of interest such as amplitude, frequency etc
-				#integrate the AC function from current_time to current_time + time
-				AC_coupling=integrate.quad(lambda x: function(x,*params),current_time,current_time+time)[0]
-			else:
-				AC_coupling=integrate.quad(lambda x: function(x),current_time,current_time+time)[0]
+			#integrate the AC function from current_time to current_time + time
+			AC_coupling=self.integrate_AC(AC_function,current_time,current_time+time)
 
 			kick_list = [[AC_coupling,j] for j in range(L)]
 			static_z = [['z',kick_list]]
 			H += self.construct_Hamiltonian(basis, static_z).tocsr()
 
 
-		expH = expm_multiply_parallel(H,a=-1j)
+		expH = self.expm(H,dtype,tol)
 		
 		return expH
 
@@ -0,0 +1,248 @@
+import os, io, contextlib, tempfile, weakref
+import numpy as np
+from QNV4py.out_of_core import Chunked_state, Out_of_core_dynamics, popcount
+
+
+##
+# @file mpi.py Contains the classes Distributed_state and MPI_dynamics
+#
+
+
+
+def mpi():
+	"""! mpi4py.MPI, imported on first use (the import initializes MPI, i.e. importing QNV4py does not) """
+	try:
+		from mpi4py import MPI
+	except ImportError:
+		raise AssertionError ('the MPI backend requires mpi4py')
+	return MPI
+
+
+
+def rank_bits(comm):
+	"""! Number of index bits distributed over the processes of comm (the number of processes must be a power of 2) """
+	size = comm.Get_size()
+	assert size & (size-1) == 0, 'the number of MPI processes must be a power of 2, got {0:d}'.format(size)
+	return size.bit_length()-1
+
+
+
+class Distributed_state(Chunked_state):
+	"""! State of L spins distributed over the processes of an MPI communicator: the top rank_bits index bits are the rank of the process
+		holding the amplitudes, the remaining ones are processed in chunks as in Chunked_state (in memory or in a local file).
+		Passes over bits above the chunk gather the buffers of the processes differing in the rank bits among them (pairwise exchange for a
+		single rank bit), such that Kick_propagator and Trotter_propagator run unchanged. All processes have to take part in every operation """
+
+	def __init__(self,L,comm=None,chunk_size=2**20,group_bits=3,path=None,dtype=np.complex128):
+
+		##
+		# @param L system size
+		# @param comm MPI communicator, its size must be a power of 2. Default is None, i.e. MPI.COMM_WORLD
+		# @param chunk_size number of amplitudes per chunk (power of 2, at most 2**L/size of comm). Default is 2**20
+		# @param group_bits maximal number of bits above the chunk processed in one pass. Default is 3
+		# @param path directory of the local files (should be on a local disk). Default is None, i.e. the amplitudes are held in memory
+		# @param dtype dtype of the amplitudes. Default is np.complex128
+
+		assert chunk_size & (chunk_size-1) == 0, 'chunk_size must be a power of 2'
+
+		## MPI communicator of the processes holding the state
+		self.comm = mpi().COMM_WORLD if comm == None else comm
+
+		## rank of this process
+		self.rank = self.comm.Get_rank()
+
+		## number of index bits given by the rank
+		self.rank_bits = rank_bits(self.comm)
+		assert self.rank_bits <= L, 'more MPI processes than amplitudes'
+
+		self.L = L
+		self.Ns = 2**L
+		self.chunk_bits = min(int(chunk_size).bit_length()-1,L-self.rank_bits)
+		self.chunk_size = 2**self.chunk_bits
+		self.n_chunks = self.Ns//self.chunk_size
+		self.group_bits = max(1,group_bits)
+		self.dtype = np.dtype(dtype)
+
+		## number of chunks held by this process
+		self.n_local_chunks = self.n_chunks >> self.rank_bits
+
+		## first (global) chunk held by this process
+		self.first_chunk = self.rank*self.n_local_chunks
+
+		## directory of the local files (None: in memory)
+		self.path = path
+
+		## local file of the amplitudes (None in memory, deleted with this object)
+		self.file_name = None
+
+		## amplitudes of this process (indices first_chunk*chunk_size to (first_chunk+n_local_chunks)*chunk_size)
+		self.psi = None
+		if path == None:
+			self.psi = np.zeros(self.n_local_chunks*self.chunk_size,dtype=self.dtype)
+		else:
+			fd, self.file_name = tempfile.mkstemp(suffix='.psi',dir=path)
+			os.close(fd)
+			self.psi = np.memmap(self.file_name,dtype=self.dtype,mode='w+',shape=(self.n_local_chunks*self.chunk_size,))
+			weakref.finalize(self,os.remove,self.file_name)
+
+		self.chunk_popcount = popcount(np.arange(self.chunk_size),self.chunk_bits)
+		self.__communicators = {}
+
+
+	def local_bits(self):
+		"""! Number of index bits held by every process """
+		return self.L - self.rank_bits
+
+
+	def high_bit_groups(self):
+		"""! Bits above the chunk, in groups of at most group_bits bits. Groups do not mix local and rank bits """
+		local = list(range(self.chunk_bits,self.local_bits()))
+		distributed = list(range(self.local_bits(),self.L))
+		return [bits[i:i+self.group_bits] for bits in [local,distributed] for i in range(0,len(bits),self.group_bits)]
+
+
+	def communicator(self,bits):
+		"""! Communicator of the processes whose ranks differ only in the (rank) bits bits, ordered by their rank """
+		bits = tuple(bits)
+		if bits not in self.__communicators:
+			mask = sum(1<<(bit-self.local_bits()) for bit in bits)
+			self.__communicators[bits] = self.comm.Split(color=self.rank & ~mask,key=self.rank)
+		return self.__communicators[bits]
+
+
+	def groups(self,high_bits,write=True):
+		"""! Generator over (k, buffer) as in Chunked_state.groups, k is the global index of the first chunk. Buffers spanning rank bits are
+			gathered from the processes differing in these bits, every process writes back its own part """
+		high_bits = sorted(high_bits)
+		local = [bit for bit in high_bits if bit < self.local_bits()]
+		distributed = [bit for bit in high_bits if bit >= self.local_bits()]
+		C = self.chunk_size
+		offsets = np.zeros(1,dtype=np.int64)
+		for bit in local:
+			offsets = np.concatenate((offsets,offsets+(1<<(bit-self.chunk_bits))))
+		mask = int(offsets[-1])
+		buffer = np.empty(len(offsets)*C,dtype=self.dtype)
+
+		if len(distributed) == 0:
+			for k in range(self.n_local_chunks):
+				if k & mask:
+					continue
+				for m, i in enumerate(offsets):
+					buffer[m*C:(m+1)*C] = self.psi[(k+i)*C:(k+i+1)*C]
+				yield self.first_chunk+k, buffer
+				if write:
+					for m, i in enumerate(offsets):
+						self.psi[(k+i)*C:(k+i+1)*C] = buffer[m*C:(m+1)*C]
+			return
+
+		# the rank bits are the top bits of the buffer: the gathered buffers are ordered by rank
+		comm = self.communicator(distributed)
+		position = comm.Get_rank()
+		rank_mask = sum(1<<(bit-self.local_bits()) for bit in distributed)
+		first_chunk = (self.rank & ~rank_mask)*self.n_local_chunks
+		gathered = np.empty(comm.Get_size()*buffer.size,dtype=self.dtype)
+		for k in range(self.n_local_chunks):
+			if k & mask:
+				continue
+			for m, i in enumerate(offsets):
+				buffer[m*C:(m+1)*C] = self.psi[(k+i)*C:(k+i+1)*C]
+			comm.Allgather(buffer,gathered)
+			yield first_chunk+k, gathered
+			if write:
+				own = gathered[position*buffer.size:(position+1)*buffer.size]
+				for m, i in enumerate(offsets):
+					self.psi[(k+i)*C:(k+i+1)*C] = own[m*C:(m+1)*C]
+
+
+	def copies(self,high_bits):
+		"""! Number of processes holding the buffers of groups(high_bits) """
+		return 2**sum(1 for bit in high_bits if bit >= self.local_bits())
+
+
+	def allreduce(self,value):
+		"""! Sum of value over all processes """
+		return self.comm.allreduce(value,op=mpi().SUM)
+
+
+	def product_state(self,spinors):
+		"""! Sets the state to the product of the single spin states spinors[j] = (up, down) of the sites j """
+		c = self.chunk_bits
+		low = np.ones(1,dtype=self.dtype)
+		for p in range(c-1,-1,-1):
+			low = np.kron(low,spinors[self.L-1-p])
+		for k in range(self.n_local_chunks):
+			factor = 1.0
+			for p in range(c,self.L):
+				factor = factor*spinors[self.L-1-p][((self.first_chunk+k)>>(p-c)) & 1]
+			self.psi[k*self.chunk_size:(k+1)*self.chunk_size] = factor*low
+		return self
+
+
+	def copy(self,path=None):
+		"""! Copy of the state (in memory or in a new local file in the directory path) """
+		state = Distributed_state(self.L,self.comm,self.chunk_size,self.group_bits,path=path,dtype=self.dtype)
+		state.psi[:] = self.psi
+		return state
+
+
+	def to_array(self):
+		"""! All amplitudes as (in-memory) array on every process, only sensible for small L """
+		return np.concatenate(self.comm.allgather(np.array(self.psi)))
+
+
+
+class MPI_dynamics(Out_of_core_dynamics):
+	"""! Evolution of states distributed over the processes of an MPI communicator (see Distributed_state) with the propagators of
+		Out_of_core_dynamics. All processes run the same script, e.g. mpirun -n 4 python script.py. Expectation values are reduced over
+		the processes, i.e. every process returns the full data. Only rank 0 saves the data and prints """
+
+	def __init__(self,nv_instance,rabi_freq,kick_building_blocks,detuning=None,AC_function=None,trotter_step=0.01,
+					chunk_size=2**20,group_bits=3,comm=None,path=None,profile=False):
+
+		##
+		# @param nv_instance NV_system object (can be matrix free), identical on all processes (same seed)
+		# @param rabi_freq, kick_building_blocks, detuning, AC_function drive (see NV_dynamics)
+		# @param trotter_step maximal Trotter step of the 'dd' elements (see Out_of_core_dynamics). Default is 0.01
+		# @param chunk_size, group_bits chunks of the local parts of the states (see Distributed_state). Default is 2**20 and 3
+		# @param comm MPI communicator, its size must be a power of 2. Default is None, i.e. MPI.COMM_WORLD
+		# @param path directory of local state files. Default is None, i.e. the states are held in memory
+		# @param profile see NV_dynamics. Default is False
+
+		## MPI communicator of the processes
+		self.comm = mpi().COMM_WORLD if comm == None else comm
+		chunk_size = min(chunk_size,2**(nv_instance.L-rank_bits(self.comm)))
+
+		Out_of_core_dynamics.__init__(self,nv_instance,rabi_freq,kick_building_blocks,detuning=detuning,AC_function=AC_function,
+										trotter_step=trotter_step,chunk_size=chunk_size,group_bits=group_bits,path=path,profile=profile)
+		self.engine = 'mpi'
+
+
+	def new_state(self):
+		"""! Empty Distributed_state of the geometry of the propagators """
+		L, c, group_bits = self.geometry
+		return Distributed_state(L,self.comm,2**c,group_bits,path=self.path)
+
+
+	def save_data_tuple(self,data_tuple,file_name,save_dir,folder,sub_directories,
+					overwrite=False,extra_save_parameters=None):
+		# only rank 0 writes, all processes continue with its folder
+		if self.comm.Get_rank() == 0:
+			folder = Out_of_core_dynamics.save_data_tuple(self,data_tuple,file_name,save_dir,folder,sub_directories,
+															overwrite=overwrite,extra_save_parameters=extra_save_parameters)
+		return self.comm.bcast(folder,root=0)
+
+
+	def evolve_sequential(self,initial_state,n_steps,observable,sequence,file_name,save_every=1000,save_dir='./data/',
+						folder='new_data_set',extra_save_parameters=None):
+
+		"""! Evolution of the Distributed_state initial_state (see Out_of_core_dynamics.evolve_sequential). Output only on rank 0 """
+
+		if self.comm.Get_rank() == 0 and not os.path.exists(save_dir):
+			os.mkdir(save_dir)
+		self.comm.Barrier()
+		save_parameters = {'n_processes':self.comm.Get_size()}
+		if extra_save_parameters!=None:
+			save_parameters.update(extra_save_parameters)
+		with contextlib.redirect_stdout(io.StringIO()) if self.comm.Get_rank() != 0 else contextlib.nullcontext():
+			return Out_of_core_dynamics.evolve_sequential(self,initial_state,n_steps,observable,sequence,file_name,save_every=save_every,
+															save_dir=save_dir,folder=folder,extra_save_parameters=save_parameters)
@@ -0,0 +1,643 @@
+import os
+import numpy as np
+from scipy.linalg import expm, svd
+from QNV4py import Helper_funcs
+from QNV4py import Profiler
+from QNV4py.nv_dynamics import NV_dynamics
+from QNV4py.program import Program
+from QNV4py.out_of_core import PAULI
+
+hlp = Helper_funcs()
+
+
+##
+# @file mps.py Contains the classes MPS_state, Gate_propagator, TDVP_propagator and MPS_dynamics
+#
+
+
+## identity of a single spin
+IDENTITY = np.eye(2,dtype=np.complex128)
+
+
+
+def coupling_basis(J,k,tol):
+	"""! Orthonormal basis (columns) of the couplings J[i,j] of the sites i <= k to the sites j > k (truncated SVD of the off-diagonal block) """
+	block = J[:k+1,k+1:]
+	if block.size == 0 or np.max(np.abs(block)) == 0:
+		return np.zeros((J.shape[0]-k-1,0))
+	_, s, Vh = svd(block,full_matrices=False)
+	rank = int(np.sum(s > tol*max(np.max(np.abs(J)),s[0])))
+	return Vh[:rank].T
+
+
+
+def dipolar_mpo(J_xy,J_z,h,tol=1e-8):
+	"""! MPO of H = sum_{i<j} J^xy_ij (sigma^x_i sigma^x_j + sigma^y_i sigma^y_j) + J^z_ij sigma^z_i sigma^z_j + sum_i h_i sigma^z_i along the chain 0, ..., L-1.
+		The long-range couplings crossing a bond are compressed by an SVD of the off-diagonal block of the coupling matrix (singular values below
+		tol times the largest coupling are dropped). Returns the tensors W[n] of shape (left bond, right bond, 2, 2) with W[a,b,s,t] = <s|O|t> """
+
+	##
+	# @param J_xy, J_z symmetric coupling matrices (L,L) in the order of the chain
+	# @param h fields of the sites
+	# @param tol relative tolerance of the compression. Default is 1e-8
+
+	L = len(h)
+	# channels of the bonds: start, X couplings, Y couplings, Z couplings, finished
+	channels = [(J_xy,'x'),(J_xy,'y'),(J_z,'z')]
+	bases = {}
+	for J, label in channels:
+		if id(J) not in bases:
+			bases[id(J)] = [coupling_basis(J,k,tol) for k in range(L-1)] + [np.zeros((0,0))]
+
+	def layout(k):
+		# offsets of the channels at bond k (after site k) and its dimension
+		offsets, position = [], 1
+		for J, _ in channels:
+			offsets += [position]
+			position += bases[id(J)][k].shape[1] if k < L-1 else 0
+		return offsets, position+1
+
+	tensors = []
+	for k in range(L):
+		left_offsets, left_dim = layout(k-1) if k > 0 else ([1,1,1],2)
+		right_offsets, right_dim = layout(k)
+		W = np.zeros((left_dim,right_dim,2,2),dtype=np.complex128)
+		W[0,0] = IDENTITY
+		W[left_dim-1,right_dim-1] = IDENTITY
+		W[0,right_dim-1] = h[k]*PAULI['z']
+		for (J, label), left, right in zip(channels,left_offsets,right_offsets):
+			basis = bases[id(J)]
+			if k < L-1:
+				# site k opens the channels of bond k
+				opened = J[k,k+1:].dot(basis[k])
+				for m in range(len(opened)):
+					W[0,right+m] = opened[m]*PAULI[label]
+			if k > 0:
+				previous = basis[k-1]
+				for m in range(previous.shape[1]):
+					# channels of bond k-1 close at site k (the first site right of the bond) ...
+					W[left+m,right_dim-1] = previous[0,m]*PAULI[label]
+					# ... or are passed on to bond k
+					if k < L-1:
+						transfer = previous[1:,m].dot(basis[k])
+						for n in range(len(transfer)):
+							W[left+m,right+n] = transfer[n]*IDENTITY
+		tensors += [W]
+
+	# boundaries: the chain starts in the channel start and ends in the channel finished
+	tensors[0] = tensors[0][:1]
+	tensors[-1] = tensors[-1][:,-1:]
+	return tensors
+
+
+
+def expm_krylov(apply,v,tau,n_krylov=30,tol=1e-12):
+	"""! exp(-i tau H) v with a Lanczos approximation of the hermitian operator apply(v) = H v """
+	beta = np.linalg.norm(v)
+	if beta == 0:
+		return v
+	vectors = [v/beta]
+	alpha, off_diagonal = [], []
+	for k in range(min(n_krylov,v.size)):
+		w = apply(vectors[k])
+		alpha += [np.vdot(vectors[k],w).real]
+		for u in vectors:
+			w = w - np.vdot(u,w)*u
+		b = np.linalg.norm(w)
+		T = np.diag(alpha) + np.diag(off_diagonal,1) + np.diag(off_diagonal,-1)
+		c = expm(-1j*tau*T)[:,0]
+		if b < tol or abs(c[-1])*b < tol or k == min(n_krylov,v.size)-1:
+			break
+		off_diagonal += [b]
+		vectors += [w/b]
+	return beta*sum(c[n]*vectors[n] for n in range(len(c)))
+
+
+
+class MPS_state():
+	"""! Matrix product state of L spins along a chain. Tensor n (shape (left bond, 2, right bond), index 0 spin up) belongs to the site order[n].
+		Keeps track of the discarded weight of all truncations """
+
+	def __init__(self,L,order=None):
+
+		##
+		# @param L system size
+		# @param order sites of the chain positions. Default is None, i.e. range(L)
+
+		## system size
+		self.L = L
+
+		## sites of the chain positions
+		self.order = list(range(L)) if order == None else list(order)
+
+		## tensors of the chain positions
+		self.tensors = [np.zeros((1,2,1),dtype=np.complex128) for _ in range(L)]
+
+		## discarded weight of all truncations so far
+		self.truncation_error = 0.0
+
+
+	def product_state(self,spinors):
+		"""! Sets the state to the product of the single spin states spinors[j] = (up, down) of the sites j """
+		for n, site in enumerate(self.order):
+			self.tensors[n] = np.array(spinors[site],dtype=np.complex128).reshape(1,2,1)
+		self.truncation_error = 0.0
+		return self
+
+
+	def bond_dimensions(self):
+		"""! Bond dimensions between the chain positions """
+		return [A.shape[2] for A in self.tensors[:-1]]
+
+
+	def max_bond_dimension(self):
+		"""! Largest bond dimension """
+		return max(self.bond_dimensions(),default=1)
+
+
+	def expectation(self,directions):
+		"""! Expectation values of sum_j sigma^a_j / L for a in directions ('x', 'y' or 'z') """
+		values = []
+		for direction in directions:
+			identity = np.ones((1,1),dtype=np.complex128)
+			total = np.zeros((1,1),dtype=np.complex128)
+			for A in self.tensors:
+				transfer = lambda E, O: np.einsum('ab,atc,st,bsd->cd',E,A,O,A.conj(),optimize=True)
+				total = transfer(total,IDENTITY) + transfer(identity,PAULI[direction])
+				identity = transfer(identity,IDENTITY)
+			values += [(total[0,0]/identity[0,0]).real/self.L]
+		return values
+
+
+	def norm(self):
+		"""! Norm of the state """
+		E = np.ones((1,1),dtype=np.complex128)
+		for A in self.tensors:
+			E = np.einsum('ab,asc,bsd->cd',E,A,A.conj(),optimize=True)
+		return np.sqrt(abs(E[0,0]))
+
+
+	def copy(self):
+		"""! Copy of the state """
+		state = MPS_state(self.L,self.order)
+		state.tensors = [A.copy() for A in self.tensors]
+		state.truncation_error = self.truncation_error
+		return state
+
+
+	def to_array(self):
+		"""! Amplitudes in the basis of spin_basis_1d(L,pauli=True), only sensible for small L """
+		psi = np.ones((1,1),dtype=np.complex128)
+		for A in self.tensors:
+			psi = np.tensordot(psi,A,axes=([1],[0])).reshape(-1,A.shape[2])
+		# site order[n] is axis n: sites in increasing order, site 0 the most significant
+		psi = psi.reshape([2]*self.L).transpose(np.argsort(self.order))
+		return psi.reshape(-1)
+
+
+
+class Gate_propagator():
+	"""! Kick applied to an MPS_state: a single site gate on every site (exact, keeps the canonical form) """
+
+	def __init__(self,U):
+
+		##
+		# @param U single spin unitaries of all sites, array (L,2,2)
+
+		## unitaries of the sites
+		self.U = np.array(U)
+
+
+	def dot(self,psi,work_array=None,overwrite_v=True):
+		"""! Propagator interface (see expm_multiply_parallel.dot): applies the gates to the MPS_state psi (in-place) """
+		assert overwrite_v, 'matrix product states are evolved in-place'
+		for n, site in enumerate(psi.order):
+			psi.tensors[n] = np.einsum('st,atb->asb',self.U[site],psi.tensors[n])
+		return psi
+
+
+
+class TDVP_propagator():
+	"""! 'dd' element applied to an MPS_state: second order two-site TDVP sweeps with the MPO of H_dd (see dipolar_mpo). Bonds are truncated to
+		chi_max and a discarded weight of at most cutoff per SVD. The uniform AC field commutes with H_dd and is applied as exact z rotations """
+
+	def __init__(self,mpo,time,time_step=0.05,chi_max=64,cutoff=1e-12,AC_angle=0.0,expansion=True):
+
+		##
+		# @param mpo MPO tensors of H_dd in the order of the chain (including the detuning)
+		# @param time duration of the element
+		# @param time_step maximal TDVP step. Default is 0.05
+		# @param chi_max maximal bond dimension. Default is 64
+		# @param cutoff maximal discarded weight per truncation. Default is 1e-12
+		# @param AC_angle integral of the AC field over the element. Default is 0
+		# @param expansion enlarge the bonds before the TDVP steps until they are saturated (see expand). Default is True
+
+		self.__mpo = mpo
+
+		## number of TDVP steps
+		self.n_steps = max(1,int(np.ceil(time/time_step-1e-12)))
+
+		## duration of a TDVP step
+		self.dt = time/self.n_steps
+
+		## maximal bond dimension
+		self.chi_max = chi_max
+
+		## maximal discarded weight per truncation
+		self.cutoff = cutoff
+
+		## integral of the AC field over the element
+		self.AC_angle = AC_angle
+
+		## whether unsaturated bonds are enlarged before the TDVP steps
+		self.expansion = expansion
+
+
+	def __left(self,E,A,W):
+		X = np.tensordot(E,A,axes=([0],[0]))
+		X = np.tensordot(X,W,axes=([0,2],[0,3]))
+		return np.tensordot(X,A.conj(),axes=([0,3],[0,1]))
+
+
+	def __right(self,E,A,W):
+		X = np.tensordot(A,E,axes=([2],[0]))
+		X = np.tensordot(X,W,axes=([1,2],[3,1]))
+		return np.tensordot(X,A.conj(),axes=([3,1],[1,2]))
+
+
+	def __two_site(self,left,W1,W2,right):
+		def apply(theta):
+			X = np.tensordot(left,theta,axes=([0],[0]))
+			X = np.tensordot(X,W1,axes=([0,2],[0,3]))
+			X = np.tensordot(X,W2,axes=([3,1],[0,3]))
+			return np.tensordot(X,right,axes=([1,3],[0,1]))
+		return apply
+
+
+	def __one_site(self,left,W,right):
+		def apply(A):
+			X = np.tensordot(left,A,axes=([0],[0]))
+			X = np.tensordot(X,W,axes=([0,2],[0,3]))
+			return np.tensordot(X,right,axes=([1,2],[0,1]))
+		return apply
+
+
+	def __split(self,theta,psi):
+		# truncated SVD of the two-site tensor theta (a, s1, s2, c)
+		a, _, _, c = theta.shape
+		U, s, Vh = svd(theta.reshape(2*a,2*c),full_matrices=False,lapack_driver='gesvd')
+		weights = s**2/np.sum(s**2)
+		discarded = np.cumsum(weights[::-1])[::-1]
+		keep = max(1,min(self.chi_max,int(np.sum(discarded > self.cutoff))))
+		psi.truncation_error += float(np.sum(weights[keep:]))
+		s = s[:keep]/np.linalg.norm(s[:keep])
+		return U[:,:keep].reshape(a,2,keep), s, Vh[:keep].reshape(keep,2,c)
+
+
+	def expand(self,psi):
+		"""! Enlarges the right bases of psi (center at the first site) up to chi_max: the bases of psi are kept and completed with the part of
+			the right bases of H psi orthogonal to them. Without the expansion, TDVP cannot build up entanglement between distant sites from
+			states of small bond dimension, e.g. product states. psi itself is unchanged """
+		A, W, L = psi.tensors, self.__mpo, psi.L
+		# H psi as an MPS with bonds of dimension chi times the MPO bond dimension
+		phi = []
+		for n in range(L):
+			a, _, b = A[n].shape
+			phi += [np.einsum('uvst,atb->aubvs',W[n],A[n]).reshape(a*W[n].shape[0],b*W[n].shape[1],2).transpose(0,2,1)]
+
+		# from the right: the tensors of psi and H psi at site n with their right bonds in the new basis of the sites > n
+		bases = [None]*L
+		psi_n, phi_n = A[L-1], phi[L-1]
+		for n in range(L-1,0,-1):
+			a = psi_n.shape[0]
+			M_psi = psi_n.reshape(a,-1)
+			M_phi = phi_n.reshape(phi_n.shape[0],-1)
+			new = M_psi
+			extra = min(self.chi_max,M_psi.shape[1])-a
+			if extra > 0 and np.linalg.norm(M_phi) > 0:
+				# part of the states of H psi orthogonal to the (orthonormal) right basis states of psi
+				R = M_phi - M_phi.dot(M_psi.conj().T).dot(M_psi)
+				_, s, Vh = svd(R,full_matrices=False,lapack_driver='gesvd')
+				keep = min(extra,int(np.sum(s > 1e-10*np.linalg.norm(M_phi,2))))
+				if keep > 0:
+					complement = Vh[:keep] - Vh[:keep].dot(M_psi.conj().T).dot(M_psi)
+					complement = np.linalg.qr(complement.T)[0].T
+					new = np.concatenate([M_psi,complement],axis=0)
+			bases[n] = new.reshape(new.shape[0],2,-1)
+			# psi: its right basis states are the first ones of the new basis. H psi: projected onto the new basis
+			psi_n = np.zeros(A[n-1].shape[:2]+(new.shape[0],),dtype=np.complex128)
+			psi_n[:,:,:a] = A[n-1]
+			phi_n = np.tensordot(phi[n-1],M_phi.dot(new.conj().T),axes=([2],[0]))
+		psi.tensors = [psi_n] + bases[1:]
+
+
+	def saturated(self,psi):
+		"""! Whether all bonds of psi have their largest possible dimension (chi_max or the dimension of the smaller side) """
+		return all(chi >= min(self.chi_max,2**min(n+1,psi.L-n-1)) for n, chi in enumerate(psi.bond_dimensions()))
+
+
+	def sweep(self,psi,tau):
+		"""! One second order TDVP step of duration 2*tau: a left to right and a right to left sweep of duration tau each """
+		A, W, L = psi.tensors, self.__mpo, psi.L
+		if L == 1:
+			A[0] = expm_krylov(self.__one_site(np.ones((1,1,1)),W[0],np.ones((1,1,1))),A[0],2*tau)
+			return
+		# environments, the center of the state is the first site
+		left = [np.ones((1,1,1),dtype=np.complex128)] + [None]*L
+		right = [None]*L + [np.ones((1,1,1),dtype=np.complex128)]
+		for n in range(L-1,0,-1):
+			right[n] = self.__right(right[n+1],A[n],W[n])
+
+		for n in range(L-1):
+			theta = np.tensordot(A[n],A[n+1],axes=([2],[0]))
+			theta = expm_krylov(self.__two_site(left[n],W[n],W[n+1],right[n+2]),theta,tau)
+			A[n], s, Vh = self.__split(theta,psi)
+			A[n+1] = s[:,None,None]*Vh
+			left[n+1] = self.__left(left[n],A[n],W[n])
+			if n < L-2:
+				A[n+1] = expm_krylov(self.__one_site(left[n+1],W[n+1],right[n+2]),A[n+1],-tau)
+
+		for n in range(L-2,-1,-1):
+			theta = np.tensordot(A[n],A[n+1],axes=([2],[0]))
+			theta = expm_krylov(self.__two_site(left[n],W[n],W[n+1],right[n+2]),theta,tau)
+			U, s, A[n+1] = self.__split(theta,psi)
+			A[n] = U*s[None,None,:]
+			right[n+1] = self.__right(right[n+2],A[n+1],W[n+1])
+			if n > 0:
+				A[n] = expm_krylov(self.__one_site(left[n],W[n],right[n+1]),A[n],-tau)
+
+
+	def dot(self,psi,work_array=None,overwrite_v=True):
+		"""! Propagator interface (see expm_multiply_parallel.dot): evolves the MPS_state psi (in-place) """
+		assert overwrite_v, 'matrix product states are evolved in-place'
+		assert len(self.__mpo) == psi.L, 'the state does not match the MPO'
+		for _ in range(self.n_steps):
+			if self.expansion and psi.L > 1 and not self.saturated(psi):
+				self.expand(psi)
+			self.sweep(psi,self.dt/2)
+		if self.AC_angle != 0:
+			U = expm(-1j*self.AC_angle*PAULI['z'])
+			for n in range(psi.L):
+				psi.tensors[n] = np.einsum('st,atb->asb',U,psi.tensors[n])
+		return psi
+
+
+
+class MPS_dynamics(NV_dynamics):
+	"""! Matrix product state evolution of the drives of NV_dynamics for moderately large L with bounded entanglement: kicks are exact single site
+		gates, 'dd' elements are evolved with two-site TDVP (see TDVP_propagator) using an SVD-compressed MPO of H_dd (see dipolar_mpo).
+		The bond dimension and the accumulated truncation error are recorded at every measurement. No noise """
+
+	def __init__(self,nv_instance,rabi_freq,kick_building_blocks,detuning=None,AC_function=None,time_step=0.05,chi_max=64,cutoff=1e-12,
+					mpo_tol=1e-8,order=None,expansion=True,profile=False):
+
+		##
+		# @param nv_instance NV_system object (can be matrix free)
+		# @param rabi_freq, kick_building_blocks, detuning, AC_function drive (see NV_dynamics)
+		# @param time_step maximal TDVP step of the 'dd' elements (in units of 1/energy_scale). Default is 0.05
+		# @param chi_max maximal bond dimension. Default is 64
+		# @param cutoff maximal discarded weight per truncation (2(L-1) per TDVP step, the error accumulates over the steps). Default is 1e-12
+		# @param mpo_tol relative tolerance of the compression of the couplings in the MPO. Default is 1e-8
+		# @param order sites along the chain, e.g. sorted by position or 'rcm' (reverse Cuthill-McKee ordering of the couplings).
+		# Default is None, i.e. range(L)
+		# @param expansion enlarge unsaturated bonds before the TDVP steps (see TDVP_propagator.expand). Default is True
+		# @param profile see NV_dynamics. Default is False
+
+		self.__dict__.update(nv_instance.__dict__)
+
+		# system and drive (used to rebuild the drive with other TDVP steps, see exact_deviation)
+		self.__system = nv_instance
+		self.__settings = {'rabi_freq':rabi_freq,'kick_building_blocks':kick_building_blocks,'detuning':detuning,'AC_function':AC_function,
+							'chi_max':chi_max,'cutoff':cutoff,'mpo_tol':mpo_tol,'order':order,'expansion':expansion}
+
+		self.profiler = None
+		if profile:
+			self.profiler = Profiler()
+			if nv_instance.__dict__.get('profiler') != None:
+				self.profiler.merge(nv_instance.profiler)
+
+		self.detuning = detuning
+		self.rabi_freq = rabi_freq
+		self.noise = None
+		self.noise_bins = None
+		self.AC_function = AC_function
+		self.engine = 'mps'
+		self.precision = 'double'
+		self.dtype = np.complex128
+		self.renormalize_every = None
+		self.async_measure = False
+
+		## maximal TDVP step of the 'dd' elements
+		self.time_step = time_step
+
+		## maximal bond dimension
+		self.chi_max = chi_max
+
+		## maximal discarded weight per truncation
+		self.cutoff = cutoff
+
+		## relative tolerance of the MPO compression
+		self.mpo_tol = mpo_tol
+
+		## whether unsaturated bonds are enlarged before the TDVP steps
+		self.expansion = expansion
+
+		assert type(kick_building_blocks)==list, 'kick_squence must be  of type list'
+		for block in kick_building_blocks:
+			for element in block[0]:
+				assert type(element)==tuple and len(element)==2 and element[0] in ['x','y','z','dd'], 'element {0} not understood'.format(element)
+
+		if detuning == None:
+			detuning_list = np.zeros(self.L)
+		elif type(detuning)==list:
+			assert len(detuning)==self.L, 'not enough elements given in detuning: L={0:d}, length of detuning ={1:d}'.format(self.L,len(detuning))
+			detuning_list = np.array(detuning,dtype=np.float64)
+		else:
+			detuning_list = detuning*np.ones(self.L)
+
+		pairs, J_xy, J_z, h = self.dd_terms()
+		J_xy_matrix = np.zeros((self.L,self.L))
+		J_z_matrix = np.zeros((self.L,self.L))
+		J_xy_matrix[pairs[:,0],pairs[:,1]] = J_xy
+		J_z_matrix[pairs[:,0],pairs[:,1]] = J_z
+		J_xy_matrix += J_xy_matrix.T
+		J_z_matrix += J_z_matrix.T
+
+		if type(order)==str:
+			assert order=='rcm', "order {0} not understood".format(order)
+			from scipy.sparse import csr_matrix
+			from scipy.sparse.csgraph import reverse_cuthill_mckee
+			strength = np.maximum(np.abs(J_xy_matrix),np.abs(J_z_matrix))
+			order = list(reverse_cuthill_mckee(csr_matrix(strength*(strength>=0.1*np.max(strength))),symmetric_mode=True))
+
+		## sites along the chain of the states
+		self.order = list(range(self.L)) if order == None else [int(site) for site in order]
+		assert sorted(self.order) == list(range(self.L)), 'order must be a permutation of the sites'
+
+		with self.profiling(), self.phase('build/mpo'):
+			chain = np.array(self.order)
+			h_dd = (h+detuning_list)[chain]
+			mpo = dipolar_mpo(J_xy_matrix[np.ix_(chain,chain)],J_z_matrix[np.ix_(chain,chain)],h_dd,tol=mpo_tol)
+
+		## bond dimensions of the MPO of H_dd (including the detuning)
+		self.mpo_bond_dimensions = [W.shape[1] for W in mpo[:-1]]
+
+		## building blocks of the sequences to be applied (with Gate_propagator and TDVP_propagator objects)
+		self.building_blocks = []
+		with self.profiling(), self.phase('build/setup'):
+			for block in kick_building_blocks:
+				current_time = 0.0
+				sequence = []
+				for label, time in block[0]:
+					if label=='dd':
+						AC_angle = 0.0
+						if AC_function != None:
+							AC_angle = hlp.integrate_AC(AC_function,current_time,current_time+time)
+						propagator = TDVP_propagator(mpo,time,time_step,chi_max,cutoff,AC_angle,expansion)
+					else:
+						# kick (rabi_freq*time*sigma^label + detuning*time*sigma^z) on every site
+						propagator = Gate_propagator([expm(-1j*(rabi_freq*time*PAULI[label] + detuning_list[j]*time*PAULI['z'])) for j in range(self.L)])
+					sequence += [(label,time,propagator)]
+					current_time += time
+				self.building_blocks += [[sequence,block[1]]]
+
+		## compact representation of the building blocks (see Program)
+		self.program = Program(self.building_blocks)
+
+		## largest bond dimension at the measurements of the last run
+		self.bond_dimensions = np.zeros(1)
+
+		## accumulated truncation error at the measurements of the last run
+		self.truncation_errors = np.zeros(1)
+
+
+	def exact_deviation(self,initial_state,n_steps,observable,file_name,time_steps=None,cutoff=0.0,save_dir='./data/',engine='krylov'):
+		"""! Checks the evolve_periodic of the MPS against the exact evolve_periodic of NV_dynamics (only sensible for small L, needs H_dd):
+			runs the drive with each of the TDVP steps time_steps and quantifies the deviation of the observables """
+
+		##
+		# With chi_max at least 2^(L/2) and cutoff 0, the bonds are not truncated and the deviation is the error of the time steps of TDVP, 
+		# which decreases quadratically with the time step. All runs are saved (in different folders of the data file, see save_data).
+		#
+		# @param initial_state direction 'x', 'y' or 'z' of the polarized initial state
+		# @param n_steps, observable, file_name, save_dir see evolve_periodic (observable: list of directions)
+		# @param time_steps TDVP steps to compare. Default is None, i.e. time_step, time_step/2 and time_step/4
+		# @param cutoff maximal discarded weight per truncation of the runs (see TDVP_propagator). Default is 0, i.e. truncations to chi_max only
+		# @param engine engine of the exact NV_dynamics reference. Default is 'krylov'
+		#
+		# @return dict with 'time_steps', 'max_deviation' (maximal absolute deviation of all observables for each time step), 'times',
+		# the data of the exact run ('exact') and of the runs of the time steps ('data')
+
+		assert not self.matrix_free, 'the exact reference needs H_dd (matrix_free=False)'
+		if time_steps == None:
+			time_steps = [self.time_step,self.time_step/2,self.time_step/4]
+
+		settings = dict(self.__settings)
+		settings['cutoff'] = cutoff
+		rabi_freq = settings.pop('rabi_freq')
+		kick_building_blocks = settings.pop('kick_building_blocks')
+		exact = NV_dynamics(self.__system,rabi_freq,kick_building_blocks,engine=engine,detuning=settings['detuning'],AC_function=settings['AC_function'])
+		data_exact, times = exact.evolve_periodic(exact.initial_state(initial_state),n_steps,exact.SP_observable(observable),file_name,save_dir=save_dir)
+
+		data, max_deviation = [], []
+		for time_step in time_steps:
+			mps = MPS_dynamics(self.__system,rabi_freq,kick_building_blocks,time_step=time_step,**settings)
+			data += [mps.evolve_periodic(mps.initial_state(initial_state),n_steps,observable,file_name,save_dir=save_dir)[0]]
+			max_deviation += [float(np.abs(data[-1]-data_exact).max())]
+
+		return {'time_steps':list(time_steps),'max_deviation':max_deviation,'times':times,'exact':data_exact,'data':data}
+
+
+	def work_array(self,psi):
+		# the propagators work on the tensors
+		return None
+
+
+	def initial_state(self,direction):
+		"""! Product MPS_state polarized along direction ('x', 'y' or 'z'), see NV_system.initial_state """
+		spinor = {'z':np.array([1,0]),'x':np.array([1,1])/np.sqrt(2),'y':np.array([1,1j])/np.sqrt(2)}
+		assert direction in spinor, "input not understood: direction should be 'x', 'y' or 'z'"
+		return MPS_state(self.L,self.order).product_state([spinor[direction]]*self.L)
+
+
+	def SP_observable(self,directions):
+		"""! Observables sum_j sigma^a_j of the directions, evaluated on the MPS (the directions themselves) """
+		for char in directions:
+			assert char in ['x','y','z'], 'input not understood'
+		return list(directions)
+
+
+	def measure_function(self,observable):
+		# the observables and the bond dimension and truncation error of every measurement
+		point = [0]
+		def measure(psi,out):
+			out[:] = psi.expectation(observable)
+			self.bond_dimensions[point[0]] = psi.max_bond_dimension()
+			self.truncation_errors[point[0]] = psi.truncation_error
+			point[0] += 1
+		return measure
+
+
+	def save_data_tuple(self,data_tuple,file_name,save_dir,folder,sub_directories,
+					overwrite=False,extra_save_parameters=None):
+		# the bond dimensions and truncation errors are saved with the observables
+		return NV_dynamics.save_data_tuple(self,data_tuple+(self.bond_dimensions,self.truncation_errors),file_name,save_dir,folder,
+											sub_directories+('bond_dimension','truncation_error'),overwrite=overwrite,
+											extra_save_parameters=extra_save_parameters)
+
+
+	def evolve_periodic(self,initial_state,n_steps,observable,file_name,save_every=1000,save_dir='./data/',
+						folder='new_data_set',extra_save_parameters=None):
+
+		"""! Floquet evolution of the MPS_state initial_state (see NV_dynamics.evolve_periodic). The final state is stored in final_state,
+			the bond dimensions and truncation errors of the measurements in bond_dimensions and truncation_errors """
+
+		##
+		# @param observable list of directions 'x', 'y', 'z' (see SP_observable)
+		#
+		# @return data, times
+
+		return self.evolve_sequential(initial_state,n_steps,observable,None,file_name,save_every=save_every,save_dir=save_dir,
+										folder=folder,extra_save_parameters=extra_save_parameters)
+
+
+	def evolve_sequential(self,initial_state,n_steps,observable,sequence,file_name,save_every=1000,save_dir='./data/',
+						folder='new_data_set',extra_save_parameters=None):
+
+		"""! Evolution of the MPS_state initial_state with the blocks sequence[step] (see NV_dynamics.evolve_sequential).
+			sequence=None applies all blocks at every step. The final state is stored in final_state """
+
+		##
+		# @param observable list of directions 'x', 'y', 'z' (see SP_observable)
+		#
+		# @return data, times
+
+		if not os.path.exists(save_dir):
+			os.mkdir(save_dir)
+		assert isinstance(initial_state,MPS_state) and initial_state.order==self.order, 'initial_state must be an MPS_state of initial_state()'
+		self.SP_observable(observable)
+
+		if sequence == None:
+			blocks_of_step = lambda step: self.program.blocks
+			points = sum(self.data_points())*n_steps
+		else:
+			assert len(sequence)>=n_steps, 'sequence is too short'
+			blocks_of_step = lambda step: [self.program.blocks[sequence[step]]]
+			points = sum(self.data_points()[sequence[step]] for step in range(n_steps))
+
+		data = np.zeros((len(observable),points+1))
+		times = np.zeros(points+1)
+		self.bond_dimensions = np.zeros(points+1,dtype=np.int64)
+		self.truncation_errors = np.zeros(points+1)
+
+		save_parameters = {'time_step':self.time_step,'chi_max':self.chi_max,'cutoff':self.cutoff,'mpo_tol':self.mpo_tol,'expansion':self.expansion,
+							'max_mpo_bond_dimension':max(self.mpo_bond_dimensions,default=1)}
+		if extra_save_parameters!=None:
+			save_parameters.update(extra_save_parameters)
+
+		## state after the last evolution (MPS_state)
+		self.final_state = initial_state.copy()
+
+		return self.execute_program(blocks_of_step,n_steps,self.final_state,observable,data,times,None,
+										file_name,save_every,save_dir,folder,save_parameters,
+										'finished step {0:d}')
@@ -10,12 +10,19 @@ import contextlib
 from scipy.linalg import logm, expm
 import h5py
 import copy
+from concurrent.futures import ThreadPoolExecutor, Future
+from types import SimpleNamespace
+from time import perf_counter
 #from helper_funcs import *
 #from nv_system import *
 
 
 from QNV4py import Helper_funcs
 from QNV4py import NV_system
+from QNV4py import Program
+from QNV4py import Profiler
+from QNV4py.program import Compiled_block, Dense_expH, Propagator_cache, Noise_stream
+from QNV4py.planner import Run_planner
 
 hlp = Helper_funcs()
 
@@ -30,10 +37,26 @@ class NV_dynamics(NV_system):
 	"""! Computes (Floquet) dynamics generated from the input sequence of kicks """
 	
 
-	def __init__(self,nv_instance,rabi_freq,kick_building_blocks,detuning=None,AC_function=None,noise=None):
+	## largest system size for which engine='auto' uses dense unitaries
+	dense_max_L = 10
+
+
+	def __init__(self,nv_instance,rabi_freq,kick_building_blocks,detuning=None,AC_function=None,noise=None,engine='auto',noise_bins=None,noise_tol=None,cache_memory=2**28,async_measure=False,
+					precision='double',renormalize_every=None,tol=None,profile=False,propagator_cache=None):
 		#self,kick_seq,RK=False,*system_params):
 		#parameters = {param: getattr(nv_instance, param) for param in dir(nv_instance) if not param.startswith("__")} 
-		super().__init__(nv_instance.B_field_dir,nv_instance.L, nv_instance.min_dist,nv_instance.max_dist,nv_instance.seed,scaling_factor=nv_instance.scaling_factor)
+
+		# adopt graph, energy scale and Hamiltonian components of nv_instance instead of resampling the graph and re-estimating the energy scale.
+		# This makes NV_dynamics objects built from views (see NV_system.rescaled) cheap
+		self.__dict__.update(nv_instance.__dict__)
+
+		## Profiler with the wall time and calls per phase of the construction and of all evolve_* calls (None if profile is False).
+		# Includes the construction phases of nv_instance if it was profiled as well. Stored as attributes of the saved data sets
+		self.profiler = None
+		if profile:
+			self.profiler = Profiler()
+			if nv_instance.__dict__.get('profiler') != None:
+				self.profiler.merge(nv_instance.profiler)
 
 		## Detuning. Default is None
 		self.detuning = detuning
@@ -48,6 +71,41 @@ class NV_dynamics(NV_system):
 		# Then, during time evolution f(x,parameter1,parameter2,parameter3) will be used (and integrated over x).
 		# Applied to each block of the sequence (see building_blocks) separately.
 		self.AC_function =AC_function
+
+		## engine used to apply the building blocks: 'krylov' (expm_multiply_parallel) or 'dense' (dense unitaries, only sensible for small L).
+		# 'auto' picks 'dense' for L <= dense_max_L
+		assert engine in ['auto','krylov','dense'], "engine must be 'auto', 'krylov' or 'dense'"
+		auto_engine = engine=='auto'
+		if auto_engine:
+			engine = 'dense' if self.L <= self.dense_max_L else 'krylov'
+		self.engine = engine
+
+		## engine of the blocks rebuilt at every step of evolve_time_dependent. 'auto' picks 'krylov': a dense unitary does not pay off for a single application
+		self.time_dependent_engine = 'krylov' if auto_engine else engine
+
+		## precision of H_dd, the propagators and the states: 'double' (np.complex128) or 'single' (np.complex64)
+		assert precision in ['double','single'], "precision must be 'double' or 'single'"
+		self.precision = precision
+
+		## numpy dtype corresponding to precision
+		self.dtype = np.complex128 if precision=='double' else np.complex64
+
+		## 'dd' propagators (without detuning and AC field) reference H_dd instead of a scaled copy if H_dd lives in shared memory (see NV_system.share)
+		self.zero_copy = self.is_shared('H_dd')
+
+		## tolerance of all propagators of the drive (see Helper_funcs.set_tol). Default is None, i.e. the tolerance of nv_instance
+		if tol != None:
+			self.tol = tol
+
+		## the states are renormalized every renormalize_every steps. None: every 100 steps in single precision, never in double precision
+		self.renormalize_every = renormalize_every
+		if renormalize_every==None and precision=='single':
+			self.renormalize_every = 100
+
+		# input of the constructor (used to rebuild the drive in another precision, see precision_drift)
+		self.__settings = {'rabi_freq':rabi_freq,'kick_building_blocks':kick_building_blocks,'detuning':detuning,
+							'AC_function':AC_function,'noise':noise,'engine':'auto' if auto_engine else engine,'noise_bins':noise_bins,'noise_tol':noise_tol,
+							'cache_memory':cache_memory,'async_measure':async_measure,'renormalize_every':renormalize_every,'tol':tol,'profile':profile}
 		
 		#check if kick_building_block is of right form
 		if type(kick_building_blocks)!=list:
@@ -72,8 +130,59 @@ class NV_dynamics(NV_system):
 		# set up list of exponentials according to the building blocks
 		
 		## building blocks of the seqeunces to be applied
-		self.building_blocks = hlp.setup_expH(self.L,self.basis,self.H_dd,
-			kick_building_blocks,rabi_freq,detuning,self.AC_function,self.noise)
+		with self.profiling(), self.phase('build/setup_expH'):
+			if propagator_cache == None:
+				self.building_blocks = hlp.setup_expH(self.L,self.basis,self.H_dd,
+					kick_building_blocks,rabi_freq,detuning,self.AC_function,self.noise,dtype=self.dtype,tol=self.tol,zero_copy=self.zero_copy)
+			else:
+				# propagators shared with other drives of the same system (see Parameter_sweep)
+				assert propagator_cache.dense == (self.engine=='dense'), 'the propagator cache must match the engine'
+				self.building_blocks = [hlp.update_building_blocks(block,self.L,self.basis,self.H_dd,rabi_freq,detuning,self.AC_function,self.noise,
+									cache=propagator_cache,dtype=self.dtype,tol=self.tol,zero_copy=self.zero_copy) for block in kick_building_blocks]
+
+		## compact array representation of the building blocks executed by the evolve_* methods (see Program)
+		with self.phase('build/program'):
+			self.program = Program(self.building_blocks,dense=self.engine=='dense')
+		if self.profiler != None:
+			for b,block in enumerate(self.program.blocks):
+				block.profile(self.profiler,'apply/block {0:d}'.format(b))
+		self.__multipoles = {}
+
+		## LRU cache of element propagators (limited to cache_memory bytes) used to rebuild time dependent blocks, see evolve_time_dependent.
+		# Can be shared among drives of the same NV_system, precision and tol (input propagator_cache)
+		self.propagator_cache = Propagator_cache(max_bytes=cache_memory,dense=self.engine=='dense') if propagator_cache == None else propagator_cache
+
+		## LRU cache of the element propagators of the time dependent blocks (the propagator_cache unless time_dependent_engine differs from engine)
+		self.time_dependent_cache = self.propagator_cache
+		if self.propagator_cache.dense != (self.time_dependent_engine=='dense'):
+			self.time_dependent_cache = Propagator_cache(max_bytes=cache_memory,dense=self.time_dependent_engine=='dense')
+
+		## if True, observables are evaluated on a worker thread (on a copy of the state) while the next propagators are applied, see Async_measurement
+		self.async_measure = async_measure
+
+		## timing report of the measurements of the last evolve_* call (see Async_measurement.report)
+		self.measurement_report = None
+
+		## number of bins of the quantized noise pool (None: a new propagator is built for every noisy element).
+		# With noise_tol, the number of bins is chosen such that the error of every noisy propagator is below noise_tol (see noise_error_bound)
+		self.noise_bins = noise_bins
+
+		## LRU cache (limited to cache_memory bytes) of the propagators of the quantized noise pool {(duration, bin): propagator}, see noise_pool
+		self.noise_pool_cache = Propagator_cache(max_bytes=cache_memory)
+		self.__pool_durations = set()
+		self.__H_norm = None
+		if noise_bins!=None or noise_tol!=None:
+			assert self.noise!=None, 'noise_bins and noise_tol require noise'
+			assert self.AC_function==None, 'the quantized noise pool is not available with an AC field (noisy propagators depend on time)'
+			durations = [element[1] for block in self.building_blocks for element in block[0] if element[2] is None]
+			if noise_tol!=None:
+				max_duration = max(durations) if len(durations)>0 else 0.0
+				self.noise_bins = max(1,int(np.ceil(self.H_norm_bound()*max_duration*self.noise/noise_tol)))
+			assert self.noise_bins>=1, 'noise_bins must be a positive integer'
+			# build the pool up front
+			self.__pool_durations = set(durations)
+			for duration in self.__pool_durations:
+				self.noise_pool(duration)
 
 
 		#print(self.building_blocks)
@@ -155,28 +264,7 @@ class NV_dynamics(NV_system):
 				dset = file.create_dataset(folder + '/' + data_name,data=data)
 
 				#store all relevant parameters as attributes
-				dset.attrs['system_size']=self.L
-				dset.attrs['seed_NV_system']=self.seed
-				dset.attrs['B_field_dir_NV_system']=self.B_field_dir
-				dset.attrs['rmin_NV_system']=self.min_dist
-				dset.attrs['rmax_NV_system']=self.max_dist
-				dset.attrs['scaling_factor_NV_system']=self.scaling_factor
-				if self.detuning!=None:
-					dset.attrs['detuning'] = self.detuning
-				else:
-					dset.attrs['detuning'] = 'None'
-				
-				dset.attrs['rabi_freq'] = self.rabi_freq
-				if self.noise!=None:
-					dset.attrs['noise'] = self.noise
-				else:
-					dset.attrs['noise'] = 'None'
-				
-				#extra parameters
-				if extra_save_parameters!=None:
-					keys=list(extra_save_parameters.keys())
-					for key in keys:
-						dset.attrs[key]=extra_save_parameters[key]
+				self.save_attributes(dset,extra_save_parameters)
 			print(' === data saved === ')
 
 			
@@ -191,31 +279,7 @@ class NV_dynamics(NV_system):
 				dset = file.create_dataset(folder + '/'+ data_name,data=data)
 				
 				#store all relevant parameters as attributes
-				#graph parameters
-				dset.attrs['system_size']=self.L
-				dset.attrs['seed_NV_system']=self.seed
-				dset.attrs['B_field_dir_NV_system']=self.B_field_dir
-				dset.attrs['rmin_NV_system']=self.min_dist
-				dset.attrs['rmax_NV_system']=self.max_dist
-				dset.attrs['scaling_factor_NV_system']=self.scaling_factor
-
-				#dynamic parameters
-				if self.detuning!=None:
-					dset.attrs['detuning'] = self.detuning
-				else:
-					dset.attrs['detuning'] = 'None'
-				
-				dset.attrs['rabi_freq'] = self.rabi_freq
-				if self.noise!=None:
-					dset.attrs['noise'] = self.noise
-				else:
-					dset.attrs['noise'] = 'None'
-			
-				#extra save parameters
-				if extra_save_parameters!=None:
-					keys=list(extra_save_parameters.keys())
-					for key in keys:
-						dset.attrs[key]=extra_save_parameters[key]
+				self.save_attributes(dset,extra_save_parameters)
 			print(' === data saved === ')
 		
 		elif not os.path.exists(save_dir + file_name + ".hdf5"):
@@ -227,44 +291,332 @@ class NV_dynamics(NV_system):
 				dset = file.create_dataset(folder + '/'+ data_name,data=data)
 
 				#store all relevant parameters as attributes
-				#graph parameters
-				dset.attrs['system_size']=self.L
-				dset.attrs['seed_NV_system']=self.seed
-				dset.attrs['B_field_dir_NV_system']=self.B_field_dir
-				dset.attrs['rmin_NV_system']=self.min_dist
-				dset.attrs['rmax_NV_system']=self.max_dist
-				dset.attrs['scaling_factor_NV_system']=self.scaling_factor
-
-				#dynamic parameters
-				if self.detuning!=None:
-					dset.attrs['detuning'] = self.detuning
-				else:
-					dset.attrs['detuning'] = 'None'
-				
-				dset.attrs['rabi_freq'] = self.rabi_freq
-				if self.noise!=None:
-					dset.attrs['noise'] = self.noise
-				else:
-					dset.attrs['noise'] = 'None'
-			
-				#extra save parameters
-				if extra_save_parameters!=None:
-					keys=list(extra_save_parameters.keys())
-					for key in keys:
-						dset.attrs[key]=extra_save_parameters[key]
+				self.save_attributes(dset,extra_save_parameters)
 			print(' === data saved === ')
 
 		return folder
 
 
+	def save_attributes(self,dset,extra_save_parameters=None):
+		"""! Stores all relevant parameters of the system and the drive as attributes of the data set dset"""
+
+		#graph parameters
+		self.save_system_attributes(dset)
+
+		#dynamic parameters
+		if self.detuning!=None:
+			dset.attrs['detuning'] = self.detuning
+		else:
+			dset.attrs['detuning'] = 'None'
+		
+		dset.attrs['rabi_freq'] = self.rabi_freq
+		dset.attrs['engine'] = self.engine
+		dset.attrs['precision'] = self.precision
+		if self.tol!=None:
+			dset.attrs['tol'] = self.tol
+		else:
+			dset.attrs['tol'] = 'None'
+		if self.profiler!=None:
+			self.profiler.save_attributes(dset)
+		if self.noise!=None:
+			dset.attrs['noise'] = self.noise
+		else:
+			dset.attrs['noise'] = 'None'
+		if self.noise_bins!=None:
+			dset.attrs['noise_bins'] = self.noise_bins
+			dset.attrs['noise_error_bound'] = self.noise_error_bound()
+		else:
+			dset.attrs['noise_bins'] = 'None'
+
+		#extra save parameters
+		if extra_save_parameters!=None:
+			keys=list(extra_save_parameters.keys())
+			for key in keys:
+				dset.attrs[key]=extra_save_parameters[key]
+
+
 	def save_data_tuple(self,data_tuple,file_name,save_dir,folder,sub_directories,
 					overwrite=False,extra_save_parameters=None):
-		for d, data in enumerate(data_tuple):
-			folder =self.save_data(data,file_name,save_dir,folder,sub_directories[d],
-					overwrite=overwrite,extra_save_parameters=extra_save_parameters)
+		with self.phase('save'):
+			for d, data in enumerate(data_tuple):
+				folder =self.save_data(data,file_name,save_dir,folder,sub_directories[d],
+						overwrite=overwrite,extra_save_parameters=extra_save_parameters)
 		return folder
 
 
+	@contextlib.contextmanager
+	def profiling(self):
+		"""! Context manager attaching profiler to the helper functions (to time the AC integrations, phase 'quad') """
+		previous = hlp.profiler
+		hlp.profiler = self.profiler
+		try:
+			yield
+		finally:
+			hlp.profiler = previous
+
+
+	def measure_function(self,observable):
+		"""! Returns a function measure(psi,out) that stores the expectation values of all observables (per spin) in out """
+		
+		# evaluate <psi|O|psi> directly with the sparse matrices of the observables (avoids the overhead of hamiltonian.expt_value)
+		matrices = [obs.tocsr().astype(self.dtype) for obs in observable]
+		L = self.L
+
+		def measure(psi,out):
+			if psi.ndim==1:
+				for j in range(len(matrices)):
+					out[j] = np.vdot(psi,matrices[j].dot(psi)).real/L
+			else:
+				# one state per column
+				for j in range(len(matrices)):
+					out[j] = np.einsum('ij,ij->j',psi.conj(),matrices[j].dot(psi)).real/L
+
+		return measure
+
+
+	def renormalize_step(self,psi,step):
+		"""! Renormalizes psi (in-place) if step is a multiple of renormalize_every """
+		if self.renormalize_every!=None and step % self.renormalize_every == 0:
+			hlp.renormalize(psi)
+		return psi
+
+
+	@classmethod
+	def planned(cls,nv_instance,rabi_freq,kick_building_blocks,n_steps,observable,driver='evolve_periodic',n_states=1,sequence=None,
+				memory_budget=None,**kwargs):
+		"""! NV_dynamics object with the fastest engine whose estimated peak memory for the given run fits into memory_budget (see Run_planner).
+			The chosen plan is stored in run_plan """
+
+		##
+		# @param nv_instance, rabi_freq, kick_building_blocks, kwargs inputs of NV_dynamics (except engine)
+		# @param n_steps, observable, driver, n_states, sequence specification of the run (see Run_planner.plan)
+		# @param memory_budget memory (in bytes) the run may use. Default is None, i.e. the currently available memory
+
+		assert 'engine' not in kwargs, 'the engine is chosen by the planner'
+		planner_inputs = ['detuning','AC_function','noise','noise_bins','cache_memory','async_measure','precision']
+		planner = Run_planner(nv_instance,rabi_freq,kick_building_blocks,memory_budget=memory_budget,
+								**{name: kwargs[name] for name in planner_inputs if name in kwargs})
+		engine = planner.engine(n_steps,observable,driver=driver,n_states=n_states,sequence=sequence)
+
+		nv_dynamics = cls(nv_instance,rabi_freq,kick_building_blocks,engine=engine,**kwargs)
+
+		## plan (see Run_planner.plan) of the run the object was built for (only set by planned)
+		nv_dynamics.run_plan = planner.plan(engine,n_steps,observable,driver=driver,n_states=n_states,sequence=sequence)
+		return nv_dynamics
+
+
+	def with_precision(self,precision):
+		"""! Returns a NV_dynamics object with the same system and drive in precision precision ('double' or 'single') """
+		settings = dict(self.__settings)
+		rabi_freq = settings.pop('rabi_freq')
+		kick_building_blocks = settings.pop('kick_building_blocks')
+		return NV_dynamics(self,rabi_freq,kick_building_blocks,precision=precision,**settings)
+
+
+	def precision_drift(self,method,*args,**kwargs):
+		"""! Runs the evolve_* method method (e.g. 'evolve_periodic') in single and in double precision and quantifies 
+			the deviation (drift) of the single precision observables from the double precision reference """
+
+		##
+		# Both runs are saved (in different folders of the data file, see save_data).
+		#
+		# @param method name of the evolve_* method
+		# @param args, kwargs input of the evolve_* method
+		#
+		# @return dict with 'times', 'deviation' (maximal absolute deviation of all observables and states at each time), 
+		# 'max_deviation', 'drift_rate' (slope of a linear fit of deviation over times) and the data of both runs ('single', 'double')
+
+		data_single, times = getattr(self.with_precision('single'),method)(*args,**kwargs)
+		data_double, _ = getattr(self.with_precision('double'),method)(*args,**kwargs)
+
+		deviation = np.abs(data_single-data_double)
+		deviation = deviation.max(axis=(0,)+tuple(range(2,deviation.ndim)))
+		drift_rate = np.polyfit(times,deviation,1)[0] if len(times)>1 else 0.0
+
+		return {'times':times,'deviation':deviation,'max_deviation':float(deviation.max()),'drift_rate':float(drift_rate),
+				'single':data_single,'double':data_double}
+
+
+	def measurement(self,observable):
+		"""! Returns the Async_measurement object used by the evolve_* methods (double buffered if async_measure is True) """
+		measure = self.measure_function(observable)
+		if self.profiler != None:
+			measure = self.profiler.timed(measure,'measure')
+		return Async_measurement(measure,double_buffered=self.async_measure)
+
+
+
+	def H_norm_bound(self):
+		"""! Upper bound (maximal absolute row sum) on the operator norm of the Hamiltonian of the 'dd' elements (H_dd plus detuning) """
+		if self.__H_norm==None:
+			H = self.H_dd
+			if self.detuning!=None:
+				detuning = self.detuning if type(self.detuning)==list else self.L*[self.detuning]
+				H = H + hlp.construct_Hamiltonian(self.basis,[['z',[[detuning[j],j] for j in range(self.L)]]]).tocsr()
+			self.__H_norm = float(np.abs(H).sum(axis=1).max())
+		return self.__H_norm
+
+
+	def noise_pool(self,time):
+		"""! Quantized noise pool: propagators of a noisy 'dd' element of duration time, one for the center of each of the noise_bins bins of the noise distribution.
+			Built once and kept in noise_pool_cache (see pooled_expH) """
+
+		##
+		# The uniform noise \f$ r \in [-1,1] \f$ is discretized into noise_bins bins of width 2/noise_bins. 
+		# A noisy element with random number r is applied with the propagator of the center of its bin (see noise_bin).
+		#
+		# @param time duration of the 'dd' element (without noise)
+		#
+		# @return list of propagators
+
+		return [self.pooled_expH(time,k) for k in range(self.noise_bins)]
+
+
+	def pooled_expH(self,time,k):
+		"""! Propagator of bin k of the quantized noise pool of a noisy 'dd' element of duration time (see noise_pool). 
+			Dense for the durations of the building blocks with engine 'dense', otherwise with time_dependent_engine """
+		expH = self.noise_pool_cache.get((time,k))
+		if expH is None:
+			center = -1.0 + (2.0*k+1.0)/self.noise_bins
+			with self.phase('build/noise_pool'):
+				expH = hlp.build_noisy_expH(self.L,self.basis,self.H_dd,self.rabi_freq,self.detuning,None,
+											0.0,time,self.noise,center,dtype=self.dtype,tol=self.tol,zero_copy=self.zero_copy)
+				if self.time_dependent_engine=='dense' or (self.engine=='dense' and time in self.__pool_durations):
+					expH = Dense_expH.from_expm(expH)
+			expH = self.noise_pool_cache.put((time,k),expH)
+		return expH
+
+
+	def noise_stream(self,seed):
+		"""! Noise_stream of the random numbers of the noisy elements (None without noise, nothing is drawn) """
+
+		##
+		# @param seed int or np.random.SeedSequence seeding a new stream, or a Noise_stream (e.g. spawned for a parallel worker, see Noise_stream.spawn)
+
+		if self.noise==None:
+			return None
+		if isinstance(seed,Noise_stream):
+			# a fresh copy: every run starts at the beginning of the stream
+			return Noise_stream(seed.seed_sequence,seed.chunk_size)
+		return Noise_stream(seed)
+
+
+	def noise_bin(self,random_num):
+		"""! Index of the bin of the quantized noise pool a random number in [-1,1] falls into """
+		return min(int((random_num+1.0)*0.5*self.noise_bins),self.noise_bins-1)
+
+
+	def noise_error_bound(self,time=None):
+		"""! Upper bound on the operator norm error of a single pooled noisy propagator: ||H|| * time * noise / noise_bins """
+
+		##
+		# Within a bin, the noisy duration deviates from the one of the bin center by at most time*noise/noise_bins.
+		# Since \f$ \| e^{-iHt_1} - e^{-iHt_2} \| \leq \|H\| |t_1-t_2| \f$, this bounds the error of each pooled propagator.
+		# The error of the final state is bounded by the sum of these errors over all noisy elements applied.
+		#
+		# @param time duration of the 'dd' element. Default is None, i.e. the longest noisy element of the building blocks
+		#
+		# @return error bound (0 if the noise pool is not used)
+
+		if self.noise_bins==None:
+			return 0.0
+		if time==None:
+			durations = [element[1] for block in self.building_blocks for element in block[0] if element[2] is None]
+			time = max(durations) if len(durations)>0 else 0.0
+		return self.H_norm_bound()*time*self.noise/self.noise_bins
+
+
+
+	def work_array(self,psi):
+		"""! Work array of the propagators applied to psi (see expm_multiply_parallel.dot) """
+		return np.zeros((2*psi.size,), dtype=psi.dtype) # twice as long because complex-valued
+
+
+	def execute_program(self,blocks_of_step,n_steps,psi,observable,data,times,random_num,
+							file_name,save_every,save_dir,folder,extra_save_parameters,message):
+		"""! Execution loop shared by all evolve_* methods. 
+			Applies the compiled blocks returned by blocks_of_step(step) for all steps and stores the observables in data and times"""
+
+		##
+		# @param blocks_of_step function returning the list of Compiled_block objects to be applied at a given step
+		# @param n_steps number of steps
+		# @param psi initial state (updated in-place)
+		# @param observable observables of interest. Must be list of QuSpin Hamiltonian objects.
+		# @param data preallocated array for the observables. data[:,0] is set to the initial values
+		# @param times preallocated array for the measurement times
+		# @param random_num random numbers for the noise (Noise_stream, None without noise)
+		# @param message message printed after every step, formatted with the step number
+		#
+		# @return data, times
+
+		work_array=self.work_array(psi)
+		measure = self.measurement(observable)
+		try:
+			with self.profiling():
+				return self.__execute(blocks_of_step,n_steps,psi,data,times,random_num,measure,work_array,
+										file_name,save_every,save_dir,folder,extra_save_parameters,message)
+		finally:
+			measure.close()
+			self.measurement_report = measure.report()
+
+
+	def __execute(self,blocks_of_step,n_steps,psi,data,times,random_num,measure,work_array,
+					file_name,save_every,save_dir,folder,extra_save_parameters,message):
+
+		#save data and check if the file already exists
+		folder = self.save_data_tuple((data,times),file_name,save_dir,folder,
+										('observables','times'),
+										overwrite=False,
+										extra_save_parameters=extra_save_parameters)
+
+		#compute initial expectation values of observables
+		measure(psi,data[:,0])
+
+		def noisy_expH(current_time,time,random_num):
+			if self.noise_bins!=None:
+				return self.pooled_expH(time,self.noise_bin(random_num))
+			return hlp.build_noisy_expH(self.L,self.basis,self.H_dd,self.rabi_freq,self.detuning,self.AC_function,
+										current_time,time,self.noise,random_num,dtype=self.dtype,tol=self.tol,zero_copy=self.zero_copy)
+
+		if self.profiler != None:
+			# time the construction and the application of noisy propagators
+			build_noisy_expH = self.profiler.timed(noisy_expH,'build/noisy')
+			def noisy_expH(current_time,time,random_num):
+				return SimpleNamespace(dot=self.profiler.timed(build_noisy_expH(current_time,time,random_num).dot,'apply/noisy'))
+
+		#loop through the individual blocks
+		current_time = 0.0
+		point = 0
+		rand_n_count = 0
+		for step in range(n_steps):
+
+			for block in blocks_of_step(step):
+				current_time, point, rand_n_count = block.execute(psi,work_array,current_time,point,data,times,measure,
+																	noisy_expH=noisy_expH,random_num=random_num,rand_n_count=rand_n_count)
+
+			self.renormalize_step(psi,step+1)
+			with self.phase('print'):
+				print(message.format(step+1))
+
+			#save data in hdf5 format
+			if step % save_every == 0 and n_steps != 0:
+				# existing data is overwritten/updated here
+				measure.flush()
+				folder = self.save_data_tuple((data,times),file_name,save_dir,folder,
+												('observables','times'),
+												overwrite=True,
+												extra_save_parameters=extra_save_parameters)
+
+		measure.flush()
+		folder = self.save_data_tuple((data,times),file_name,save_dir,folder,
+										('observables','times'),
+										overwrite=True,
+										extra_save_parameters=extra_save_parameters)
+
+		return data, times
+
+
+
 	def evolve_periodic(self,initial_state,n_steps,observable,
 						file_name,save_every=1000,save_dir='./data/',
 						folder='new_data_set',extra_save_parameters=None,seed=1):
@@ -278,6 +630,7 @@ class NV_dynamics(NV_system):
 		# initial_state[basis.index('1'*L)]=1
 		# ~~~~~~~~~~~~~
 		# correspoding to a pure \f$\hat{z}\f$-polarized initial state.
+		# A 2d array (one state per column) evolves a batch of states at once; data then has shape (observables, time points, states).
 		# 
 		# @param n_steps number of Floquet periods to evolve the initial state.
 		# @param observable observables of interest. Must be list of QuSpin Hamiltonian objects.
@@ -286,7 +639,7 @@ class NV_dynamics(NV_system):
 		# @param save_dir directory to save the data in. Default is './data/'.
 		# @param folder folder name of the data set within the file file_name to save the data (check .hdf5 format). Default is 'new_data_set'.
 		# @param extra_save_parameters dict of additional parameters to be save. For example {'description':'This is a description of the data'}
-		# @param seed seed used to generate noisy sequence in case noise is not None. Default is 1.
+		# @param seed seed used to generate noisy sequence in case noise is not None: int, np.random.SeedSequence or Noise_stream (see noise_stream). Default is 1.
 		#
 		# @return data
 		
@@ -303,93 +656,17 @@ class NV_dynamics(NV_system):
 
 		# compute the number of values to be stored
 		nr_of_data_points = sum(self.data_points())*n_steps
-		data = np.zeros((len(observable),nr_of_data_points+1))
+		data = np.zeros((len(observable),nr_of_data_points+1)+initial_state.shape[1:])
 		times = np.zeros(nr_of_data_points+1)
-		current_time = 0.0
-		time_point =0
 
 		# preallocate memory 
-		psi = initial_state.copy().astype(np.complex128)
-		work_array=np.zeros((2*len(psi),), dtype=psi.dtype) # twice as long because complex-valued
+		psi = initial_state.copy().astype(self.dtype)
 
-		#save data and check if the file already exists
-		folder = self.save_data_tuple((data,times),file_name,save_dir,folder,
-										('observables','times'),
-										overwrite=False,
-										extra_save_parameters=extra_save_parameters)
-		
-
-		#compute initial expectation values of observables
-		current_measurment_point=0
-		for j in range(len(observable)):
-			data[j,current_measurment_point] = observable[j].expt_value(psi).real/self.L 
+		#random numbers for the noise, drawn lazily
+		random_num = self.noise_stream(seed)
 
-		#pick random numbers for the noise
-		with temp_seed(seed):
-			random_num = np.random.uniform(-1,1,size=sum(self.data_points())*n_steps)
-
-
-		#loop through the individual blocks
-		rand_n_count = 0
-		for step in range(n_steps):
-			
-			for block in self.building_blocks:
-				#[[(),(),()],nr_of_reps]
-				nr_of_reps = block[1]
-
-				for n in range(nr_of_reps):
-					
-					for element in block[0]:
-						#element has three entries ('dd',time,expH or None)
-
-						#update time
-						time = element[1]
-						current_time += time
-
-						#check if some expm_multiply_parallel objects need to be build in the loop (due to noise)
-						if element[2]==None:
-
-							exp_H= hlp.build_noisy_expH(self.L,self.basis,
-														self.H_dd,self.rabi_freq,
-														self.detuning,
-														self.AC_function,
-														current_time,
-														time,
-														self.noise,
-														random_num[rand_n_count])
-							rand_n_count += 1
-						else:
-							exp_H = element[2]
-
-						exp_H.dot(psi,work_array=work_array,overwrite_v=True) 
-
-						# measure the observable whenever only the dipolar part ('dd') is applied 
-						if element[0]=='dd':
-							current_measurment_point +=1
-							for j in range(len(observable)):
-								data[j,current_measurment_point] = observable[j].expt_value(psi).real/self.L 
-							
-							#update time
-							time_point +=1
-							times[time_point]= current_time
-
-			print('finished Floquet cycle {0:d}'.format(step+1))
-			
-			#save data in hdf5 format
-			if step % save_every == 0 and n_steps != 0:
-				# existing data is overwritten/updated here
-				folder = self.save_data_tuple((data,times),file_name,save_dir,folder,
-												('observables','times'),
-												overwrite=True,
-												extra_save_parameters=extra_save_parameters)
-		
-		folder = self.save_data_tuple((data,times),file_name,save_dir,folder,
-										('observables','times'),
-										overwrite=True,
-										extra_save_parameters=extra_save_parameters)
-		
-		
-		return data, times
+		return self.execute_program(lambda step: self.program.blocks,n_steps,psi,observable,data,times,random_num,
+										file_name,save_every,save_dir,folder,extra_save_parameters,'finished Floquet cycle {0:d}')
 
 
 
@@ -407,6 +684,7 @@ class NV_dynamics(NV_system):
 		# initial_state[basis.index('1'*L)]=1
 		# ~~~~~~~~~~~~~
 		# correspoding to a pure \f$\hat{z}\f$-polarized initial state.
+		# A 2d array (one state per column) evolves a batch of states at once; data then has shape (observables, time points, states).
 		# 
 		# @param n_steps number of Floquet periods to evolve the initial state.
 		# @param observable observables of interest. Must be list of QuSpin Hamiltonian objects.
@@ -415,7 +693,7 @@ class NV_dynamics(NV_system):
 		# @param save_dir directory to save the data in. Default is './data/'.
 		# @param folder folder name of the data set within the file file_name to save the data (check .hdf5 format). Default is 'new_data_set'.
 		# @param extra_save_parameters dict of additional parameters to be save. For example {'description':'This is a description of the data'}
-		# @param seed seed used to generate noisy sequence in case noise is not None. Default is 1.
+		# @param seed seed used to generate noisy sequence in case noise is not None: int, np.random.SeedSequence or Noise_stream (see noise_stream). Default is 1.
 		# @param seed_random_seq seed used to generate the random sequence of blocks. Default is 2
 		# 
 		# @return data
@@ -429,100 +707,25 @@ class NV_dynamics(NV_system):
 		for obs in observable:
 			assert isinstance(obs,hamiltonian) , 'observable input not understood: must be of type quspin.operators.hamiltonian'
 
-		# preallocate memory to store the data
-
-		# compute the number of values to be stored
-		data = []
-		times = []
-		current_time = 0.0
-
-		psi = initial_state.copy().astype(np.complex128)
-		work_array=np.zeros((2*len(psi),), dtype=psi.dtype) # twice as long because complex-valued
-
-		#save data and check if the file already exists
-		folder = self.save_data_tuple((np.array(data),np.array(times)),file_name,save_dir,folder,
-										('observables','times'),
-										overwrite=False,
-										extra_save_parameters=extra_save_parameters)
-				
-		#compute initial expectation values of observables
-		obs_vals = []
-		for j in range(len(observable)):
-			obs_vals +=  [observable[j].expt_value(psi).real/self.L]
-		data += [obs_vals]
-		times += [0.0]
 		#pick random numbers from 0 to len(self.building_blocks)-1
 		with temp_seed(seed_random_seq):
 			ind_list = np.random.randint(low=0,high=len(self.building_blocks),size=n_steps)
 
-		#pick random numbers for the noise
-		with temp_seed(seed):
-			random_num = np.random.uniform(-1,1,size=sum(self.data_points())*n_steps)
+		# preallocate memory to store the data
 
-		#loop through the individual blocks
-		rand_n_count = 0
-		for step in range(n_steps):
+		# compute the number of values to be stored
+		nr_of_data_points = int(np.sum(self.program.data_points()[ind_list]))
+		data = np.zeros((len(observable),nr_of_data_points+1)+initial_state.shape[1:])
+		times = np.zeros(nr_of_data_points+1)
 
-			ind = ind_list[step]
-			block = self.building_blocks[ind] # has the following form[[(),(),()],nr_of_reps]
-		
-			nr_of_reps = block[1]
-			for n in range(nr_of_reps):
-					
-				for element in block[0]:
-					
-					#update time
-					time = element[1]
-					current_time += time
-
-					#check if some expm_multiply_parallel objects need to be build in the loop (due to noise)
-					if element[2]==None:
-						exp_H= hlp.build_noisy_expH(self.L,self.basis,
-													self.H_dd,
-													self.rabi_freq,
-													self.detuning,
-													self.AC_function,
-													current_time,
-													time,
-													self.noise,
-													random_num[rand_n_count])
-						rand_n_count += 1
-					else:
-						exp_H = element[2]
-
-					exp_H.dot(psi,work_array=work_array,overwrite_v=True) 
-					#print(element)
-
-					#measure the observable whenever only the dipolar part ('dd') is applied 
-					if element[0]=='dd':
-						obs_vals = []
-						for j in range(len(observable)):
-							obs_vals +=  [observable[j].expt_value(psi).real/self.L]
-						data += [obs_vals]
-						#update time
-						times += [current_time]
-			
-			print('finished cycle {0:d}'.format(step+1))
-			
-			#save data in hdf5 format
-			if step % save_every == 0 and n_steps != 0:
+		psi = initial_state.copy().astype(self.dtype)
+
+		#random numbers for the noise, drawn lazily
+		random_num = self.noise_stream(seed)
+
+		return self.execute_program(lambda step: [self.program.blocks[ind_list[step]]],n_steps,psi,observable,data,times,random_num,
+										file_name,save_every,save_dir,folder,extra_save_parameters,'finished cycle {0:d}')
 
-				# existing data is overwritten/updated here
-				folder = self.save_data_tuple((np.array(data).T,np.array(times)),file_name,save_dir,folder,
-										('observables','times'),
-										overwrite=True,
-										extra_save_parameters=extra_save_parameters)
-		
-		
-		folder = self.save_data_tuple((np.array(data).T,np.array(times)),file_name,save_dir,folder,
-										('observables','times'),
-										overwrite=True,
-										extra_save_parameters=extra_save_parameters)
-		
-		data = np.array(data).T
-		times = np.array(times)
-		
-		return data, times
 
 
 	def evolve_sequential(self,initial_state,n_steps,observable,sequence,
@@ -538,6 +741,7 @@ class NV_dynamics(NV_system):
 		# initial_state[basis.index('1'*L)]=1
 		# ~~~~~~~~~~~~~
 		# correspoding to a pure \f$\hat{z}\f$-polarized initial state.
+		# A 2d array (one state per column) evolves a batch of states at once; data then has shape (observables, time points, states).
 		# 
 		# @param n_steps number of Floquet periods to evolve the initial state.
 		# @param observable observables of interest. Must be list of QuSpin Hamiltonian objects.
@@ -547,7 +751,7 @@ class NV_dynamics(NV_system):
 		# @param save_dir directory to save the data in. Default is './data/'.
 		# @param folder folder name of the data set within the file file_name to save the data (check .hdf5 format). Default is 'new_data_set'.
 		# @param extra_save_parameters dict of additional parameters to be save. For example {'description':'This is a description of the data'}
-		# @param seed seed used to generate noisy sequence in case noise is not None. Default is 1.
+		# @param seed seed used to generate noisy sequence in case noise is not None: int, np.random.SeedSequence or Noise_stream (see noise_stream). Default is 1.
 		# 
 		# @return data
 
@@ -566,103 +770,162 @@ class NV_dynamics(NV_system):
 		# preallocate memory to store the data
 
 		# compute the number of values to be stored
-		data = []
-		times = []
-		current_time = 0.0
+		nr_of_data_points = int(np.sum(self.program.data_points()[np.array(sequence[:n_steps],dtype=np.int64)]))
+		data = np.zeros((len(observable),nr_of_data_points+1)+initial_state.shape[1:])
+		times = np.zeros(nr_of_data_points+1)
 
+		psi = initial_state.copy().astype(self.dtype)
 
-		psi = initial_state.copy().astype(np.complex128)
-		work_array=np.zeros((2*len(psi),), dtype=psi.dtype) # twice as long because complex-valued
+		#random numbers for the noise, drawn lazily
+		random_num = self.noise_stream(seed)
 
-		#save data and check if the file already exists
-		folder = self.save_data_tuple((np.array(data),np.array(times)),file_name,save_dir,folder,
-										('observables','times'),
-										overwrite=False,
-										extra_save_parameters=extra_save_parameters)
-				
+		return self.execute_program(lambda step: [self.program.blocks[sequence[step]]],n_steps,psi,observable,data,times,random_num,
+										file_name,save_every,save_dir,folder,extra_save_parameters,'finished cycle {0:d}')
 
-		#compute initial expectation values of observables
-		obs_vals = []
-		for j in range(len(observable)):
-			obs_vals +=  [observable[j].expt_value(psi).real/self.L]
-		data += [obs_vals]
-		times += [0.0]
-		#pick random numbers for the noise
-		with temp_seed(seed):
-			random_num = np.random.uniform(-1,1,size=sum(self.data_points())*n_steps)
 
-		#loop through the individual blocks
-		rand_n_count = 0
-		for step in range(n_steps):
 
-			#pick a the number from 0 to len(self.building_blocks)-1
-			
-			ind = sequence[step]
-			block = self.building_blocks[ind] # has the following form[[(),(),()],nr_of_reps]
-		
-			nr_of_reps = block[1]
-			for n in range(nr_of_reps):
-					
-				for element in block[0]:
-					
-					#update time
-					time = element[1]
-					current_time += time
-
-					#check if some expm_multiply_parallel objects need to be build in the loop (due to noise)
-					if element[2]==None:
-
-						exp_H= hlp.build_noisy_expH(self.L,self.basis,
-													self.H_dd,
-													self.rabi_freq,
-													self.detuning,
-													self.AC_function,
-													current_time,
-													time,
-													self.noise,
-													random_num[rand_n_count])
-						rand_n_count += 1
-					else:
-						exp_H = element[2]
-
-					exp_H.dot(psi,work_array=work_array,overwrite_v=True) 
-
-					#measure the observable whenever only the dipolar part ('dd') is applied 
-					if element[0]=='dd':
-						obs_vals = []
-						for j in range(len(observable)):
-							obs_vals +=  [observable[j].expt_value(psi).real/self.L]
-						data += [obs_vals]
-						#update time
-						times += [current_time]
-			
-			print('finished cycle {0:d}'.format(step+1))
-			
-			#save data in hdf5 format
-			if step % save_every == 0 and n_steps != 0:
-				# existing data is overwritten/updated here
-				folder = self.save_data_tuple((np.array(data).T,np.array(times)),file_name,save_dir,folder,
+	def multipole_propagators(self,n_multipole,dense=None):
+		"""! Returns the (cached) propagators of the n-multipoles (U_n^+, U_n^-) built from the blocks 0 (+) and 1 (-)"""
+
+		##
+		# The multipoles are defined recursively: U_0^\f$\pm\f$ are the blocks 0 and 1, and \f$ U_n^\pm = U_{n-1}^\mp U_{n-1}^\pm \f$,
+		# i.e. \f$ U_1^+ \f$ applies block 0 followed by block 1 (a dipole).
+		#
+		# @param n_multipole order of the multipoles
+		# @param dense if True, the multipoles are dense unitaries (one matrix-vector product per application).
+		# If False, the 2^n blocks of a multipole are fused into a single compiled sequence. Default is None, i.e. dense if engine is 'dense'
+		#
+		# @return propagators (with the dot interface of expm_multiply_parallel) and durations of U_n^+ and U_n^-
+
+		if dense==None:
+			dense = self.engine=='dense'
+
+		key = (n_multipole,dense)
+		if key not in self.__multipoles:
+			durations = [self.program.blocks[0].duration,self.program.blocks[1].duration]
+			if dense:
+				U = [self.program.block_unitary(0),self.program.block_unitary(1)]
+				for n in range(n_multipole):
+					U = [U[1].dot(U[0]),U[0].dot(U[1])]
+				propagators = [Dense_expH(U[0]),Dense_expH(U[1])]
+			else:
+				words = [[0],[1]]
+				for n in range(n_multipole):
+					words = [words[0]+words[1],words[1]+words[0]]
+				propagators = []
+				for word in words:
+					elements = []
+					for b in word:
+						elements += self.building_blocks[b][0]*self.building_blocks[b][1]
+					propagators += [Compiled_block([elements,1],self.program)]
+			if n_multipole>0:
+				durations = 2*[2**(n_multipole-1)*(durations[0]+durations[1])]
+			self.__multipoles[key] = (propagators,durations)
+
+		return self.__multipoles[key]
+
+
+
+	def evolve_random_multipolar(self,initial_state,n_steps,observable,n_multipole,
+						file_name,save_every=1000,save_dir='./data/',
+						folder='new_data_set',extra_save_parameters=None,
+						seed_random_seq=2,dense=None):
+
+		"""! Method for random multipolar evolution: at each step a randomly chosen n-multipole U_n^+ or U_n^- is applied (see multipole_propagators)"""
+
+		##
+		# @param initial_state initial state of the system (see evolve_periodic)
+		# @param n_steps number of random multipoles to apply.
+		# @param observable observables of interest. Must be list of QuSpin Hamiltonian objects. Evaluated after every multipole.
+		# @param n_multipole order of the multipoles. n_multipole=0 is a random sequence of blocks 0 and 1
+		# @param save_every data is automatically save after save_every many steps. Default is 1000.
+		# @param file_name filename (without ending) to save the data.
+		# @param save_dir directory to save the data in. Default is './data/'.
+		# @param folder folder name of the data set within the file file_name to save the data (check .hdf5 format). Default is 'new_data_set'.
+		# @param extra_save_parameters dict of additional parameters to be save. For example {'description':'This is a description of the data'}
+		# @param seed_random_seq seed used to generate the random sequence of multipoles. Default is 2
+		# @param dense see multipole_propagators. Default is None
+		#
+		# @return data, times
+
+		assert self.noise==None, 'random multipolar drives are not available with noise'
+		assert len(self.building_blocks)>=2, 'random multipolar drives need (at least) two building blocks'
+
+		if not os.path.exists(save_dir):
+			os.mkdir(save_dir)
+
+		assert isinstance(observable,list), 'observables should be input as list of quspin.operators.hamiltonian objects'
+
+		for obs in observable:
+			assert isinstance(obs,hamiltonian) , 'observable input not understood: must be of type quspin.operators.hamiltonian'
+
+		save_parameters = {'n_multipole':n_multipole,'seed_random_seq':seed_random_seq}
+		if extra_save_parameters!=None:
+			save_parameters.update(extra_save_parameters)
+
+		with self.phase('build/multipoles'):
+			propagators, durations = self.multipole_propagators(n_multipole,dense=dense)
+
+		#pick the random sequence of multipoles: 0 ~ U_n^+, 1 ~ U_n^-
+		with temp_seed(seed_random_seq):
+			signs = np.random.randint(low=0,high=2,size=n_steps)
+
+		data = np.zeros((len(observable),n_steps+1)+initial_state.shape[1:])
+		times = np.zeros(n_steps+1)
+
+		psi = initial_state.copy().astype(self.dtype)
+		work_array = np.zeros((2*psi.size,), dtype=psi.dtype)
+
+		folder = self.save_data_tuple((data,times),file_name,save_dir,folder,
 										('observables','times'),
-										overwrite=True,
-										extra_save_parameters=extra_save_parameters)
-		
-		
-		folder = self.save_data_tuple((np.array(data).T,np.array(times)),file_name,save_dir,folder,
+										overwrite=False,
+										extra_save_parameters=save_parameters)
+
+		measure = self.measurement(observable)
+		try:
+			measure(psi,data[:,0])
+
+			dots = [propagators[0].dot,propagators[1].dot]
+			if self.profiler != None:
+				dots = [self.profiler.timed(dots[0],'apply/multipole +'),self.profiler.timed(dots[1],'apply/multipole -')]
+			for step in range(n_steps):
+				sign = signs[step]
+				dots[sign](psi,work_array,True)
+				self.renormalize_step(psi,step+1)
+				measure(psi,data[:,step+1])
+				times[step+1] = times[step] + durations[sign]
+
+				with self.phase('print'):
+					print('finished cycle {0:d}'.format(step+1))
+
+				#save data in hdf5 format
+				if step % save_every == 0 and n_steps != 0:
+					# existing data is overwritten/updated here
+					measure.flush()
+					folder = self.save_data_tuple((data,times),file_name,save_dir,folder,
+													('observables','times'),
+													overwrite=True,
+													extra_save_parameters=save_parameters)
+
+			measure.flush()
+		finally:
+			measure.close()
+			self.measurement_report = measure.report()
+
+		folder = self.save_data_tuple((data,times),file_name,save_dir,folder,
 										('observables','times'),
 										overwrite=True,
-										extra_save_parameters=extra_save_parameters)
-				
-		data = np.array(data).T
-		times = np.array(times)
-		
+										extra_save_parameters=save_parameters)
+
 		return data, times
 
 
+
 	def evolve_time_dependent(self,initial_state,n_steps,observable,
 						discrete_functions,
 						file_name,save_every=1000,save_dir='./data/',
 						folder='new_data_set',extra_save_parameters=None,
-						seed=1,seed_random_seq=2):
+						seed=1,seed_random_seq=2,look_ahead=2,n_workers=1):
 		
 		"""! Method for time dependent evolution based on blocks"""
 
@@ -673,6 +936,7 @@ class NV_dynamics(NV_system):
 		# initial_state[basis.index('1'*L)]=1
 		# ~~~~~~~~~~~~~
 		# correspoding to a pure \f$\hat{z}\f$-polarized initial state.
+		# A 2d array (one state per column) evolves a batch of states at once; data then has shape (observables, time points, states).
 		# 
 		# @param n_steps number of Floquet periods to evolve the initial state.
 		# @param observable observables of interest. Must be list of QuSpin Hamiltonian objects.
@@ -684,7 +948,10 @@ class NV_dynamics(NV_system):
 		# @param save_dir directory to save the data in. Default is './data/'.
 		# @param folder folder name of the data set within the file file_name to save the data (check .hdf5 format). Default is 'new_data_set'.
 		# @param extra_save_parameters dict of additional parameters to be save. For example {'description':'This is a description of the data'}
-		# @param seed seed used to generate noisy sequence in case noise is not None. Default is 1.
+		# @param seed seed used to generate noisy sequence in case noise is not None: int, np.random.SeedSequence or Noise_stream (see noise_stream). Default is 1.
+		# @param look_ahead number of steps whose blocks are built (on n_workers threads) while the current step is propagated, see Block_pipeline.
+		# 0 builds the blocks of each step just before it is applied. Blocks with durations seen before are always reused. Default is 2.
+		# @param n_workers number of threads building blocks. Default is 1.
 		# 
 		# @return data
 
@@ -704,143 +971,232 @@ class NV_dynamics(NV_system):
 
 		# compute the number of values to be stored
 		nr_of_data_points = sum(self.data_points())*n_steps
-		data = np.zeros((len(observable),nr_of_data_points+1))
+		data = np.zeros((len(observable),nr_of_data_points+1)+initial_state.shape[1:])
 		times = np.zeros(nr_of_data_points+1)
-		current_time = 0.0
-		time_point =0
 
 		# preallocate memory 
-		psi = initial_state.copy().astype(np.complex128)
-		work_array=np.zeros((2*len(psi),), dtype=psi.dtype) # twice as long because complex-valued
+		psi = initial_state.copy().astype(self.dtype)
 
-		#save data and check if the file already exists
-		folder = self.save_data_tuple((data,times),file_name,save_dir,folder,
-										('observables','times'),
-										overwrite=False,
-										extra_save_parameters=extra_save_parameters)
-		
+		#random numbers for the noise, drawn lazily
+		random_num = self.noise_stream(seed)
 
-		#compute initial expectation values of observables
-		current_measurment_point=0
-		for j in range(len(observable)):
-			data[j,current_measurment_point] = observable[j].expt_value(psi).real/self.L 
+		pipeline = Block_pipeline(self,discrete_functions,n_steps,look_ahead=look_ahead,n_workers=n_workers)
+		try:
+			return self.execute_program(pipeline,n_steps,psi,observable,data,times,random_num,
+											file_name,save_every,save_dir,folder,extra_save_parameters,'finished Floquet cycle {0:d}')
+		finally:
+			pipeline.close()
 
-		#pick random numbers for the noise
-		with temp_seed(seed):
-			random_num = np.random.uniform(-1,1,size=sum(self.data_points())*n_steps)
 
 
-		#loop through the individual blocks
-		rand_n_count = 0
+	def time_dependent_durations(self,b,step,discrete_functions):
+		"""! Durations of the elements of block b at a given step of evolve_time_dependent (None if the block is not time dependent)"""
 
-		for step in range(n_steps):
-			
-			# update the building blocks
-			blocks = []
-			# modify blocks 
-			for b in range(len(self.building_blocks)):
-				original_block = self.building_blocks[b]
-				#[[(),(),..],n]		
-				sequence = []
-				function_input = discrete_functions[b]
-				if function_input != None:
-					if len(function_input)>1:
-						function = function_input[0]
-						params = tuple(function_input[1:])
-						for e, element in enumerate(self.building_blocks[b][0]):
-							time = function(original_block[0][e][1],step,*params)
-							sequence += [(element[0],time,element[2])]
-
-					else:
-						function = function_input[0]
-						for e,element in enumerate(self.building_blocks[b][0]):
-							time = function(original_block[0][e][1],step)
-							sequence += [(element[0],time,element[2])]
-
-					current_block = [sequence,self.building_blocks[b][1]]
-
-					# compute updates
-					current_block = hlp.update_building_blocks(current_block,self.L,
-																	self.basis,self.H_dd,
-																	self.rabi_freq,self.detuning,
-																	self.AC_function,self.noise)	
-					#print(building_blocks)
-					#print('update block with index {0:d}'.format(b))
-					blocks += [current_block]
-				else:
-					current_block = self.building_blocks[b]
-					blocks += [current_block]
-					continue
-				
+		function_input = discrete_functions[b]
+		if function_input == None:
+			return None
 
-			for block in blocks:
-				#[[(),(),()],nr_of_reps]
-				
-				nr_of_reps = block[1]
-
-				for n in range(nr_of_reps):
-					
-					for element in block[0]:
-						#element has three entries ('dd',time,expH or None)
-
-						#update time
-						time = element[1]
-						current_time += time
-
-						#check if some expm_multiply_parallel objects need to be build in the loop (due to noise)
-						if element[2]==None:
-
-							exp_H= hlp.build_noisy_expH(self.L,self.basis,
-														self.H_dd,self.rabi_freq,
-														self.detuning,
-														self.AC_function,
-														current_time,
-														time,
-														self.noise,
-														random_num[rand_n_count])
-							rand_n_count += 1
-						else:
-							exp_H = element[2]
-
-						exp_H.dot(psi,work_array=work_array,overwrite_v=True) 
-
-						# measure the observable whenever only the dipolar part ('dd') is applied 
-						if element[0]=='dd':
-							current_measurment_point +=1
-							for j in range(len(observable)):
-								data[j,current_measurment_point] = observable[j].expt_value(psi).real/self.L 
-							
-							#update time
-							time_point +=1
-							times[time_point]= current_time
-
-			print('finished Floquet cycle {0:d}'.format(step+1))
-			
-			#save data in hdf5 format
-			if step % save_every == 0 and n_steps != 0:
-				# existing data is overwritten/updated here
-				folder = self.save_data_tuple((data,times),file_name,save_dir,folder,
-												('observables','times'),
-												overwrite=True,
-												extra_save_parameters=extra_save_parameters)
-			
+		function = function_input[0]
+		params = tuple(function_input[1:])
+		return tuple(function(element[1],step,*params) for element in self.building_blocks[b][0])
 
-		
-		folder = self.save_data_tuple((data,times),file_name,save_dir,folder,
-										('observables','times'),
-										overwrite=True,
-										extra_save_parameters=extra_save_parameters)
-		
-		
-		return data, times
 
 
+	def time_dependent_block(self,b,durations):
+		"""! Compiled block b with the element durations durations (see time_dependent_durations)"""
+
+		original_block = self.building_blocks[b]
+		sequence = [(element[0],durations[e],element[2]) for e,element in enumerate(original_block[0])]
+		current_block = [sequence,original_block[1]]
+
+		# compute updates
+		with self.phase('build/time_dependent'):
+			current_block = hlp.update_building_blocks(current_block,self.L,
+															self.basis,self.H_dd,
+															self.rabi_freq,self.detuning,
+															self.AC_function,self.noise,
+															cache=self.time_dependent_cache,dtype=self.dtype,tol=self.tol,zero_copy=self.zero_copy)
+			block = Program([current_block],dense=self.time_dependent_engine=='dense').blocks[0]
+		if self.profiler != None:
+			block.profile(self.profiler,'apply/block {0:d}'.format(b))
+		return block
+
+
+
+	def time_dependent_blocks(self,step,discrete_functions,memo=None):
+		"""! Returns the compiled blocks of evolve_time_dependent at a given step"""
+
+		##
+		# @param step evolution time step
+		# @param discrete_functions see evolve_time_dependent
+		# @param memo optional dict {(b,durations): Compiled_block} of blocks built before. New blocks are added to it
+		#
+		# @return list of Compiled_block objects
+
+		blocks = []
+		for b in range(len(self.building_blocks)):
+			durations = self.time_dependent_durations(b,step,discrete_functions)
+			if durations == None:
+				blocks += [self.program.blocks[b]]
+			elif memo == None:
+				blocks += [self.time_dependent_block(b,durations)]
+			else:
+				if (b,durations) not in memo:
+					memo[(b,durations)] = self.time_dependent_block(b,durations)
+				blocks += [memo[(b,durations)]]
+
+		return blocks
+
+
+
+class Block_pipeline():
+	"""! Producer/consumer pipeline for evolve_time_dependent: the blocks of the next look_ahead steps are built on a thread pool
+		while the current step is propagated. The durations depend on the step only (never on the state), so they are known ahead of time.
+		Blocks are shared by the scheduled steps with the same durations and released after the last of them (their element propagators
+		stay in the time_dependent_cache of NV_dynamics) """
+
+	def __init__(self,nv_dynamics,discrete_functions,n_steps,look_ahead=2,n_workers=1):
+
+		##
+		# @param nv_dynamics NV_dynamics object
+		# @param discrete_functions see NV_dynamics.evolve_time_dependent
+		# @param n_steps number of steps
+		# @param look_ahead number of steps built ahead of the current one. 0 builds the blocks of each step when needed (no threads)
+		# @param n_workers number of worker threads
+
+		self.nv_dynamics = nv_dynamics
+		self.discrete_functions = discrete_functions
+		self.n_steps = n_steps
+		self.look_ahead = look_ahead
+
+		## memo of the (future) blocks of the scheduled steps {(b,durations): Future}
+		self.memo = {}
+
+		## number of blocks taken from the memo instead of being built
+		self.reused = 0
+
+		self.__pending = {}
+		self.__last_use = {}
+		self.__next = 0
+		self.__pool = ThreadPoolExecutor(max_workers=n_workers) if look_ahead>0 else None
+
+
+	def __submit(self,step):
+		entries = []
+		for b in range(len(self.nv_dynamics.building_blocks)):
+			durations = self.nv_dynamics.time_dependent_durations(b,step,self.discrete_functions)
+			if durations == None:
+				entries += [self.nv_dynamics.program.blocks[b]]
+				continue
+			key = (b,durations)
+			if key in self.memo:
+				self.reused += 1
+			elif self.__pool == None:
+				self.memo[key] = self.nv_dynamics.time_dependent_block(b,durations)
+			else:
+				self.memo[key] = self.__pool.submit(self.nv_dynamics.time_dependent_block,b,durations)
+			entries += [self.memo[key]]
+			self.__last_use[key] = step
+		self.__pending[step] = entries
+
+
+	def __call__(self,step):
+		"""! Compiled blocks of step (blocks_of_step of NV_dynamics.execute_program). Schedules the steps up to step+look_ahead """
+
+		while self.__next <= min(step+self.look_ahead,self.n_steps-1):
+			self.__submit(self.__next)
+			self.__next += 1
+		entries = self.__pending.pop(step)
+		# release the blocks no scheduled step refers to anymore
+		for key in [key for key, last in self.__last_use.items() if last <= step]:
+			del self.memo[key], self.__last_use[key]
+		return [entry.result() if isinstance(entry,Future) else entry for entry in entries]
+
+
+	def close(self):
+		"""! Shuts down the worker threads """
+		if self.__pool != None:
+			self.__pool.shutdown(wait=True,cancel_futures=True)
+
+
+
+class Async_measurement():
+	"""! Measurement function measure(psi,out) of the evolve_* methods with an optional double buffered mode:
+		the state is copied into one of two spare buffers and the observables are evaluated on a worker thread
+		while the main thread already applies the next propagators """
+
+	def __init__(self,measure,double_buffered=True):
+
+		##
+		# @param measure function measure(psi,out) storing all observables of psi in out (see NV_dynamics.measure_function)
+		# @param double_buffered if False, measure is called directly (synchronous). Default is True
+
+		self.measure = measure
+		self.double_buffered = double_buffered
+
+		## number of measurements
+		self.n_measurements = 0
+
+		## time spent evaluating observables
+		self.measure_time = 0.0
+
+		## time the main thread spent waiting for the worker thread (double buffered mode only)
+		self.wait_time = 0.0
+
+		self.__buffers = None
+		self.__next = 0
+		self.__future = None
+		self.__pool = ThreadPoolExecutor(max_workers=1) if double_buffered else None
+
+
+	def __timed(self,psi,out):
+		t = perf_counter()
+		self.measure(psi,out)
+		self.measure_time += perf_counter()-t
+
+
+	def __call__(self,psi,out):
+		self.n_measurements += 1
+		if self.__pool == None:
+			self.__timed(psi,out)
+			return
+
+		if self.__buffers == None or self.__buffers[0].shape != psi.shape:
+			self.flush()
+			self.__buffers = [np.empty_like(psi),np.empty_like(psi)]
+		# the worker may still read the other buffer
+		buffer = self.__buffers[self.__next]
+		self.__next = 1-self.__next
+		buffer[...] = psi
+		self.flush()
+		self.__future = self.__pool.submit(self.__timed,buffer,out)
+
+
+	def flush(self):
+		"""! Waits until all submitted measurements are stored """
+		if self.__future != None:
+			t = perf_counter()
+			self.__future.result()
+			self.wait_time += perf_counter()-t
+			self.__future = None
+
+
+	def close(self):
+		"""! Waits for the last measurement and shuts down the worker thread """
+		self.flush()
+		if self.__pool != None:
+			self.__pool.shutdown(wait=True)
 
-		# evolve
 
-		# repeat
+	def report(self):
+		"""! Timing report: number of measurements, measure_time, wait_time and overlap,
+			the fraction of the measurement time hidden behind the propagation (1 - wait_time/measure_time) """
+		overlap = 0.0
+		if self.double_buffered and self.measure_time>0:
+			overlap = max(0.0,1.0-self.wait_time/self.measure_time)
+		return {'double_buffered':self.double_buffered,'n_measurements':self.n_measurements,
+				'measure_time':self.measure_time,'wait_time':self.wait_time,'overlap':overlap}
 
-		return 0
 
 
 @contextlib.contextmanager
@@ -8,11 +8,14 @@ import time
 import scipy.integrate as integrate
 import contextlib
 import h5py
+import copy
 
 #from helper_funcs import *
 
 
 from QNV4py import Helper_funcs
+from QNV4py import Profiler
+from QNV4py.shared import Shared_csr
 
 hlp = Helper_funcs()
 
@@ -53,14 +56,42 @@ hlp = Helper_funcs()
 # and NV_dynamics to evolve in time with user defined sequence. To setup a working code, first you have to 
 # construct a NV_system object. Then, use it to build a NV_dynamics object. NV_system can be used with default parameter settings
 # (for example  <code> C13_object = NV_system.default(L) </code>), which builds the random graph with
-# default settings. An NV_dynamics object requires the following input: 
+# default settings. For large clusters, weak couplings can be dropped from the dipolar Hamiltonian with <code> coupling_cutoff </code>
+# (relative to the largest coupling) or <code> distance_cutoff </code>. This makes <code> H_dd </code> (and all propagators built from it) sparser;
+# the resulting error can be checked with <code> cutoff_report() </code>.
+# <code> H_dd </code> is stored as the sum of its components <code> H_int + scaling_factor*H_z </code> (real float64 matrices: H_dd is real symmetric in the \f$ \sigma^z \f$ basis). To scan <code> scaling_factor </code> 
+# (or a uniform static detuning) use <code> C13_object.rescaled(scaling_factor=0.3) </code>, which returns a view of the same graph without rebuilding it.
+# <code> spectrum() </code> diagonalizes <code> H_dd </code> sector by sector of fixed total magnetization; single sectors (<code> sector=n_up </code>) 
+# and partial spectra (<code> k=10 </code>, optionally around a target energy <code> sigma </code>) are available as well. Results are memoized and can be cached on disk with <code> cache_dir </code>.
+# An NV_dynamics object requires the following input:
 # 	- <code> nv_instance </code>, a NV_system object
 # 	- <code> rabi_freq </code>, the amplitude of the kicks
 # 	- <code> kick_building_blocks </code>, the elementary building blocks of the drive, for instance
 # 	- <code> detuning=None </code>, Detuning (left over single particle field in the rotating frame, Default None)
 # 	- <code> AC_function=None </code>, a (continous) AC field given as an arbitrary function, Default None
-# 	- <code> noise=None </code>, some noise to increase ergodicity, Default None
+# 	- <code> noise=None </code>, some noise to increase ergodicity, Default None. The random numbers are drawn lazily in chunks (see Noise_stream) from the <code> seed </code>
+# 	  of the evolve_* methods (an int, a <code> np.random.SeedSequence </code> or a Noise_stream, e.g. one of <code> Noise_stream(seed).spawn(n_workers) </code> for parallel runs)
+# 	- <code> engine='auto' </code>, how the building blocks are applied: 'krylov' (sparse, expm_multiply_parallel) or 'dense' (precomputed dense unitaries,
+# 	  all elements between two measurements multiplied into a single unitary). 'auto' uses 'dense' for L <= 10 (except for the blocks rebuilt at every step of evolve_time_dependent). Default 'auto'
+# 	- <code> noise_bins=None </code> or <code> noise_tol=None </code>, approximate noise: the noise distribution is discretized into <code> noise_bins </code> bins 
+# 	  (or as many bins as needed for an error below <code> noise_tol </code> per noisy propagator) whose propagators are built once; 
+# 	  the noisy elements then only index their bin. The error bound is available from <code> noise_error_bound() </code>. Default None (exact noise)
+# 	- <code> async_measure=False </code>, if True the observables are evaluated on a worker thread (on a copy of the state) while the next propagators are applied. 
+# 	  The achieved overlap is reported in <code> measurement_report </code> after each run. Default False
+# 	- <code> precision='double' </code>, 'single' runs <code> H_dd </code>, the propagators and the states in complex64 (half the memory and bandwidth). 
+# 	  The states are then renormalized every <code> renormalize_every </code> (default 100) steps. 
+# 	  <code> precision_drift('evolve_periodic',...) </code> runs a drive in both precisions and quantifies the deviation of the single precision observables. Default 'double'
+# 	- <code> tol=None </code>, tolerance of all propagators of the drive (inherited from the NV_system object, whose own <code> tol </code> is used for the energy scale and initial states). 
+# 	  <code> Helper_funcs.tol </code> sets a global default for all propagators of the package. Default None (machine precision)
+# 	- <code> profile=False </code>, if True the wall time and number of calls of each phase (propagator construction, application per block and element, 
+# 	  observables, AC integrations, saving, printing) are accumulated in <code> profiler </code> (see Profiler, <code> print(c13_dynamics.profiler) </code>) 
+# 	  and stored as attributes of the saved data sets. <code> NV_system(...,profile=True) </code> profiles the construction of the graph. Default False
 # 
+# Before a long run, <code> Run_planner(C13_object,rabi_freq,kick_building_blocks,noise=...).best(n_steps,observables) </code> estimates the peak memory 
+# (H_dd, propagators, dense unitaries, states, data and noise arrays) and the run time (from calibrated micro-benchmarks, see <code> Run_planner.calibrate() </code>) 
+# of each engine; <code> NV_dynamics.planned(C13_object,rabi_freq,kick_building_blocks,n_steps,observables,memory_budget=...) </code> builds the NV_dynamics object 
+# with the fastest engine that fits into the memory budget (default: the available memory). <code> spectrum_bytes() </code> estimates the memory of <code> spectrum() </code>.
+#
 # <code> kick_building_blocks </code> as well as AC_function have to be provided in a special list format: <code>  [block1, block2, ...] </code>, 
 # where each block is a list itself. For instance  <code> block1 = [[('dd',0.2),('x',0.1)],50] </code>. 
 # 	 <code> block2 = [[('z',1.0)],1] </code>. The first elememt of this list is a list of tuples defining the sequence. 
@@ -85,11 +116,50 @@ hlp = Helper_funcs()
 # - <code> evolve_sequential(initial_state,n_steps,observable,sequence,file_name,save_every=1000,save_dir='./data/',folder='new_data_set',extra_save_parameters=None,seed=1) </code> 
 # 			Can be used to drive the initial state with s specific <code> sequence </code>. At each step the sequence element specifies which block out of <code> kick_building_blocks </code> is to be applied.
 # 			(see Example code for sequential drive)
-# - <code> evolve_time_dependent(initial_state,n_steps,observable,discrete_functions,file_name,save_every=1000,save_dir='./data/',folder='new_data_set',extra_save_parameters=None,seed=1,seed_random_seq=2) </code> 
+# - <code> evolve_time_dependent(initial_state,n_steps,observable,discrete_functions,file_name,save_every=1000,save_dir='./data/',folder='new_data_set',extra_save_parameters=None,seed=1,seed_random_seq=2,look_ahead=2,n_workers=1) </code> 
 # 			Evolves the system with time dependent <code> kick_building_blocks </code>. <code> discrete_functions </code> is used to specify the time dependence of each block in <code> kick_building_blocks </code>.
 # 			<code> discrete_functions </code> is provided in list for (similar to <code> AC_function </code>), for instance <code> discrete_functions =[None,[func,some_param]]</code>. 
 # 			The latter input attributes no time dependence to the first block in <code> kick_building_blocks </code> but adds some time dependence given by a the function <code> func(n,some_param) </code> 
 # 			where the function input n specifies the evolution time step. (see Example code for a time dependent drive)
+# 			The blocks of the next <code> look_ahead </code> steps are built on <code> n_workers </code> threads while the current step is propagated; blocks whose durations were seen before are reused.
+#
+# - <code> Quasi_periodic_drive(c13_dynamics,kind='fibonacci').evolve(initial_state,n_generations,observable,file_name) </code> 
+# 			drives the initial state with the Fibonacci (or Thue-Morse, <code> kind='thue_morse' </code>) word of blocks 0 and 1 and evaluates the observables 
+# 			after the words of each generation. For small L the word unitaries are composed recursively, reaching exponentially long times.
+# - <code> evolve_random_multipolar(initial_state,n_steps,observable,n_multipole,file_name,save_every=1000,save_dir='./data/',folder='new_data_set',extra_save_parameters=None,seed_random_seq=2) </code> 
+# 			applies a random sequence of n-multipoles \f$ U_n^\pm = U_{n-1}^\mp U_{n-1}^\pm \f$ built from blocks 0 (+) and 1 (-) and evaluates the observables after every multipole.
+# 			The two multipole propagators are built once (dense unitaries for small L, a fused block sequence otherwise).
+#
+# - <code> Parameter_sweep(C13_object,grid,kick_building_blocks=...,**fixed_inputs).run(initial_state,n_steps,observable,file_name,driver='evolve_periodic',n_workers=1) </code> 
+# 			runs an evolve_* method on all combinations of the values in <code> grid </code> (e.g. <code> {'rabi_freq':[...],'noise':[None,0.05]} </code>; the axes are 
+# 			'rabi_freq', 'detuning', 'noise' and 'kick_building_blocks'). The system is built once, propagators of elements with coinciding parameters are shared among the points 
+# 			(see the input <code> propagator_cache </code> of NV_dynamics), points are distributed over <code> n_workers </code> processes and all results are stored in a single 
+# 			HDF5 group with the grid axes first (the values of the axes are stored in <code> grid/&lt;axis&gt; </code>).
+#
+# For several evolutions of the same graph in separate processes, <code> C13_object.share(path=None) </code> moves the CSR arrays of H_dd (and of its components) 
+# into a <code> multiprocessing.shared_memory </code> segment (or memory-mapped files in the directory <code> path </code>, see Shared_csr). Pickled systems carry a handle only, 
+# i.e. all workers read the same physical copy of H_dd, and the 'dd' propagators of NV_dynamics (without detuning and AC field) reference H_dd instead of storing a scaled copy.
+#
+# System sizes whose state vector does not fit into memory (L=28-30) are evolved out of core: <code> NV_system(...,energy_scale=J,matrix_free=True) </code> skips the basis and H_dd, 
+# <code> Out_of_core_dynamics(C13_object,rabi_freq,kick_building_blocks,trotter_step=0.01,chunk_size=2**20,path=local_disk) </code> keeps the state in a <code> np.memmap </code> file 
+# (see Chunked_state) and streams it in chunks: kicks are exact products of single spin rotations (pairs of chunks differing in one bit), the 'dd' elements are 
+# Trotterized into diagonal phases (local to the chunks) and flip-flop gates. <code> initial_state(direction) </code>, <code> evolve_periodic </code> and <code> evolve_sequential </code> 
+# mirror NV_dynamics with observables given as directions, e.g. <code> ['x','z'] </code>.
+# <code> MPI_dynamics(C13_object,rabi_freq,kick_building_blocks,...) </code> distributes the state over MPI processes (the top index bits are the rank, see Distributed_state)
+# with the same propagators and drivers. Run the same script on all processes, e.g. <code> mpirun -n 4 python script.py </code> (requires mpi4py).
+#
+# Hundreds of spins (a matrix free NV_system) are treated with a cluster-correlation expansion: <code> Cluster_expansion(C13_object,rabi_freq,kick_building_blocks,max_order=3,coupling_threshold=0.1) </code>
+# enumerates the clusters of up to <code> max_order </code> spins connected by strong couplings, evolves each of them exactly (<code> C13_object.subsystem(cluster) </code>, optionally on
+# <code> n_workers </code> processes) and sums the cluster correlations into the magnetization. <code> convergence_report() </code> lists the contributions order by order and cluster by cluster.
+# For qualitative semiclassical dynamics, <code> DTWA_dynamics(C13_object,rabi_freq,kick_building_blocks,time_step=0.01,n_trajectories=1000) </code> samples the initial product state
+# with the discrete truncated Wigner approximation (see Wigner_ensemble) and evolves all trajectories at once: kicks are exact rotations, 'dd' elements follow the
+# mean-field equations of H_dd. It accepts the drives of NV_dynamics and returns the data of <code> evolve_periodic </code> and <code> evolve_sequential </code> in the same format.
+#
+# Moderately large systems with bounded entanglement can be evolved as matrix product states with <code> MPS_dynamics(C13_object,rabi_freq,kick_building_blocks,chi_max=64,order='rcm') </code>.
+# The couplings of H_dd are compressed into an MPO (SVD of the couplings crossing each bond), 'dd' elements are evolved with two-site TDVP and kicks are exact single site gates.
+# The data of <code> evolve_periodic </code> and <code> evolve_sequential </code> has the usual format, the bond dimension and the truncation error of every measurement
+# are stored in <code> bond_dimensions </code> and <code> truncation_errors </code> and saved next to the observables.
+# For small L, <code> exact_deviation('x',n_steps,observables,file_name) </code> checks the TDVP evolution against the exact <code> evolve_periodic </code> for decreasing time steps.
 #
 # Any of the above functions evaluates the given observables whenever only the dipolar Hamiltonian is applied.
 # The results (measurement times and observable values) are stored in HDF5 data format in a file <code> save_dir + file_name </code>. 
@@ -111,7 +181,8 @@ class NV_system():
 	"""! Sets up a random graph of L spins where each spin has a min_dist to all other spins
 		and is at least connected to one other spin at no further than max_dist """
 	
-	def __init__(self,B_field_dir,L,min_dist,max_dist,seed,scaling_factor=0.1):
+	def __init__(self,B_field_dir,L,min_dist,max_dist,seed,scaling_factor=0.1,coupling_cutoff=None,distance_cutoff=None,tol=None,profile=False,
+					energy_scale=None,matrix_free=False):
 
         ## Basic constructor. 
         #
@@ -121,6 +192,14 @@ class NV_system():
         # @param max_dist maximum nearest neighbor distance between \f$ C^{13} \f$ spins
         # @param scaling_factor parameter to scale the importance of single particle terms due to the field generated from the NV center. Default is 0.1
         # @param L system size
+        # @param coupling_cutoff drop pair couplings with \f$ |J_{ij}| \f$ below coupling_cutoff times the largest coupling. Default is None (keep all couplings)
+        # @param distance_cutoff drop pair couplings between spins further apart than distance_cutoff. Default is None (keep all couplings)
+        # @param tol tolerance of the propagators used to estimate the energy scale and to prepare initial states (see Helper_funcs.set_tol). 
+        # 		Inherited by NV_dynamics objects. Default is None (global Helper_funcs.tol)
+        # @param profile if True, the wall time of the construction phases is accumulated in profiler (see Profiler). Default is False
+        # @param energy_scale if given, used as energy scale instead of the estimate from the free induction decay. Default is None
+        # @param matrix_free if True, neither the QuSpin basis nor H_dd (and its components) are built, the system only provides its couplings 
+        # 		(see dd_terms) for out-of-core evolutions of large L (see Out_of_core_dynamics). Requires energy_scale. Default is False
         # @param spin_positions Positions of spins on the random graph
         # @param basis QuSpin basis object 
         # @param energy_scale energy scale J of random graph of \$ C^{13} \f$ spins (without single particle terms! Those are normalized with J and scaled with scaling_factor).
@@ -128,7 +207,19 @@ class NV_system():
         # @param H_dd dipolar Hamiltonian corresponding to the random graph (including single particle terms)
 
 
-		interactions_x_y, interactions_z, spin_positions, couplings = hlp.sampling_points(B_field_dir,min_dist,max_dist,L,seed)
+		## Profiler with the wall time of the construction phases (None if profile is False)
+		self.profiler = Profiler() if profile else None
+
+		with self.phase('NV_system/sampling'):
+			interactions_x_y, interactions_z, spin_positions, couplings = hlp.sampling_points(B_field_dir,min_dist,max_dist,L,seed)
+
+			# keep the full set of couplings to be able to quantify the error of a truncation (see cutoff_report)
+			self.__full_interactions = [['xx',interactions_x_y],['yy',interactions_x_y],['zz',interactions_z]]
+			self.__discarded_couplings = []
+			if coupling_cutoff != None or distance_cutoff != None:
+				interactions_x_y, interactions_z, couplings, self.__discarded_couplings = hlp.truncate_couplings(spin_positions,
+																	interactions_x_y,interactions_z,couplings,
+																	coupling_cutoff=coupling_cutoff,distance_cutoff=distance_cutoff)
 
 		self.__name = '{} nuclear spins randomly placed around a NV center'.format(L)
 
@@ -149,6 +240,15 @@ class NV_system():
 		## scaling_factor parameter to scale the importance of single particle terms due to the field generated from the NV center, default is 1.0
 		self.scaling_factor = scaling_factor
 
+		## relative coupling threshold below which pair couplings are dropped (None if all couplings are kept)
+		self.coupling_cutoff = coupling_cutoff
+
+		## distance beyond which pair couplings are dropped (None if all couplings are kept)
+		self.distance_cutoff = distance_cutoff
+
+		## tolerance of the propagators (None: global Helper_funcs.tol)
+		self.tol = tol
+
 		self.__interactions_x_y = interactions_x_y
 		self.__interactions_z = interactions_z
 		self.__couplings = couplings
@@ -160,29 +260,67 @@ class NV_system():
 		self.spin_positions = spin_positions
 		
 
+		## uniform static detuning added to H_dd (see rescaled). Default is None
+		self.static_detuning = None
+		self.__S_z = None
+		self.__sectors = None
+		self.__spectra = {}
+		self.__shared = {}
+		self.__pair_table = None
+
+		## True if the basis and H_dd are not built (see dd_terms)
+		self.matrix_free = matrix_free
+		if matrix_free:
+			assert energy_scale != None, 'matrix free systems require the energy_scale'
+			self.energy_scale = energy_scale
+			self.__z_field = hlp.compute_single_particle_fields(self.spin_positions,self.energy_scale,B_field_dir,scaling_factor=self.scaling_factor)
+			self.basis = None
+			self.H_int = None
+			self.H_z = None
+			self.H_dd = None
+			return
+
 		# dipolar Hamiltonian and energy scale
 		
 		## QuSpin basis object 
 		self.basis = spin_basis_1d(L=self.L,pauli=True)
 		interactions = [['xx',self.__interactions_x_y],['yy',self.__interactions_x_y],['zz',self.__interactions_z]]
-		H_dd = hlp.construct_Hamiltonian(self.basis,interactions)
+		with self.phase('NV_system/hamiltonian'):
+			H_dd = hlp.construct_Hamiltonian(self.basis,interactions)
 		
 		#estimate relevant energy scales (without disordered single particle fields)
 		
 		##energy scale J of random graph of \f$C^{13}\f$ spins (without single particle terms! Those are normalized with J and scaled with scaling_factor).
-        # Computed from the free induction decay of an initially \f$ \hat{x} \f$-polarized (pure) state.
-		self.energy_scale = hlp.estimate_scales(self.basis,self.L,H_dd,delta_t=0.0005,time_steps=1000)
+        # Computed from the free induction decay of an initially \f$ \hat{x} \f$-polarized (pure) state (unless given).
+		if energy_scale != None:
+			self.energy_scale = energy_scale
+		else:
+			with self.phase('NV_system/estimate_scales'):
+				# from all couplings: the time unit and the fields must not depend on the cutoff (see cutoff_report)
+				H_scale = H_dd
+				if coupling_cutoff != None or distance_cutoff != None:
+					H_scale = hlp.construct_Hamiltonian(self.basis,self.__full_interactions)
+				self.energy_scale = hlp.estimate_scales(self.basis,self.L,H_scale,delta_t=0.0005,time_steps=1000,tol=self.tol)
 
 		#rescale interactions in units of the energy_scale
 
+		# H_dd is real symmetric in the sigma^z basis: its components are stored as real (float64) matrices
 
-		#add disordered single particle fields normalized by the energy_scale
-		self.__z_field = hlp.compute_single_particle_fields(self.spin_positions,self.energy_scale,B_field_dir,scaling_factor=self.scaling_factor)
-		
-		#build the dipolar Hamiltonian and rescale in units of the energy_scale
+		with self.phase('NV_system/hamiltonian'):
+			## interaction part of H_dd in units of the energy_scale
+			self.H_int = hlp.to_real(H_dd.tocsr())/self.energy_scale
+
+			#add disordered single particle fields normalized by the energy_scale
+			self.__z_field = hlp.compute_single_particle_fields(self.spin_positions,self.energy_scale,B_field_dir,scaling_factor=self.scaling_factor)
+			
+			## single particle fields generated by the NV center for scaling_factor=1 in units of the energy_scale
+			self.H_z = hlp.to_real(hlp.construct_Hamiltonian(self.basis,
+					[['z',hlp.compute_single_particle_fields(self.spin_positions,self.energy_scale,B_field_dir,scaling_factor=1)]]).tocsr())/self.energy_scale
+
+		#build the dipolar Hamiltonian as linear combination of its (cached) components
 
 		## dipolar Hamiltonian corresponding to the random graph (including single particle terms)
-		self.H_dd = hlp.construct_Hamiltonian(self.basis,interactions + [['z',self.__z_field]]).tocsr()/self.energy_scale
+		self.H_dd = self.H_int + self.scaling_factor*self.H_z
 	
 
 	@classmethod	
@@ -207,6 +345,202 @@ class NV_system():
 
 
 
+	def rescaled(self,scaling_factor=None,static_detuning=None):
+		"""! Returns a view of the system with a different scaling_factor and/or a uniform static detuning.
+			The graph, the energy scale and the components H_int, H_z are shared with the original system,
+			only H_dd is recombined (one sparse addition instead of a full rebuild)"""
+		##
+		# @param scaling_factor new scaling_factor of the single particle fields. Default is None (keep the current value)
+		# @param static_detuning uniform field \f$ \delta\sum_j \sigma^z_j \f$ (in units of the energy_scale) added to H_dd. Default is None (no detuning)
+		#
+		# @return NV_system object
+
+		if scaling_factor == None:
+			scaling_factor = self.scaling_factor
+
+		view = copy.copy(self)
+		view.scaling_factor = scaling_factor
+		view.static_detuning = static_detuning
+		view.__z_field = hlp.compute_single_particle_fields(self.spin_positions,self.energy_scale,self.B_field_dir,scaling_factor=scaling_factor)
+		view.__spectra = {}
+		if self.matrix_free:
+			return view
+		view.H_dd = self.H_int + scaling_factor*self.H_z
+
+		if static_detuning != None:
+			view.H_dd = view.H_dd + static_detuning*self.total_magnetization()
+
+		return view
+
+
+
+	def dd_terms(self):
+		"""! Terms of H_dd in units of the energy_scale: \f$ H_{dd} = \sum_{k} J^{xy}_k (\sigma^x_i\sigma^x_j + \sigma^y_i\sigma^y_j) + J^{z}_k \sigma^z_i\sigma^z_j + \sum_j h_j \sigma^z_j \f$
+			with pairs k = (i,j). Available for matrix free systems as well """
+		##
+		# @return pairs (int array of shape (n,2)), J_xy, J_z (arrays of length n), h (array of length L, including the static_detuning)
+
+		pairs = np.array([[i,j] for _, i, j in self.__interactions_z],dtype=np.int64).reshape(-1,2)
+		J_xy = np.array([coupling for coupling, _, _ in self.__interactions_x_y],dtype=np.float64)/self.energy_scale
+		J_z = np.array([coupling for coupling, _, _ in self.__interactions_z],dtype=np.float64)/self.energy_scale
+		h = np.zeros(self.L)
+		for field, j in self.__z_field:
+			h[j] += field/self.energy_scale
+		if self.static_detuning != None:
+			h += self.static_detuning
+		return pairs, J_xy, J_z, h
+
+
+
+	def subsystem(self,sites):
+		"""! Returns the system of the spins sites (e.g. a cluster, see Cluster_expansion) with the couplings among them. The energy scale and the
+			single particle fields of the spins are the ones of this system, the basis and H_dd are built for len(sites) spins (this system can be matrix free) """
+		##
+		# @param sites list of sites of this system. Site sites[n] is site n of the subsystem
+		#
+		# @return NV_system object
+
+		sites = np.array(sites,dtype=np.int64)
+		index = -np.ones(self.L,dtype=np.int64)
+		index[sites] = np.arange(len(sites))
+
+		# pairs, xy and zz couplings as arrays and the single particle fields for scaling_factor=1 (computed once, shared with the views of this system)
+		if self.__pair_table is None:
+			pairs = np.array([[i,j] for _, i, j in self.__interactions_z],dtype=np.int64).reshape(-1,2)
+			fields = hlp.compute_single_particle_fields(self.spin_positions,self.energy_scale,self.B_field_dir,scaling_factor=1)
+			self.__pair_table = (pairs,np.array([coupling for coupling, _, _ in self.__interactions_x_y]),
+									np.array([coupling for coupling, _, _ in self.__interactions_z]),np.array([field for field, _ in fields]))
+		pairs, couplings_x_y, couplings_z, fields = self.__pair_table
+		inside = np.all(index[pairs]>=0,axis=1)
+		local_pairs = index[pairs[inside]].tolist()
+
+		view = copy.copy(self)
+		view.L = len(sites)
+		view.spin_positions = self.spin_positions[sites]
+		view.profiler = None
+		view.matrix_free = False
+		view.__interactions_x_y = [[coupling,i,j] for coupling, (i,j) in zip(couplings_x_y[inside].tolist(),local_pairs)]
+		view.__interactions_z = [[coupling,i,j] for coupling, (i,j) in zip(couplings_z[inside].tolist(),local_pairs)]
+		view.__couplings = (couplings_z[inside]/2).tolist()
+		view.__full_interactions = [['xx',view.__interactions_x_y],['yy',view.__interactions_x_y],['zz',view.__interactions_z]]
+		view.__discarded_couplings = []
+		view.__z_field = [[self.__z_field[site][0],n] for n, site in enumerate(sites.tolist())]
+		view.__name = '{} nuclear spins of a system of {}'.format(view.L,self.L)
+		view.__S_z = None
+		view.__sectors = None
+		view.__spectra = {}
+		view.__shared = {}
+		view.__pair_table = None
+
+		view.basis = spin_basis_1d(L=view.L,pauli=True)
+		view.H_int = hlp.to_real(hlp.construct_Hamiltonian(view.basis,view.__full_interactions).tocsr())/self.energy_scale
+		view.H_z = hlp.to_real(hlp.construct_Hamiltonian(view.basis,[['z',[[field,n] for n, field in enumerate(fields[sites].tolist())]]]).tocsr())/self.energy_scale
+		view.H_dd = view.H_int + self.scaling_factor*view.H_z
+		if self.static_detuning != None:
+			view.H_dd = view.H_dd + self.static_detuning*view.total_magnetization()
+		return view
+
+
+
+	def share(self,path=None):
+		"""! Moves H_int, H_z and H_dd into shared memory (see Shared_csr). Worker processes receiving the (pickled) system attach to the same arrays
+			and NV_dynamics builds the 'dd' propagators as zero-copy views of the shared H_dd """
+		##
+		# @param path directory of memory-mapped files with a subdirectory per matrix (e.g. on a local disk: a system pickled to a file then refers to them).
+		# Default is None, i.e. multiprocessing.shared_memory segments (freed by unshare() or with this system)
+		#
+		# @return self
+
+		# the dict is shared with views of this system (see rescaled)
+		self.__shared = dict(self.__shared)
+		for name in ['H_int','H_z','H_dd']:
+			if not self.is_shared(name):
+				shared = Shared_csr(getattr(self,name),None if path == None else os.path.join(path,name))
+				matrix = shared.tocsr()
+				setattr(self,name,matrix)
+				self.__shared[name] = (shared,matrix)
+		return self
+
+
+
+	def is_shared(self,name):
+		"""! True if the matrix name ('H_int', 'H_z' or 'H_dd') of this system lives in shared memory (see share) """
+		return name in self.__shared and getattr(self,name) is self.__shared[name][1]
+
+
+
+	def unshare(self):
+		"""! Copies the shared matrices back into private memory and frees the shared arrays (only in the process which called share).
+			Views of this system (see rescaled) still using shared components must not be used afterwards """
+		for name, (shared, matrix) in self.__shared.items():
+			if getattr(self,name) is matrix:
+				setattr(self,name,matrix.copy())
+			shared.unlink()
+		self.__shared = {}
+
+
+
+	def __getstate__(self):
+		# shared matrices are pickled as handles (see share)
+		state = self.__dict__.copy()
+		shared_state = {}
+		for name, (shared, matrix) in self.__shared.items():
+			if state[name] is matrix:
+				state[name] = shared
+				shared_state[name] = shared
+		state['_NV_system__shared'] = shared_state
+		return state
+
+
+
+	def __setstate__(self,state):
+		shared_state = state['_NV_system__shared']
+		for name, shared in shared_state.items():
+			state[name] = shared.tocsr()
+			shared_state[name] = (shared,state[name])
+		self.__dict__.update(state)
+
+
+
+	def phase(self,name):
+		"""! Context manager accumulating the wall time of the enclosed code as phase name in profiler (does nothing if profiling is disabled) """
+		if self.profiler == None:
+			return contextlib.nullcontext()
+		return self.profiler.phase(name)
+
+
+
+	def save_system_attributes(self,dset):
+		"""! Stores the parameters of the graph as attributes of the data set dset (see NV_dynamics.save_attributes)"""
+		dset.attrs['system_size']=self.L
+		dset.attrs['seed_NV_system']=self.seed
+		dset.attrs['B_field_dir_NV_system']=self.B_field_dir
+		dset.attrs['rmin_NV_system']=self.min_dist
+		dset.attrs['rmax_NV_system']=self.max_dist
+		dset.attrs['scaling_factor_NV_system']=self.scaling_factor
+		if self.static_detuning!=None:
+			dset.attrs['static_detuning_NV_system'] = self.static_detuning
+		else:
+			dset.attrs['static_detuning_NV_system'] = 'None'
+		if self.coupling_cutoff!=None:
+			dset.attrs['coupling_cutoff_NV_system'] = self.coupling_cutoff
+		else:
+			dset.attrs['coupling_cutoff_NV_system'] = 'None'
+		if self.distance_cutoff!=None:
+			dset.attrs['distance_cutoff_NV_system'] = self.distance_cutoff
+		else:
+			dset.attrs['distance_cutoff_NV_system'] = 'None'
+
+
+
+	def total_magnetization(self):
+		"""! Returns \f$ \sum_j \sigma^z_j \f$ as (cached) sparse matrix"""
+		if self.__S_z is None:
+			self.__S_z = hlp.to_real(hlp.construct_Hamiltonian(self.basis,[['z',[[1.0,j] for j in range(self.L)]]]).tocsr())
+		return self.__S_z
+
+
+
 	def __str__(self):
 		"""! Print function """
 		print('\nSampled spin postions are:\n\n')
@@ -247,7 +581,7 @@ class NV_system():
 			# rotate around x by -pi/2			
 			work_array=np.zeros((2*len(initial_state),), dtype=initial_state.dtype)
 			Ox=hamiltonian([['x',[[1.0,j] for j in range(self.L)] ],],[],basis=self.basis,dtype=np.complex128,check_symm=False,check_herm=False)	
-			rotation = expm_multiply_parallel(Ox.tocsr(),a=1j*np.pi*0.25)
+			rotation = hlp.set_tol(expm_multiply_parallel(Ox.tocsr(),a=1j*np.pi*0.25),self.tol)
 			rotation.dot(initial_state,work_array=work_array,overwrite_v=True)
 			return initial_state
 
@@ -255,7 +589,7 @@ class NV_system():
 			#rotate around y by pi/2
 			work_array=np.zeros((2*len(initial_state),), dtype=initial_state .dtype)
 			Oy=hamiltonian([['y',[[1.0,j] for j in range(self.L)] ],],[],basis=self.basis,dtype=np.complex128,check_symm=False,check_herm=False)	
-			rotation = expm_multiply_parallel(Oy.tocsr(),a=-1j*np.pi*0.25)
+			rotation = hlp.set_tol(expm_multiply_parallel(Oy.tocsr(),a=-1j*np.pi*0.25),self.tol)
 			rotation.dot(initial_state,work_array=work_array,overwrite_v=True)
 			return initial_state
 
@@ -282,11 +616,127 @@ class NV_system():
 		return observables
 
 
-	def spectrum(self):
+	def spectrum(self,sector=None,k=None,sigma=None,which='SA',cache_dir=None):
 		"""! Computes the spectrum of H_dd"""
-		## @return eigenvalues and eigenvectors of H_dd
-		e,v =np.linalg.eigh(self.H_dd.toarray())
+		##
+		# H_dd conserves the total magnetization \f$ \sum_j \sigma^z_j \f$. The spectrum is therefore computed block by block 
+		# in the sectors of fixed number of up spins (see sector_indices) instead of diagonalizing the full dense matrix.
+		# Results are memoized and optionally cached on disk.
+		#
+		# @param sector number of up spins of the magnetization sector to diagonalize. If None, the full spectrum is computed
+		# (eigenvectors are then given in the full basis). Default is None
+		# @param k number of eigenpairs to compute with scipy.sparse.linalg.eigsh. If None, all eigenpairs are computed. Default is None
+		# @param sigma target energy for shift-invert mode of eigsh (only used if k is not None). Default is None
+		# @param which which eigenpairs to compute with eigsh: 'SA' (smallest), 'LA' (largest), 'SM' or 'LM' (smallest or largest magnitude). Default is 'SA'
+		# @param cache_dir directory to cache the result in (.npz). Default is None (memory only)
+		#
+		# @return eigenvalues and eigenvectors of H_dd (or of its block in sector)
+
+		key = (sector,k,sigma,which)
+		if cache_dir == None and key in self.__spectra:
+			return self.__spectra[key]
+
+		if cache_dir != None:
+			if not os.path.exists(cache_dir):
+				os.mkdir(cache_dir)
+			cache_file = os.path.join(cache_dir,'spectrum_L{0:d}_{1}.npz'.format(self.L,hlp.spectrum_cache_key(self.H_dd,key)))
+			if os.path.exists(cache_file):
+				if key not in self.__spectra:
+					with np.load(cache_file) as cached:
+						self.__spectra[key] = (cached['e'],cached['v'])
+				return self.__spectra[key]
+			elif key in self.__spectra:
+				np.savez(cache_file,e=self.__spectra[key][0],v=self.__spectra[key][1])
+				return self.__spectra[key]
+
+		if sector == None and not hlp.conserves_magnetization(self.H_dd,self.basis,self.L):
+			# fall back to the full matrix
+			e, v = hlp.diagonalize(self.H_dd,k=k,sigma=sigma,which=which)
+
+		elif sector == None:
+			if k == None:
+				e = np.zeros(self.basis.Ns)
+				v = np.zeros((self.basis.Ns,self.basis.Ns),dtype=self.H_dd.dtype)
+				pos = 0
+				for n_up in range(self.L+1):
+					ind = self.sector_indices(n_up)
+					e_sector, v_sector = hlp.diagonalize(self.H_dd[ind][:,ind])
+					e[pos:pos+len(ind)] = e_sector
+					v[ind,pos:pos+len(ind)] = v_sector
+					pos += len(ind)
+				order = np.argsort(e,kind='stable')
+				e, v = e[order], v[:,order]
+			else:
+				# the extremal (or sigma-closest) k eigenpairs of H_dd are among the k eigenpairs of each sector
+				e = []
+				v = []
+				for n_up in range(self.L+1):
+					ind = self.sector_indices(n_up)
+					e_sector, v_sector = hlp.diagonalize(self.H_dd[ind][:,ind],k=k,sigma=sigma,which=which)
+					v_full = np.zeros((self.basis.Ns,len(e_sector)),dtype=v_sector.dtype)
+					v_full[ind] = v_sector
+					e += [e_sector]
+					v += [v_full]
+				e = np.concatenate(e)
+				v = np.concatenate(v,axis=1)
+				order = hlp.eigenpair_selection(e,k,sigma,which)
+				e, v = e[order], v[:,order]
+
+		else:
+			ind = self.sector_indices(sector)
+			e, v = hlp.diagonalize(self.H_dd[ind][:,ind],k=k,sigma=sigma,which=which)
+
+		self.__spectra[key] = (e,v)
+
+		if cache_dir != None:
+			np.savez(cache_file,e=e,v=v)
+
 		return e, v
 
 
 
+	def sector_indices(self,n_up):
+		"""! Returns the indices of all basis states with n_up up spins"""
+		if self.__sectors is None:
+			self.__sectors = hlp.magnetization_sectors(self.basis,self.L)
+		return np.nonzero(self.__sectors==n_up)[0]
+
+
+
+
+
+	def cutoff_report(self,delta_t=0.01,time_steps=200):
+		"""! Quantifies the error made by dropping couplings (see coupling_cutoff and distance_cutoff)"""
+		##
+		# Compares the free induction decay of an initially \f$ \hat{x} \f$-polarized state under the truncated H_dd
+		# with the one under the full dipolar Hamiltonian (both including single particle terms).
+		#
+		# @param delta_t time step of the free induction decay in units of 1/energy_scale. Default is 0.01
+		# @param time_steps number of time steps of the free induction decay. Default is 200
+		#
+		# @return dict with the number of kept/discarded couplings, the norm of the discarded couplings (absolute and relative to all couplings),
+		# an upper bound on the operator norm of the discarded part of H_dd, and the free induction decays under the full and the truncated Hamiltonian
+
+		discarded = np.array(self.__discarded_couplings)
+		kept = np.array(self.__couplings)
+		full_norm = np.sqrt(np.sum(discarded**2) + np.sum(kept**2))
+
+		report = {}
+		report['nr_of_couplings'] = len(kept)
+		report['nr_of_discarded_couplings'] = len(discarded)
+		report['discarded_norm'] = np.sqrt(np.sum(discarded**2))
+		report['relative_discarded_norm'] = report['discarded_norm']/full_norm if full_norm>0 else 0.0
+		# each discarded pair contributes -J(xx+yy)+2J zz, i.e. at most 4|J| in operator norm
+		report['operator_norm_bound'] = 4*np.sum(np.abs(discarded))/self.energy_scale
+
+		H_full = hlp.construct_Hamiltonian(self.basis,self.__full_interactions + [['z',self.__z_field]]).tocsr()/self.energy_scale
+		if self.static_detuning != None:
+			# same uniform detuning as H_dd (see rescaled)
+			H_full = H_full + self.static_detuning*self.total_magnetization()
+
+		report['fid_times'] = delta_t*np.arange(time_steps+1)
+		report['fid_full'] = hlp.free_induction_decay(self.basis,self.L,H_full,delta_t=delta_t,time_steps=time_steps)[0]
+		report['fid_truncated'] = hlp.free_induction_decay(self.basis,self.L,self.H_dd,delta_t=delta_t,time_steps=time_steps)[0]
+		report['fid_max_deviation'] = np.max(np.abs(report['fid_full']-report['fid_truncated']))
+
+		return report
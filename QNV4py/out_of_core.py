@@ -0,0 +1,558 @@
+import os, tempfile, weakref
+import numpy as np
+from scipy.linalg import expm
+from QNV4py import Helper_funcs
+from QNV4py import Profiler
+from QNV4py.nv_dynamics import NV_dynamics
+from QNV4py.program import Program
+
+hlp = Helper_funcs()
+
+
+##
+# @file out_of_core.py Contains the classes Chunked_state, Kick_propagator, Trotter_propagator and Out_of_core_dynamics
+#
+
+
+## Pauli matrices in the basis (up, down) of a single spin
+PAULI = {'x':np.array([[0,1],[1,0]],dtype=np.complex128),
+		 'y':np.array([[0,-1j],[1j,0]],dtype=np.complex128),
+		 'z':np.array([[1,0],[0,-1]],dtype=np.complex128)}
+
+
+
+def popcount(x,bits):
+	"""! Number of set bits among the lowest bits bits of the integers x """
+	count = np.zeros(np.shape(x),dtype=np.int64)
+	for b in range(bits):
+		count += (x>>b) & 1
+	return count
+
+
+
+def rotate(a,bit,U):
+	"""! Applies the 2x2 matrix U (basis: bit value 0, 1) to bit of the indices of a (in-place) """
+	v = a.reshape(-1,2,1<<bit)
+	a0 = v[:,0,:].copy()
+	v[:,0,:] *= U[0,0]
+	v[:,0,:] += U[0,1]*v[:,1,:]
+	v[:,1,:] *= U[1,1]
+	v[:,1,:] += U[1,0]*a0
+	return a
+
+
+
+def flip_flop(a,p,q,theta):
+	"""! Applies exp(-i theta (sigma^x_p sigma^x_q + sigma^y_p sigma^y_q)) to the bits p, q of the indices of a (in-place).
+		Only amplitudes with different bit values of p and q are mixed """
+	p, q = max(p,q), min(p,q)
+	v = a.reshape(-1,2,1<<(p-q-1),2,1<<q)
+	x = v[:,1,:,0,:]
+	y = v[:,0,:,1,:]
+	c, s = np.cos(2*theta), -1j*np.sin(2*theta)
+	x0 = x.copy()
+	x *= c
+	x += s*y
+	y *= c
+	y += s*x0
+	return a
+
+
+
+def pair_sum(a,bit):
+	"""! Sum of conj(a_0)*a_1 over all pairs of amplitudes of a whose indices differ in bit (bit value 0 resp. 1) """
+	v = a.reshape(-1,2,1<<bit)
+	return np.vdot(v[:,0,:],v[:,1,:])
+
+
+
+class Chunked_state():
+	"""! State of L spins stored in a np.memmap file and processed in chunks of chunk_size amplitudes (the lowest chunk_bits index bits).
+		Operations on a bit above the chunk touch pairs of chunks differing in that bit, such that only 2**group_bits chunks are held in memory.
+		Index bit p corresponds to site L-1-p with bit value 0 for spin up, i.e. the ordering of spin_basis_1d(L,pauli=True) """
+
+	def __init__(self,L,chunk_size=2**20,group_bits=3,path=None,dtype=np.complex128):
+
+		##
+		# @param L system size
+		# @param chunk_size number of amplitudes per chunk (power of 2). Default is 2**20 (16 MB in double precision)
+		# @param group_bits maximal number of bits above the chunk processed in one pass over the file. Default is 3
+		# @param path directory of the file (should be on a local disk). Default is None, i.e. the directory of tempfile
+		# @param dtype dtype of the amplitudes. Default is np.complex128
+
+		assert chunk_size & (chunk_size-1) == 0, 'chunk_size must be a power of 2'
+
+		## system size
+		self.L = L
+
+		## number of amplitudes
+		self.Ns = 2**L
+
+		## number of index bits within a chunk
+		self.chunk_bits = min(int(chunk_size).bit_length()-1,L)
+
+		## number of amplitudes per chunk
+		self.chunk_size = 2**self.chunk_bits
+
+		## number of chunks
+		self.n_chunks = self.Ns//self.chunk_size
+
+		## maximal number of bits above the chunk processed in one pass
+		self.group_bits = max(1,group_bits)
+
+		## dtype of the amplitudes
+		self.dtype = np.dtype(dtype)
+
+		fd, file_name = tempfile.mkstemp(suffix='.psi',dir=path)
+		os.close(fd)
+
+		## file of the amplitudes (deleted with this object)
+		self.file_name = file_name
+
+		## amplitudes (np.memmap)
+		self.psi = np.memmap(file_name,dtype=self.dtype,mode='w+',shape=(self.Ns,))
+		weakref.finalize(self,os.remove,file_name)
+
+		## number of down spins of the indices within a chunk
+		self.chunk_popcount = popcount(np.arange(self.chunk_size),self.chunk_bits)
+
+
+	@property
+	def shape(self):
+		return (self.Ns,)
+
+
+	@property
+	def size(self):
+		return self.Ns
+
+
+	def geometry(self):
+		"""! (L, chunk_bits, group_bits) of the state """
+		return (self.L,self.chunk_bits,self.group_bits)
+
+
+	def high_bit_groups(self):
+		"""! Bits above the chunk, in groups of at most group_bits bits """
+		high = list(range(self.chunk_bits,self.L))
+		return [high[i:i+self.group_bits] for i in range(0,len(high),self.group_bits)]
+
+
+	def buffer_bit(self,bit,high_bits):
+		"""! Bit of the buffers of groups(high_bits) corresponding to the index bit bit """
+		if bit < self.chunk_bits:
+			return bit
+		return self.chunk_bits + list(high_bits).index(bit)
+
+
+	def groups(self,high_bits,write=True):
+		"""! Generator over (k, buffer): buffer holds the chunks whose indices differ only in the bits high_bits (above the chunk),
+			k is the first of them. Bit high_bits[r] is bit chunk_bits+r of the buffer. If write, the buffer is written back after each step """
+		C = self.chunk_size
+		offsets = np.zeros(1,dtype=np.int64)
+		for bit in high_bits:
+			offsets = np.concatenate((offsets,offsets+(1<<(bit-self.chunk_bits))))
+		mask = int(np.sum(offsets[-1:])) if len(high_bits)>0 else 0
+		buffer = np.empty(len(offsets)*C,dtype=self.dtype)
+		for k in range(self.n_chunks):
+			if k & mask:
+				continue
+			for m, i in enumerate(offsets):
+				buffer[m*C:(m+1)*C] = self.psi[(k+i)*C:(k+i+1)*C]
+			yield k, buffer
+			if write:
+				for m, i in enumerate(offsets):
+					self.psi[(k+i)*C:(k+i+1)*C] = buffer[m*C:(m+1)*C]
+
+
+	def copies(self,high_bits):
+		"""! Number of processes holding the buffers of groups(high_bits) (see Distributed_state) """
+		return 1
+
+
+	def allreduce(self,value):
+		"""! Sum of value over all processes sharing the state (see Distributed_state) """
+		return value
+
+
+	def magnetization(self,k):
+		"""! Total magnetization sum_j sigma^z_j of the indices of chunk k """
+		return self.L - 2*(self.chunk_popcount + popcount(np.array(k),self.L-self.chunk_bits))
+
+
+	def product_state(self,spinors):
+		"""! Sets the state to the product of the single spin states spinors[j] = (up, down) of the sites j """
+		c = self.chunk_bits
+		low = np.ones(1,dtype=self.dtype)
+		for p in range(c-1,-1,-1):
+			low = np.kron(low,spinors[self.L-1-p])
+		for k in range(self.n_chunks):
+			factor = 1.0
+			for p in range(c,self.L):
+				factor = factor*spinors[self.L-1-p][(k>>(p-c)) & 1]
+			self.psi[k*self.chunk_size:(k+1)*self.chunk_size] = factor*low
+		return self
+
+
+	def expectation(self,directions):
+		"""! Expectation values of sum_j sigma^a_j / L for a in directions ('x', 'y' or 'z') """
+		# pair sums of the bits, total magnetization
+		sums = np.zeros(self.L+1,dtype=np.complex128)
+		for k, buffer in self.groups([],write=False):
+			if 'z' in directions:
+				sums[self.L] += np.dot(np.abs(buffer)**2,self.magnetization(k))
+			if 'x' in directions or 'y' in directions:
+				for p in range(self.chunk_bits):
+					sums[p] += pair_sum(buffer,p)
+		if 'x' in directions or 'y' in directions:
+			for high_bits in self.high_bit_groups():
+				for k, buffer in self.groups(high_bits,write=False):
+					for r, p in enumerate(high_bits):
+						sums[p] += pair_sum(buffer,self.buffer_bit(p,high_bits))/self.copies(high_bits)
+		sums = self.allreduce(sums)
+		# <sigma^x> = 2 Re(conj(a_up) a_down), <sigma^y> = 2 Im(conj(a_up) a_down)
+		values = {'x':2*np.sum(sums[:self.L].real)/self.L,'y':2*np.sum(sums[:self.L].imag)/self.L,'z':sums[self.L].real/self.L}
+		return [values[direction] for direction in directions]
+
+
+	def norm(self):
+		"""! Norm of the state """
+		return np.sqrt(self.allreduce(sum(np.vdot(buffer,buffer).real for _, buffer in self.groups([],write=False))))
+
+
+	def copy(self,path=None):
+		"""! Copy of the state in a new file in the directory path (default: the directory of this state) """
+		state = Chunked_state(self.L,self.chunk_size,self.group_bits,path=os.path.dirname(self.file_name) if path==None else path,dtype=self.dtype)
+		for k, buffer in self.groups([],write=False):
+			state.psi[k*self.chunk_size:(k+1)*self.chunk_size] = buffer
+		return state
+
+
+	def to_array(self):
+		"""! Amplitudes as (in-memory) array, only sensible for small L """
+		return np.array(self.psi)
+
+
+
+class Kick_propagator():
+	"""! Product of single spin unitaries U_j (kicks) applied to a Chunked_state: one pass for the bits within the chunks
+		and one pass per group of bits above the chunks """
+
+	def __init__(self,U):
+
+		##
+		# @param U array of shape (L,2,2), the unitaries of the sites in the basis (up, down)
+
+		## unitaries of the sites
+		self.U = np.asarray(U)
+
+
+	def dot(self,psi,work_array=None,overwrite_v=True):
+		"""! Propagator interface (see expm_multiply_parallel.dot): applies the kick to the Chunked_state psi (in-place) """
+		assert overwrite_v, 'chunked states are evolved in-place'
+		L, c = psi.L, psi.chunk_bits
+		for k, buffer in psi.groups([]):
+			for p in range(c):
+				rotate(buffer,p,self.U[L-1-p])
+		for high_bits in psi.high_bit_groups():
+			for k, buffer in psi.groups(high_bits):
+				for p in high_bits:
+					rotate(buffer,psi.buffer_bit(p,high_bits),self.U[L-1-p])
+		return psi
+
+
+
+class Trotter_propagator():
+	"""! Second order Trotter decomposition of exp(-i time H_dd) applied to a Chunked_state: the diagonal part (zz couplings, fields,
+		detuning and AC field) is a phase per amplitude, the flip-flop terms of the pairs are applied as two-spin gates.
+		Gates whose bits lie above the chunks are grouped into passes over at most group_bits such bits """
+
+	def __init__(self,pairs,J_xy,J_z,h,time,geometry,trotter_step=0.01,AC_couplings=None):
+
+		##
+		# @param pairs int array (n,2) of the sites of the pair couplings (see NV_system.dd_terms)
+		# @param J_xy, J_z flip-flop and zz couplings of the pairs
+		# @param h fields of the sites (including the detuning)
+		# @param time duration of the element
+		# @param geometry (L, chunk_bits, group_bits) of the states the propagator is applied to (see Chunked_state.geometry)
+		# @param trotter_step maximal Trotter step. Default is 0.01
+		# @param AC_couplings integrals of the AC field over the Trotter steps (None without AC field)
+
+		L, c, group_bits = geometry
+
+		## (L, chunk_bits, group_bits) of the states
+		self.geometry = geometry
+
+		## number of Trotter steps
+		self.n_steps = max(1,int(np.ceil(time/trotter_step-1e-12)))
+
+		## duration of a Trotter step
+		self.dt = time/self.n_steps
+
+		self.__diagonal = Diagonal_energy(pairs,J_z,h,L,c)
+
+		# flip-flop gates (bit p, bit q, coupling), ordered by their bits above the chunks. Gates within the chunks are applied last
+		bits = L-1-np.asarray(pairs).reshape(-1,2)
+		gates = [(int(p),int(q),J) for (p,q), J in zip(bits,J_xy) if J != 0]
+		high = lambda gate: tuple(sorted(b for b in gate[:2] if b >= c))
+		gates.sort(key=lambda gate: (len(high(gate))==0,high(gate)))
+
+		passes = []
+		for gate in gates:
+			union = tuple(sorted(set(passes[-1][0]) | set(high(gate)))) if len(passes)>0 else None
+			if len(passes)>0 and len(union)<=group_bits and (len(high(gate))>0) == (len(passes[-1][0])>0):
+				passes[-1] = (union,passes[-1][1]+[gate])
+			else:
+				passes += [(high(gate),[gate])]
+
+		# schedule of passes (high bits, actions): forward gates, diagonal phase, backward gates per Trotter step.
+		# Consecutive passes over the same bits are merged
+		if AC_couplings == None:
+			AC_couplings = [0.0]*self.n_steps
+		schedule = []
+		half = self.dt/2
+		for step in range(self.n_steps):
+			for union, pass_gates in passes:
+				schedule += [(union,[('gate',p,q,J*half) for p,q,J in pass_gates])]
+			schedule += [((),[('phase',self.dt,AC_couplings[step])])]
+			for union, pass_gates in passes[::-1]:
+				schedule += [(union,[('gate',p,q,J*half) for p,q,J in pass_gates[::-1]])]
+
+		## passes (high bits, actions) over the state
+		self.schedule = []
+		for union, actions in schedule:
+			if len(self.schedule)>0 and self.schedule[-1][0] == union:
+				self.schedule[-1][1].extend(actions)
+			else:
+				self.schedule += [(union,list(actions))]
+
+
+	def dot(self,psi,work_array=None,overwrite_v=True):
+		"""! Propagator interface (see expm_multiply_parallel.dot): applies the element to the Chunked_state psi (in-place) """
+		assert overwrite_v, 'chunked states are evolved in-place'
+		assert psi.geometry() == self.geometry, 'the state does not match the chunks of the propagator'
+		for union, actions in self.schedule:
+			for k, buffer in psi.groups(union):
+				energy = None
+				for action in actions:
+					if action[0]=='gate':
+						flip_flop(buffer,psi.buffer_bit(action[1],union),psi.buffer_bit(action[2],union),action[3])
+					else:
+						if energy is None:
+							energy = self.__diagonal.energy(k)
+							magnetization = psi.magnetization(k)
+						buffer *= np.exp(-1j*(action[1]*energy + action[2]*magnetization))
+		return psi
+
+
+
+class Diagonal_energy():
+	"""! Diagonal part sum_k J^z_k sigma^z_i sigma^z_j + sum_j h_j sigma^z_j of H_dd for the indices of a chunk,
+		split into a part within the chunk (computed once), a constant of the chunk and the couplings between both """
+
+	def __init__(self,pairs,J_z,h,L,chunk_bits):
+		c = chunk_bits
+		self.__c = c
+		indices = np.arange(2**c)
+		# sigma^z of the bits within the chunk
+		self.__z = np.array([1-2*((indices>>p) & 1) for p in range(c)],dtype=np.float64).reshape(c,2**c)
+		self.__low = np.zeros(2**c)
+		self.__couplings = []
+		self.__fields = []
+		for (i,j), J in zip(np.asarray(pairs).reshape(-1,2),J_z):
+			p, q = L-1-i, L-1-j
+			if p < c and q < c:
+				self.__low += J*self.__z[p]*self.__z[q]
+			else:
+				self.__couplings += [(p,q,J)]
+		for j in range(L):
+			p = L-1-j
+			if p < c:
+				self.__low += h[j]*self.__z[p]
+			else:
+				self.__fields += [(p,h[j])]
+
+
+	def energy(self,k):
+		"""! Diagonal energies of the indices of chunk k """
+		c = self.__c
+		z_of = lambda p: 1-2*((k>>(p-c)) & 1)
+		constant = sum(field*z_of(p) for p, field in self.__fields)
+		w = np.zeros(c)
+		for p, q, J in self.__couplings:
+			if p >= c and q >= c:
+				constant += J*z_of(p)*z_of(q)
+			elif p >= c:
+				w[q] += J*z_of(p)
+			else:
+				w[p] += J*z_of(q)
+		return self.__low + constant + w.dot(self.__z)
+
+
+
+class Out_of_core_dynamics(NV_dynamics):
+	"""! Evolution of states stored in memory-mapped files (see Chunked_state) for system sizes whose state vector does not fit into memory.
+		Kicks are applied as exact products of single spin rotations, 'dd' elements with a second order Trotter decomposition
+		of H_dd into diagonal phases and flip-flop gates (matrix free, see NV_system(...,matrix_free=True)). No noise """
+
+	def __init__(self,nv_instance,rabi_freq,kick_building_blocks,detuning=None,AC_function=None,trotter_step=0.01,
+					chunk_size=2**20,group_bits=3,path=None,profile=False):
+
+		##
+		# @param nv_instance NV_system object (can be matrix free)
+		# @param rabi_freq, kick_building_blocks, detuning, AC_function drive (see NV_dynamics)
+		# @param trotter_step maximal Trotter step of the 'dd' elements (in units of 1/energy_scale). Default is 0.01
+		# @param chunk_size, group_bits chunks of the states (see Chunked_state). Default is 2**20 and 3
+		# @param path directory of the state files (should be a local disk). Default is None (directory of tempfile)
+		# @param profile see NV_dynamics. Default is False
+
+		self.__dict__.update(nv_instance.__dict__)
+
+		self.profiler = None
+		if profile:
+			self.profiler = Profiler()
+			if nv_instance.__dict__.get('profiler') != None:
+				self.profiler.merge(nv_instance.profiler)
+
+		self.detuning = detuning
+		self.rabi_freq = rabi_freq
+		self.noise = None
+		self.noise_bins = None
+		self.AC_function = AC_function
+		self.engine = 'out_of_core'
+		self.precision = 'double'
+		self.dtype = np.complex128
+		self.renormalize_every = None
+		self.async_measure = False
+		self.zero_copy = False
+
+		## maximal Trotter step of the 'dd' elements
+		self.trotter_step = trotter_step
+
+		## directory of the state files
+		self.path = path
+
+		## (L, chunk_bits, group_bits) of the states (see Chunked_state)
+		self.geometry = (self.L,min(int(chunk_size).bit_length()-1,self.L),max(1,group_bits))
+
+		assert type(kick_building_blocks)==list, 'kick_squence must be  of type list'
+		for block in kick_building_blocks:
+			for element in block[0]:
+				assert type(element)==tuple and len(element)==2 and element[0] in ['x','y','z','dd'], 'element {0} not understood'.format(element)
+
+		if detuning == None:
+			detuning_list = np.zeros(self.L)
+		elif type(detuning)==list:
+			assert len(detuning)==self.L, 'not enough elements given in detuning: L={0:d}, length of detuning ={1:d}'.format(self.L,len(detuning))
+			detuning_list = np.array(detuning,dtype=np.float64)
+		else:
+			detuning_list = detuning*np.ones(self.L)
+
+		pairs, J_xy, J_z, h = self.dd_terms()
+
+		## building blocks of the sequences to be applied (with Kick_propagator and Trotter_propagator objects)
+		self.building_blocks = []
+		with self.profiling(), self.phase('build/setup'):
+			for block in kick_building_blocks:
+				current_time = 0.0
+				sequence = []
+				for label, time in block[0]:
+					if label=='dd':
+						AC_couplings = None
+						n_steps = max(1,int(np.ceil(time/trotter_step-1e-12)))
+						if AC_function != None:
+							edges = current_time + time*np.arange(n_steps+1)/n_steps
+							AC_couplings = [hlp.integrate_AC(AC_function,edges[s],edges[s+1]) for s in range(n_steps)]
+						propagator = Trotter_propagator(pairs,J_xy,J_z,h+detuning_list,time,self.geometry,trotter_step,AC_couplings)
+					else:
+						# kick (rabi_freq*time*sigma^label + detuning*time*sigma^z) on every site
+						propagator = Kick_propagator([expm(-1j*(rabi_freq*time*PAULI[label] + detuning_list[j]*time*PAULI['z'])) for j in range(self.L)])
+					sequence += [(label,time,propagator)]
+					current_time += time
+				self.building_blocks += [[sequence,block[1]]]
+
+		## compact representation of the building blocks (see Program)
+		self.program = Program(self.building_blocks)
+
+
+	def work_array(self,psi):
+		# the propagators work on the chunks of the state
+		return None
+
+
+	def initial_state(self,direction):
+		"""! Chunked_state polarized along direction ('x', 'y' or 'z'), see NV_system.initial_state """
+		spinor = {'z':np.array([1,0]),'x':np.array([1,1])/np.sqrt(2),'y':np.array([1,1j])/np.sqrt(2)}
+		assert direction in spinor, "input not understood: direction should be 'x', 'y' or 'z'"
+		return self.new_state().product_state([spinor[direction]]*self.L)
+
+
+	def new_state(self):
+		"""! Empty Chunked_state of the geometry of the propagators """
+		L, c, group_bits = self.geometry
+		return Chunked_state(L,2**c,group_bits,path=self.path)
+
+
+	def SP_observable(self,directions):
+		"""! Observables sum_j sigma^a_j of the directions, evaluated on the chunks of the state (the directions themselves) """
+		for char in directions:
+			assert char in ['x','y','z'], 'input not understood'
+		return list(directions)
+
+
+	def measure_function(self,observable):
+		def measure(psi,out):
+			out[:] = psi.expectation(observable)
+		return measure
+
+
+	def evolve_periodic(self,initial_state,n_steps,observable,file_name,save_every=1000,save_dir='./data/',
+						folder='new_data_set',extra_save_parameters=None):
+
+		"""! Floquet evolution of the Chunked_state initial_state (see NV_dynamics.evolve_periodic). The final state is stored in final_state """
+
+		##
+		# @param observable list of directions 'x', 'y', 'z' (see SP_observable)
+		#
+		# @return data, times
+
+		return self.evolve_sequential(initial_state,n_steps,observable,None,file_name,save_every=save_every,save_dir=save_dir,
+										folder=folder,extra_save_parameters=extra_save_parameters)
+
+
+	def evolve_sequential(self,initial_state,n_steps,observable,sequence,file_name,save_every=1000,save_dir='./data/',
+						folder='new_data_set',extra_save_parameters=None):
+
+		"""! Evolution of the Chunked_state initial_state with the blocks sequence[step] (see NV_dynamics.evolve_sequential).
+			sequence=None applies all blocks at every step. The final state is stored in final_state """
+
+		##
+		# @param observable list of directions 'x', 'y', 'z' (see SP_observable)
+		#
+		# @return data, times
+
+		if not os.path.exists(save_dir):
+			os.mkdir(save_dir)
+		assert isinstance(initial_state,Chunked_state) and initial_state.geometry()==self.geometry, 'initial_state must be a Chunked_state of initial_state()'
+		self.SP_observable(observable)
+
+		if sequence == None:
+			blocks_of_step = lambda step: self.program.blocks
+			points = sum(self.data_points())*n_steps
+		else:
+			assert len(sequence)>=n_steps, 'sequence is too short'
+			blocks_of_step = lambda step: [self.program.blocks[sequence[step]]]
+			points = sum(self.data_points()[sequence[step]] for step in range(n_steps))
+
+		data = np.zeros((len(observable),points+1))
+		times = np.zeros(points+1)
+
+		save_parameters = {'trotter_step':self.trotter_step,'chunk_size':2**self.geometry[1],'group_bits':self.geometry[2]}
+		if extra_save_parameters!=None:
+			save_parameters.update(extra_save_parameters)
+
+		## state after the last evolution (Chunked_state)
+		self.final_state = initial_state.copy(self.path)
+
+		return self.execute_program(blocks_of_step,n_steps,self.final_state,observable,data,times,None,
+										file_name,save_every,save_dir,folder,save_parameters,'finished step {0:d}')
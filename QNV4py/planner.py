@@ -0,0 +1,405 @@
+import os
+import numpy as np
+from time import perf_counter
+import scipy.sparse as sparse
+from QNV4py import Helper_funcs
+from QNV4py.program import Dense_expH, Noise_stream
+
+try:
+	# theta_m of the truncated Taylor series at machine precision (Al-Mohy and Higham), as used by expm_multiply_parallel
+	from scipy.sparse.linalg._expm_multiply import _theta
+except ImportError:
+	_theta = {55: 9.9}
+
+
+##
+# @file planner.py Contains the class Run_planner
+#
+
+hlp = Helper_funcs()
+
+
+
+def matvecs(norm):
+	"""! Number of matrix-vector products of expm_multiply_parallel for an operator of 1-norm norm: min over m of m*ceil(norm/theta_m).
+		Upper bound at machine precision (the actual partition also uses norms of powers of the operator and the tolerance) """
+	if norm == 0:
+		return 0
+	return min(m*int(np.ceil(norm/theta)) for m, theta in _theta.items())
+
+
+
+def available_memory():
+	"""! Available memory in bytes (MemAvailable of /proc/meminfo, the physical memory or 4 GB) """
+	try:
+		with open('/proc/meminfo') as f:
+			for line in f:
+				if line.startswith('MemAvailable:'):
+					return int(line.split()[1])*1024
+	except OSError:
+		pass
+	try:
+		return os.sysconf('SC_PHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+	except (ValueError,OSError,AttributeError):
+		return 2**32
+
+
+
+def csr_nbytes(nnz,Ns,itemsize):
+	"""! Memory of a CSR matrix with nnz entries of itemsize bytes and Ns rows (int32 indices) """
+	return nnz*(itemsize+4) + (Ns+1)*4
+
+
+
+class Run_planner():
+	"""! Estimates the peak memory and run time of an evolve_* run of a drive of a NV_system before the NV_dynamics object is built,
+		and picks the fastest engine that fits into a memory budget """
+
+	## machine specific costs measured by calibrate (shared by all planners)
+	calibration = None
+
+	def __init__(self,nv_instance,rabi_freq,kick_building_blocks,detuning=None,AC_function=None,noise=None,noise_bins=None,
+					cache_memory=2**28,async_measure=False,precision='double',memory_budget=None,calibration=None):
+
+		##
+		# @param nv_instance NV_system object
+		# @param rabi_freq, kick_building_blocks, detuning, AC_function, noise, noise_bins, cache_memory, async_measure, precision
+		# inputs of the NV_dynamics object to plan for (see NV_dynamics)
+		# @param memory_budget memory (in bytes) the run may use. Default is None, i.e. the currently available memory
+		# @param calibration dict of machine specific costs (see calibrate). Default is None, i.e. measured on first use
+
+		assert precision in ['double','single'], "precision must be 'double' or 'single'"
+
+		## NV_system object
+		self.nv_instance = nv_instance
+
+		## Rabi frequency
+		self.rabi_freq = rabi_freq
+
+		## building blocks [[(label,time),...],nr_of_reps] of the drive
+		self.kick_building_blocks = kick_building_blocks
+
+		## detuning of the drive
+		self.detuning = detuning
+
+		## AC function of the drive
+		self.AC_function = AC_function
+
+		## noise of the drive
+		self.noise = noise
+
+		## number of bins of the quantized noise pool (see NV_dynamics.noise_pool)
+		self.noise_bins = noise_bins
+
+		## memory limit of the propagator cache of evolve_time_dependent
+		self.cache_memory = cache_memory
+
+		## observables evaluated on a copy of the state (see Async_measurement)
+		self.async_measure = async_measure
+
+		## 'double' or 'single'
+		self.precision = precision
+
+		## memory (in bytes) the run may use
+		self.memory_budget = available_memory() if memory_budget==None else memory_budget
+
+		if calibration != None:
+			Run_planner.calibration = calibration
+
+		L = nv_instance.L
+		Ns = nv_instance.basis.Ns
+
+		## dimension of the Hilbert space
+		self.Ns = Ns
+
+		## bytes of a complex and a real number in the precision of the run
+		self.itemsize = 16 if precision=='double' else 8
+		self.real_itemsize = self.itemsize//2
+
+		# shift of the 'dd' elements by the detuning and the AC field: diagonal
+		detuning_norm = 0.0
+		if detuning != None:
+			detuning_norm = float(np.sum(np.abs(detuning))) if type(detuning)==list else L*abs(detuning)
+		H_dd_norm = float(np.abs(nv_instance.H_dd).sum(axis=0).max())
+		nnz_dd = nv_instance.H_dd.nnz
+		if (detuning != None or AC_function != None) and nv_instance.H_dd.diagonal().nonzero()[0].size < Ns:
+			nnz_dd += Ns - nv_instance.H_dd.diagonal().nonzero()[0].size
+
+		# (nnz, bytes per entry, number of matrix-vector products) of each distinct element
+		self.__elements = {}
+		for block in kick_building_blocks:
+			for label, time in block[0]:
+				if (label,time) in self.__elements:
+					continue
+				if label=='dd':
+					norm = time*(H_dd_norm + detuning_norm)
+					self.__elements[(label,time)] = (nnz_dd,self.real_itemsize,matvecs(norm))
+				else:
+					norm = time*(abs(rabi_freq)*L + detuning_norm)
+					# 'x' and 'z' kicks are real, 'y' kicks imaginary. 'z' kicks are diagonal
+					nnz = Ns if label=='z' else L*Ns + (Ns if detuning != None else 0)
+					itemsize = self.itemsize if label=='y' else self.real_itemsize
+					self.__elements[(label,time)] = (nnz,itemsize,matvecs(norm))
+
+		## nnz of H_dd (the 'dd' elements)
+		self.nnz_dd = nnz_dd
+
+
+	@classmethod
+	def calibrate(cls,repeat=5):
+		"""! Measures the machine specific costs (in seconds) used by the run time estimates and stores them in Run_planner.calibration """
+
+		##
+		# - 'build': per nnz of building the propagator of a sparse Hamiltonian (see Helper_funcs.expm)
+		# - 'sparse_nnz_double', 'sparse_nnz_single', 'sparse_vector_double', 'sparse_vector_single': per nnz and per Ns of a matrix-vector product 
+		#   (and the vector operations of a Taylor step) of expm_multiply_parallel.dot
+		# - 'krylov_call': overhead of a call of expm_multiply_parallel.dot
+		# - 'dense_double', 'dense_single': per entry of a dense unitary applied to a state (see Dense_expH)
+		# - 'dense_call': overhead of a call of Dense_expH.dot
+		# - 'matmul': per Ns^3 of a dense (complex128) matrix product
+		# - 'csr', 'measure_call': per (nnz+Ns) and overhead of the evaluation of an observable (see NV_dynamics.measure_function)
+
+		rng = np.random.default_rng(1)
+		calibration = {}
+
+		def timed(function,n):
+			t = perf_counter()
+			for _ in range(n):
+				function()
+			return (perf_counter()-t)/n
+
+		# a diagonal and a random sparse matrix separate the cost per nnz of the matrix-vector products from the cost per Ns of the vector operations
+		Ns = 2**15
+		A = sparse.csr_matrix((rng.standard_normal(8*Ns),(np.repeat(np.arange(Ns),8),rng.integers(0,Ns,size=8*Ns))),shape=(Ns,Ns))
+		A = ((A + A.T)*0.5).tocsr()
+		A.sort_indices()
+		D = sparse.diags(rng.standard_normal(Ns)).tocsr()
+		calibration['build'] = timed(lambda: hlp.expm(A*0.5),1)/A.nnz
+
+		for dtype, name in [(np.complex128,'double'),(np.complex64,'single')]:
+			v = (rng.standard_normal(Ns)+1j*rng.standard_normal(Ns)).astype(dtype)
+			work_array = np.zeros((2*Ns,),dtype=dtype)
+			seconds = []
+			for H in [D,A]:
+				expH = hlp.expm(H*0.5,dtype)
+				seconds += [timed(lambda: expH.dot(v,work_array,True),repeat)/max(1,expH._m_star*expH._s)]
+			calibration['sparse_nnz_'+name] = max((seconds[1]-seconds[0])/(A.nnz-D.nnz),0.0)
+			calibration['sparse_vector_'+name] = max(seconds[0]/Ns - calibration['sparse_nnz_'+name],0.0)
+
+			N = 2**9
+			U = Dense_expH(np.eye(N,dtype=dtype))
+			v = v[:N].copy()
+			calibration['dense_'+name] = timed(lambda: U.dot(v,work_array,True),10*repeat)/N**2
+
+		v = np.ones(2,dtype=np.complex128)
+		work_array = np.zeros((4,),dtype=np.complex128)
+		expH = hlp.expm(sparse.csr_matrix(np.array([[0.0,0.1],[0.1,0.0]])))
+		calibration['krylov_call'] = timed(lambda: expH.dot(v,work_array,True),1000)
+		U = Dense_expH(np.eye(2,dtype=np.complex128))
+		calibration['dense_call'] = timed(lambda: U.dot(v,work_array,True),1000)
+
+		N = 2**8
+		M = rng.standard_normal((N,N)).astype(np.complex128)
+		calibration['matmul'] = timed(lambda: M.dot(M),repeat)/N**3
+
+		B = A.astype(np.complex128)
+		v = (rng.standard_normal(Ns)+1j*rng.standard_normal(Ns))
+		calibration['csr'] = timed(lambda: np.vdot(v,B.dot(v)),10*repeat)/(A.nnz+Ns)
+		b = B[:2][:,:2]
+		v = v[:2].copy()
+		calibration['measure_call'] = timed(lambda: np.vdot(v,b.dot(v)),1000)
+
+		cls.calibration = calibration
+		return calibration
+
+
+	def propagator_bytes(self,element,engine):
+		"""! Memory of the propagator of element (label,time) """
+		if engine=='dense':
+			return self.Ns**2*self.itemsize
+		nnz, itemsize, _ = self.__elements[element]
+		if element[0]=='dd' and self.detuning == None and self.AC_function == None and self.precision=='double' and self.nv_instance.is_shared('H_dd'):
+			# view of the shared H_dd (see NV_system.share)
+			return 0
+		return csr_nbytes(nnz,self.Ns,itemsize)
+
+
+	def __fused_products(self,block):
+		# keys of the dense products of a block (see Compiled_block.fuse): one per run of elements ending at a measurement or before a noisy element
+		elements, nr_of_reps = block
+		noisy = [label=='dd' and self.noise != None for label, _ in elements]
+		measured = [label=='dd' for label, _ in elements]
+		if not any(measured) and not any(noisy):
+			return [(tuple(elements),nr_of_reps)], 1
+		products = []
+		group = []
+		for i, element in enumerate(elements*nr_of_reps):
+			j = i % len(elements)
+			if noisy[j]:
+				if len(group)>0:
+					products += [(tuple(group),1)]
+					group = []
+			else:
+				group += [element]
+				if measured[j]:
+					products += [(tuple(group),1)]
+					group = []
+		if len(group)>0:
+			products += [(tuple(group),1)]
+		return products, len(products)
+
+
+	def __block_weights(self,driver,n_steps,sequence):
+		# average number of applications of each block per step
+		n_blocks = len(self.kick_building_blocks)
+		if driver in ['evolve_periodic','evolve_time_dependent']:
+			return np.ones(n_blocks)
+		if driver=='evolve_sequential':
+			assert sequence is not None, 'evolve_sequential requires the sequence'
+			return np.bincount(np.array(sequence[:n_steps],dtype=np.int64),minlength=n_blocks)/max(n_steps,1)
+		assert driver in ['evolve_random','evolve_random_multipolar'], 'driver {0} not understood'.format(driver)
+		return np.ones(n_blocks)/n_blocks
+
+
+	def plan(self,engine,n_steps,observable,driver='evolve_periodic',n_states=1,sequence=None):
+		"""! Estimated memory (in bytes) and run time (in seconds) of a run with engine """
+
+		##
+		# @param engine 'krylov' or 'dense'
+		# @param n_steps number of steps of the run
+		# @param observable list of QuSpin hamiltonian objects (or the number of single particle observables)
+		# @param driver name of the evolve_* method. Default is 'evolve_periodic'
+		# @param n_states number of states evolved at once (columns of the initial state). Default is 1
+		# @param sequence sequence of blocks (evolve_sequential only). Default is None
+		#
+		# @return dict {'engine', 'memory': {component: bytes}, 'peak_bytes', 'time': {component: seconds}, 'seconds', 'fits'}
+
+		assert engine in ['krylov','dense'], "engine must be 'krylov' or 'dense'"
+		if Run_planner.calibration == None:
+			Run_planner.calibrate()
+		cost = Run_planner.calibration
+
+		Ns = self.Ns
+		L = self.nv_instance.L
+		c = self.itemsize
+		blocks = self.kick_building_blocks
+		weights = self.__block_weights(driver,n_steps,sequence)
+		noisy = self.noise != None
+
+		if isinstance(observable,list):
+			nnz_obs = [obs.static.nnz if sparse.issparse(obs.static) else Ns**2 for obs in observable]
+		else:
+			nnz_obs = observable*[L*Ns]
+
+		points = np.array([sum(label=='dd' for label, _ in block[0])*block[1] for block in blocks])
+		nr_of_data_points = int(np.ceil(np.sum(points*weights)*n_steps))
+
+		# memory
+		memory = {}
+		memory['H_dd'] = sum(csr_nbytes(H.nnz,Ns,H.data.itemsize) for H in [self.nv_instance.H_int,self.nv_instance.H_z,self.nv_instance.H_dd])
+		# the observables and their copies in the precision of the run (see NV_dynamics.measure_function)
+		memory['observables'] = sum(csr_nbytes(nnz,Ns,16) + csr_nbytes(nnz,Ns,c) for nnz in nnz_obs)
+
+		fixed = [element for element in self.__elements if not (element[0]=='dd' and noisy)]
+		noisy_elements = [element for element in self.__elements if element[0]=='dd' and noisy]
+		memory['propagators'] = sum(self.propagator_bytes(element,'krylov') for element in fixed)
+		# the Hamiltonians of the elements are built in complex128 before they are converted to real propagators
+		memory['transient'] = max([2*csr_nbytes(self.__elements[element][0],Ns,16) for element in fixed]+[0])
+		products = set()
+		executed = []
+		if engine=='dense':
+			for block in blocks:
+				block_products, n_executed = self.__fused_products([[tuple(e) for e in block[0]],block[1]])
+				products.update(block_products)
+				executed += [n_executed]
+			# dense copies of the elements and the fused products, transient workspace of scipy.linalg.expm (complex128)
+			memory['dense_unitaries'] = (len(fixed)+len(products))*Ns**2*c
+			memory['transient'] = max(memory['transient'],6*Ns**2*16)
+
+		if noisy and self.noise_bins != None:
+			memory['noise_pool'] = self.noise_bins*sum(self.propagator_bytes(element,engine) for element in noisy_elements)
+		elif noisy:
+			# a (sparse) propagator is built for every noisy element: H_dd*time and its copy in expm_multiply_parallel
+			memory['transient'] = max(memory.get('transient',0),2*csr_nbytes(self.nnz_dd,Ns,self.real_itemsize))
+
+		memory['states'] = (3 + (2 if self.async_measure else 0))*Ns*n_states*c + Ns*n_states*16
+		memory['data'] = (len(nnz_obs)*n_states+1)*(nr_of_data_points+1)*8
+		# chunk of the Noise_stream (nothing is drawn without noise)
+		memory['noise_array'] = Noise_stream().chunk_size*8 if noisy else 0
+		if driver=='evolve_time_dependent':
+			memory['propagator_cache'] = self.cache_memory
+
+		# time
+		time = {}
+		nnz_cost = cost['sparse_nnz_'+self.precision]
+		vector_cost = cost['sparse_vector_'+self.precision]
+		dense_cost = cost['dense_'+self.precision]
+		expm_cost = 15*Ns**3*cost['matmul']
+
+		def krylov_cost(element):
+			nnz, _, n = self.__elements[element]
+			return n*(nnz*nnz_cost + Ns*vector_cost)*n_states + cost['krylov_call']
+
+		time['setup'] = sum(cost['build']*self.__elements[element][0] for element in fixed)
+		if engine=='krylov':
+			per_step = 0.0
+			for weight, block in zip(weights,blocks):
+				per_step += weight*block[1]*sum(krylov_cost(element) for element in block[0] if element not in noisy_elements)
+		else:
+			time['setup'] += len(fixed)*expm_cost + sum(max(len(group)-1,0) + 2*int(np.log2(max(power,1))) for group, power in products)*Ns**3*cost['matmul']
+			per_step = sum(weight*n*(Ns**2*dense_cost*n_states + cost['dense_call']) for weight, n in zip(weights,executed))
+		time['propagation'] = per_step*n_steps
+
+		if noisy:
+			n_noisy = sum(weight*block[1]*sum(label=='dd' for label, _ in block[0]) for weight, block in zip(weights,blocks))
+			if self.noise_bins != None:
+				time['setup'] += self.noise_bins*len(noisy_elements)*(cost['build']*self.nnz_dd + (expm_cost if engine=='dense' else 0))
+				per_noisy = np.mean([krylov_cost(e) for e in noisy_elements]) if engine=='krylov' else Ns**2*dense_cost*n_states + cost['dense_call']
+			else:
+				# noisy propagators are always sparse, built and applied once
+				per_noisy = np.mean([krylov_cost(e) for e in noisy_elements]) + cost['build']*self.nnz_dd
+			time['noise'] = n_noisy*per_noisy*n_steps
+
+		time['measurement'] = (nr_of_data_points+1)*sum((nnz+Ns)*cost['csr']*n_states + cost['measure_call'] for nnz in nnz_obs)
+
+		peak_bytes = int(sum(memory.values()))
+		return {'engine':engine,'memory':memory,'peak_bytes':peak_bytes,'time':time,'seconds':float(sum(time.values())),
+				'fits':peak_bytes <= self.memory_budget}
+
+
+	def spectrum_bytes(self,sector=None,k=None):
+		"""! Estimated memory of NV_system.spectrum(sector,k): eigenvalues, eigenvectors and the workspace of the (largest) dense sector """
+		itemsize = self.nv_instance.H_dd.dtype.itemsize
+		if sector==None:
+			sizes = [int(self.nv_instance.sector_indices(n_up).size) for n_up in range(self.nv_instance.L+1)]
+		else:
+			sizes = [int(self.nv_instance.sector_indices(sector).size)]
+		if k==None:
+			# full diagonalization: dense sector matrix, its eigenvectors and the LAPACK workspace
+			return (self.Ns if sector==None else sizes[0])*(sizes[0] if sector!=None else self.Ns)*itemsize + 3*max(sizes)**2*itemsize
+		# eigsh: k eigenvectors per sector, embedded into the full basis if sector is None
+		return k*(len(sizes)*self.Ns if sector==None else sizes[0])*itemsize
+
+
+	def best(self,n_steps,observable,driver='evolve_periodic',n_states=1,sequence=None,engines=('dense','krylov')):
+		"""! Plans of all engines (see plan) and the fastest one that fits into the memory budget (None if no engine fits) """
+		plans = [self.plan(engine,n_steps,observable,driver=driver,n_states=n_states,sequence=sequence) for engine in engines]
+		fitting = [plan for plan in plans if plan['fits']]
+		return (min(fitting,key=lambda plan: plan['seconds']) if len(fitting)>0 else None), plans
+
+
+	def engine(self,n_steps,observable,driver='evolve_periodic',n_states=1,sequence=None):
+		"""! Fastest engine that fits into the memory budget. Raises an AssertionError (with the estimates) if no engine fits """
+		plan, plans = self.best(n_steps,observable,driver=driver,n_states=n_states,sequence=sequence)
+		assert plan != None, 'no engine fits into the memory budget of {0:0.2e} bytes:\n{1}'.format(self.memory_budget,
+										'\n'.join(self.report(p) for p in plans))
+		return plan['engine']
+
+
+	def report(self,plan):
+		"""! Human readable summary of a plan """
+		lines = ['{0}: {1:0.3e} bytes peak ({2}), {3:0.3e} s'.format(plan['engine'],plan['peak_bytes'],
+											'fits' if plan['fits'] else 'exceeds the budget',plan['seconds'])]
+		lines += ['  memory {0:<18s} {1:0.3e} bytes'.format(name,value) for name, value in plan['memory'].items()]
+		lines += ['  time   {0:<18s} {1:0.3e} s'.format(name,value) for name, value in plan['time'].items()]
+		return '\n'.join(lines)
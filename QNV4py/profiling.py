@@ -0,0 +1,90 @@
+import contextlib
+from time import perf_counter
+
+
+##
+# @file profiling.py Contains the class Profiler
+#
+
+
+
+class Profiler():
+	"""! Opt-in instrumentation of NV_system and NV_dynamics: accumulates wall time and number of calls per phase.
+		Phases are named hierarchically with '/', e.g. 'build/quad' or 'apply/block 0/element 1 (dd)' """
+
+	def __init__(self):
+
+		## statistics {phase: [wall time, number of calls]}
+		self.stats = {}
+
+
+	def entry(self,name):
+		"""! Statistics [wall time, number of calls] of phase name (created if necessary) """
+		if name not in self.stats:
+			self.stats[name] = [0.0,0]
+		return self.stats[name]
+
+
+	def add(self,name,time,calls=1):
+		"""! Adds time and calls to phase name """
+		stat = self.entry(name)
+		stat[0] += time
+		stat[1] += calls
+
+
+	@contextlib.contextmanager
+	def phase(self,name):
+		"""! Context manager timing the enclosed code as phase name """
+		t = perf_counter()
+		try:
+			yield
+		finally:
+			self.add(name,perf_counter()-t)
+
+
+	def timed(self,function,name):
+		"""! Returns a wrapper of function that accumulates its wall time in phase name """
+		stat = self.entry(name)
+		def wrapper(*args,**kwargs):
+			t = perf_counter()
+			out = function(*args,**kwargs)
+			stat[0] += perf_counter()-t
+			stat[1] += 1
+			return out
+		return wrapper
+
+
+	def merge(self,other):
+		"""! Adds the statistics of the Profiler other """
+		for name, stat in other.stats.items():
+			self.add(name,stat[0],stat[1])
+		return self
+
+
+	def reset(self):
+		"""! Clears all statistics """
+		self.stats = {}
+
+
+	def total(self,prefix):
+		"""! Total wall time and calls of all phases starting with prefix """
+		time, calls = 0.0, 0
+		for name, stat in self.stats.items():
+			if name==prefix or name.startswith(prefix+'/'):
+				time += stat[0]
+				calls += stat[1]
+		return time, calls
+
+
+	def save_attributes(self,dset):
+		"""! Stores the statistics as attributes 'profile_time:<phase>' and 'profile_calls:<phase>' of the hdf5 data set (or group) dset """
+		for name, stat in self.stats.items():
+			dset.attrs['profile_time:'+name] = stat[0]
+			dset.attrs['profile_calls:'+name] = stat[1]
+
+
+	def __str__(self):
+		lines = ['{0:>12s} {1:>10s}  {2}'.format('time [s]','calls','phase')]
+		for name, stat in sorted(self.stats.items(),key=lambda item: -item[1][0]):
+			lines += ['{0:12.6f} {1:10d}  {2}'.format(stat[0],stat[1],name)]
+		return '\n'.join(lines)
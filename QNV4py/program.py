@@ -0,0 +1,385 @@
+import numpy as np
+from scipy.linalg import expm
+from collections import OrderedDict
+import threading
+
+
+##
+# @file program.py Contains the classes Program, Compiled_block, Dense_expH, Propagator_cache and Noise_stream
+#
+
+
+## opcode of elements whose propagator is built during the evolution (noisy 'dd' elements)
+NOISY = -1
+
+
+
+class Dense_expH():
+	"""! Dense unitary with the dot interface of expm_multiply_parallel. Applied with BLAS zgemv (single state) or zgemm (batch of states) """
+
+	def __init__(self,U):
+
+		##
+		# @param U dense unitary matrix
+
+		## dense unitary matrix
+		self.U = np.ascontiguousarray(U)
+
+
+	@classmethod
+	def from_expm(cls,expH):
+		"""! Dense version of the expm_multiply_parallel object expH (computed in double precision, stored in the (complex) precision of expH.A) """
+		return cls(expm(expH.a*expH.A.toarray().astype(np.complex128)).astype(np.result_type(expH.A.dtype,np.complex64)))
+
+
+	def dot(self,v,work_array=None,overwrite_v=False):
+		"""! Computes U.v, in-place if overwrite_v is True """
+
+		if not overwrite_v:
+			return self.U.dot(v)
+
+		if work_array is None:
+			v[...] = self.U.dot(v)
+		else:
+			out = work_array.ravel()[:v.size].reshape(v.shape)
+			np.dot(self.U,v,out=out)
+			v[...] = out
+
+		return v
+
+
+
+class Compiled_block():
+	"""! Array representation of a single building block [[(label,time,expH),...],nr_of_reps] with unrolled repetitions """
+
+	def __init__(self,block,program):
+
+		##
+		# @param block building block as stored in NV_dynamics.building_blocks
+		# @param program Program the block belongs to. New propagators are appended to its table
+
+		elements, nr_of_reps = block
+		table = program.table
+
+		opcodes = []
+		for element in elements:
+			if element[2] is None:
+				opcodes += [NOISY]
+			else:
+				opcodes += [len(table)]
+				table += [element[2]]
+
+		## number of repetitions of the block
+		self.nr_of_reps = nr_of_reps
+
+		## number of elements in a single repetition of the block
+		self.nr_of_elements = len(elements)
+
+		## index into the propagator table for each (unrolled) element, NOISY if the propagator is built during the evolution
+		self.opcodes = np.tile(np.array(opcodes,dtype=np.int64),nr_of_reps)
+
+		## duration of each (unrolled) element
+		self.durations = np.tile(np.array([element[1] for element in elements],dtype=np.float64),nr_of_reps)
+
+		## label ('x','y','z' or 'dd') of each (unrolled) element
+		self.labels = [element[0] for element in elements]*nr_of_reps
+
+		## measurement mask: True for 'dd' elements, after which the observables are evaluated
+		self.measure = np.tile(np.array([element[0]=='dd' for element in elements],dtype=bool),nr_of_reps)
+
+		## time after each (unrolled) element measured from the beginning of the block
+		self.offsets = np.cumsum(self.durations)
+
+		## total duration of the block
+		self.duration = self.offsets[-1] if len(self.offsets)>0 else 0.0
+
+		## number of measurements in the block
+		self.nr_of_points = int(np.sum(self.measure))
+
+		## the propagator table
+		self.table = table
+
+		if program.dense:
+			entries = self.fuse(opcodes,program)
+		else:
+			entries = [(op,i) for i,op in enumerate(self.opcodes)]
+
+		## opcodes actually executed: with the dense engine, all elements up to a measurement (or a noisy element) are fused into a single table entry
+		self.executed_opcodes = np.array([entry[0] for entry in entries],dtype=np.int64)
+
+		# python lists of the bound dot methods and the measurement flags: iterating over these is much faster than indexing numpy arrays
+		last = [entry[1] for entry in entries]
+		self.__dots = [table[entry[0]].dot if entry[0]!=NOISY else None for entry in entries]
+		self.__plain_dots = self.__dots
+		self.__last = last
+		self.__measure = [bool(self.measure[i]) for i in last]
+		self.__durations = [float(self.durations[i]) for i in last]
+		self.__offsets = [float(self.offsets[i]) for i in last]
+
+
+	def fuse(self,opcodes,program):
+		"""! Groups the unrolled elements into products ending at a measurement or before a noisy element.
+			Returns a list of (opcode of the product, index of the last element in the group)"""
+
+		# blocks without measurement (and noise) are applied as a single power of the product of its elements
+		if self.nr_of_points==0 and NOISY not in opcodes and len(opcodes)>0:
+			return [(program.dense_product(tuple(opcodes),power=self.nr_of_reps),len(self.opcodes)-1)]
+
+		entries = []
+		group = []
+		for i,op in enumerate(self.opcodes):
+			if op==NOISY:
+				if len(group)>0:
+					entries += [(program.dense_product(tuple(group)),i-1)]
+					group = []
+				entries += [(NOISY,i)]
+			else:
+				group += [int(op)]
+				if self.measure[i]:
+					entries += [(program.dense_product(tuple(group)),i)]
+					group = []
+		if len(group)>0:
+			entries += [(program.dense_product(tuple(group)),len(self.opcodes)-1)]
+
+		return entries
+
+
+	def profile(self,profiler,name):
+		"""! Wraps the propagators of the block such that their wall time is accumulated per element in profiler 
+			(phases name/element i (label), i counted within a single repetition). profiler=None removes the wrappers """
+		if profiler == None:
+			self.__dots = self.__plain_dots
+			return
+		self.__dots = [profiler.timed(dot,'{0}/element {1:d} ({2})'.format(name,i % self.nr_of_elements,self.labels[i])) if dot is not None else None
+						for dot,i in zip(self.__plain_dots,self.__last)]
+
+
+	def execute(self,psi,work_array,current_time,point,data,times,measure,noisy_expH=None,random_num=None,rand_n_count=0):
+		"""! Applies the block to psi (in-place) and evaluates the observables after every 'dd' element"""
+
+		##
+		# @param psi state (updated in-place). Can also be a 2d array with one state per column
+		# @param work_array work array of expm_multiply_parallel (twice the size of psi)
+		# @param current_time time at the beginning of the block
+		# @param point index of the last measurement in data and times
+		# @param data array to store the observables in, data[:,point]
+		# @param times array to store the measurement times in
+		# @param measure function measure(psi,out) storing all observables of psi in out
+		# @param noisy_expH function noisy_expH(current_time,time,random_num) building the propagator of noisy elements
+		# @param random_num random numbers for the noise (array or Noise_stream, None without noise)
+		# @param rand_n_count index of the next unused random number
+		#
+		# @return current_time, point, rand_n_count after the block
+
+		first_point = point
+		dots = self.__dots
+		measured = self.__measure
+
+		for i in range(len(dots)):
+			dot = dots[i]
+			if dot is None:
+				dot = noisy_expH(current_time+self.__offsets[i],self.__durations[i],random_num[rand_n_count]).dot
+				rand_n_count += 1
+
+			dot(psi,work_array,True)
+
+			if measured[i]:
+				point += 1
+				measure(psi,data[:,point])
+
+		times[first_point+1:point+1] = current_time + self.offsets[self.measure]
+
+		return current_time+self.duration, point, rand_n_count
+
+
+	def apply(self,psi,work_array):
+		"""! Applies the block to psi (in-place) without any measurement. Not available for noisy blocks"""
+
+		assert NOISY not in self.executed_opcodes, 'blocks with noise cannot be applied without random numbers'
+		for dot in self.__dots:
+			dot(psi,work_array,True)
+		return psi
+
+
+	def dot(self,v,work_array=None,overwrite_v=False):
+		"""! Propagator interface (see expm_multiply_parallel.dot): applies the whole block to v"""
+		if not overwrite_v:
+			v = v.copy()
+		if work_array is None:
+			work_array = np.zeros((2*v.size,),dtype=v.dtype)
+		return self.apply(v,work_array)
+
+
+
+class Program():
+	"""! Compact array representation of the building blocks of a NV_dynamics object:
+		integer opcodes, durations and a measurement mask per block, together with a table of propagators.
+		Shared by all evolve_* drivers of NV_dynamics """
+
+	def __init__(self,building_blocks,dense=False):
+
+		##
+		# @param building_blocks building blocks as stored in NV_dynamics.building_blocks
+		# @param dense if True, the propagators are converted to dense unitaries and all elements between two measurements
+		# are multiplied into a single unitary (only sensible for small systems). Default is False
+
+		## True if the program is executed with dense unitaries
+		self.dense = dense
+
+		## propagator table (expm_multiply_parallel or Dense_expH objects) referenced by the opcodes of the compiled blocks
+		self.table = []
+
+		self.__dense = {}
+		self.__products = {}
+
+		## compiled blocks (see Compiled_block) in the order of building_blocks
+		self.blocks = [Compiled_block(block,self) for block in building_blocks]
+
+
+	def dense_product(self,opcodes,power=1):
+		"""! Appends the dense unitary (U_{opcodes[-1]}...U_{opcodes[0]})^power to the table (once) and returns its opcode"""
+
+		key = (opcodes,power)
+		if key not in self.__products:
+			U = None
+			for op in opcodes:
+				if op not in self.__dense:
+					entry = self.table[op]
+					self.__dense[op] = entry.U if isinstance(entry,Dense_expH) else Dense_expH.from_expm(entry).U
+				U = self.__dense[op] if U is None else self.__dense[op].dot(U)
+			if power != 1:
+				# binary powering
+				U = np.linalg.matrix_power(U,power)
+			self.__products[key] = len(self.table)
+			self.table += [Dense_expH(U)]
+
+		return self.__products[key]
+
+
+	def block_unitary(self,b):
+		"""! Dense unitary of the whole block b (including repetitions)"""
+		block = self.blocks[b]
+		assert NOISY not in block.opcodes, 'no fixed unitary for blocks with noise'
+		base = tuple(int(op) for op in block.opcodes[:block.nr_of_elements])
+		return self.table[self.dense_product(base,power=block.nr_of_reps)].U
+
+
+	def data_points(self):
+		"""! Number of measurements in each block"""
+		return np.array([block.nr_of_points for block in self.blocks],dtype=np.int64)
+
+
+
+def propagator_nbytes(expH):
+	"""! Memory (in bytes) held by a propagator (expm_multiply_parallel or Dense_expH object)"""
+	if isinstance(expH,Dense_expH):
+		return expH.U.nbytes
+	A = expH.A
+	return A.data.nbytes + A.indices.nbytes + A.indptr.nbytes
+
+
+
+class Propagator_cache():
+	"""! Thread safe least-recently-used cache of propagators with a memory limit """
+
+	def __init__(self,max_bytes=2**28,dense=False):
+
+		##
+		# @param max_bytes memory limit in bytes. Least recently used propagators are dropped once it is exceeded. Default is 256 MB
+		# @param dense if True, propagators are stored as Dense_expH objects (for Programs with dense=True). Default is False
+
+		## True if the propagators are stored as dense unitaries
+		self.dense = dense
+
+		## memory limit in bytes
+		self.max_bytes = max_bytes
+
+		## memory held by the cached propagators
+		self.nbytes = 0
+
+		## number of cache hits
+		self.hits = 0
+
+		## number of cache misses
+		self.misses = 0
+
+		self.__entries = OrderedDict()
+		self.__lock = threading.Lock()
+
+
+	def __len__(self):
+		return len(self.__entries)
+
+
+	def get(self,key):
+		"""! Cached propagator of key (marked as most recently used), or None """
+		with self.__lock:
+			if key not in self.__entries:
+				self.misses += 1
+				return None
+			self.hits += 1
+			self.__entries.move_to_end(key)
+			return self.__entries[key][0]
+
+
+	def put(self,key,expH):
+		"""! Adds a propagator and drops least recently used ones until the memory limit is met. Returns the stored propagator """
+		if self.dense and not isinstance(expH,Dense_expH):
+			expH = Dense_expH.from_expm(expH)
+		nbytes = propagator_nbytes(expH)
+		with self.__lock:
+			if key in self.__entries:
+				self.nbytes -= self.__entries.pop(key)[1]
+			self.__entries[key] = (expH,nbytes)
+			self.nbytes += nbytes
+			while self.nbytes > self.max_bytes and len(self.__entries)>0:
+				self.nbytes -= self.__entries.popitem(last=False)[1][1]
+		return expH
+
+
+	def clear(self):
+		"""! Empties the cache """
+		with self.__lock:
+			self.__entries.clear()
+			self.nbytes = 0
+
+
+
+class Noise_stream():
+	"""! Uniform random numbers in [-1,1) for the noisy elements, drawn lazily in chunks from a np.random.Generator seeded by a np.random.SeedSequence.
+		Indexed like an array (random_num[i]), but only sequentially: memory is limited to a single chunk """
+
+	def __init__(self,seed=1,chunk_size=2**16):
+
+		##
+		# @param seed int or np.random.SeedSequence. Equal seeds reproduce the stream (independent of chunk_size). Default is 1
+		# @param chunk_size number of random numbers drawn at once. Default is 2**16
+
+		## SeedSequence of the stream (spawns the seeds of independent streams, see spawn)
+		self.seed_sequence = seed if isinstance(seed,np.random.SeedSequence) else np.random.SeedSequence(seed)
+
+		## number of random numbers drawn at once
+		self.chunk_size = chunk_size
+
+		self.reset()
+
+
+	def reset(self):
+		"""! Restarts the stream from its first random number """
+		self.__generator = np.random.default_rng(self.seed_sequence)
+		self.__chunk = np.zeros(0)
+		self.__start = 0
+
+
+	def __getitem__(self,index):
+		"""! Random number number index of the stream. Indices must not decrease (earlier chunks are discarded) """
+		assert index >= self.__start, 'noise streams are read sequentially, use reset() to restart'
+		while index >= self.__start+len(self.__chunk):
+			self.__start += len(self.__chunk)
+			self.__chunk = self.__generator.uniform(-1,1,size=self.chunk_size)
+		return self.__chunk[index-self.__start]
+
+
+	def spawn(self,n):
+		"""! n statistically independent streams (e.g. for parallel workers), reproducible from the seed of this stream """
+		return [Noise_stream(seed,self.chunk_size) for seed in self.seed_sequence.spawn(n)]
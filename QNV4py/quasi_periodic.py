@@ -0,0 +1,174 @@
+import os
+import numpy as np
+from quspin.operators import hamiltonian
+
+
+##
+# @file quasi_periodic.py Contains quasi-periodic sequence generators and the class Quasi_periodic_drive
+#
+
+
+
+def fibonacci_sequence(n):
+	"""! Fibonacci word of generation n: S_0 = [1], S_1 = [1,0], S_{n+1} = S_n S_{n-1} """
+	f_min1 = np.array([0],dtype=np.int64)
+	f_current = np.array([1],dtype=np.int64)
+	for _ in range(n):
+		f_temp = f_current
+		f_current = np.concatenate((f_current,f_min1))
+		f_min1 = f_temp
+
+	return f_current
+
+
+
+def thue_morse_sequence(n):
+	"""! Thue-Morse word of generation n: T_0 = [0], T_{n+1} = T_n \\bar{T}_n (length 2^n) """
+	t_current = np.array([0],dtype=np.int64)
+	for _ in range(n):
+		t_current = np.concatenate((t_current,1-t_current))
+
+	return t_current
+
+
+
+class Quasi_periodic_drive():
+	"""! Evolution with Fibonacci or Thue-Morse sequences of the first two building blocks of a NV_dynamics object.
+		The recursions of the words, U(S_{n+1}) = U(S_{n-1}) U(S_n) (Fibonacci) and U(T_{n+1}) = U(\\bar{T}_n) U(T_n) (Thue-Morse),
+		are used to reach exponentially long evolution times. Observables are evaluated at the recursion checkpoints,
+		i.e. after the words of generation 0,1,...,n_generations """
+
+	def __init__(self,nv_dynamics,kind='fibonacci',dense=None):
+
+		##
+		# @param nv_dynamics NV_dynamics object. Its building blocks 0 and 1 are the letters of the words
+		# @param kind 'fibonacci' or 'thue_morse'. Default is 'fibonacci'
+		# @param dense if True, the word unitaries are composed as dense matrices (O(log N) matrix products for a word of length N).
+		# If False, the checkpoints are reached by applying the sub-words of the recursion to the state.
+		# Default is None, i.e. dense if nv_dynamics uses the dense engine
+
+		assert kind in ['fibonacci','thue_morse'], "kind must be 'fibonacci' or 'thue_morse'"
+		assert len(nv_dynamics.building_blocks)>=2, 'quasi-periodic drives need (at least) two building blocks'
+		assert nv_dynamics.noise==None, 'quasi-periodic drives are not available with noise'
+
+		## NV_dynamics object providing the letters of the words
+		self.nv_dynamics = nv_dynamics
+
+		## 'fibonacci' or 'thue_morse'
+		self.kind = kind
+
+		## compose dense unitaries (True) or apply sub-words to the state (False)
+		self.dense = nv_dynamics.engine=='dense' if dense==None else dense
+
+		self.__letters = nv_dynamics.program.blocks[:2]
+
+
+	def sequence(self,n_generations):
+		"""! Word (sequence of block indices) of generation n_generations"""
+		if self.kind=='fibonacci':
+			return fibonacci_sequence(n_generations)
+		return thue_morse_sequence(n_generations)
+
+
+	def word_lengths(self,n_generations):
+		"""! Lengths of the words of generation 0,...,n_generations"""
+		return np.array([len(self.sequence(n)) for n in range(n_generations+1)],dtype=np.int64)
+
+
+	def __checkpoints(self,psi,work_array):
+		# generator over (state, duration) after the words of generation 0,1,2,...
+		# Fibonacci: word = S_n, other = S_{n-1}. Thue-Morse: word = T_n, other = \bar{T}_n
+		durations = [self.__letters[0].duration,self.__letters[1].duration]
+
+		if self.kind=='fibonacci':
+			word, other = [1], [0]
+			d_word, d_other = durations[1], durations[0]
+		else:
+			word, other = [0], [1]
+			d_word, d_other = durations[0], durations[1]
+
+		if self.dense:
+			U_word = self.nv_dynamics.program.block_unitary(word[0])
+			U_other = self.nv_dynamics.program.block_unitary(other[0])
+			psi_0 = psi.copy()
+			while True:
+				psi[...] = U_word.dot(psi_0)
+				yield psi, d_word
+				if self.kind=='fibonacci':
+					U_word, U_other = U_other.dot(U_word), U_word
+				else:
+					U_word, U_other = U_other.dot(U_word), U_word.dot(U_other)
+				d_word, d_other = d_word+d_other, (d_word if self.kind=='fibonacci' else d_word+d_other)
+
+		else:
+			# the word of generation n is a prefix of the word of generation n+1: the next checkpoint is reached by applying
+			# the remaining sub-word (S_{n-1} resp. \bar{T}_n) to the current state
+			for b in word:
+				self.__letters[b].apply(psi,work_array)
+			yield psi, d_word
+			while True:
+				for b in other:
+					self.__letters[b].apply(psi,work_array)
+				if self.kind=='fibonacci':
+					word, other = word+other, word
+				else:
+					word, other = word+other, other+word
+				d_word, d_other = d_word+d_other, (d_word if self.kind=='fibonacci' else d_word+d_other)
+				yield psi, d_word
+
+
+	def evolve(self,initial_state,n_generations,observable,
+				file_name,save_dir='./data/',folder='new_data_set',extra_save_parameters=None):
+
+		"""! Evolves the initial state with the quasi-periodic word of generation n_generations """
+
+		##
+		# @param initial_state initial state of the system (see NV_dynamics.evolve_periodic)
+		# @param n_generations number of recursion steps. The final word has length F_{n+2} (Fibonacci) or 2^n (Thue-Morse)
+		# @param observable observables of interest. Must be list of QuSpin Hamiltonian objects.
+		# @param file_name filename (without ending) to save the data.
+		# @param save_dir directory to save the data in. Default is './data/'.
+		# @param folder folder name of the data set within the file file_name to save the data (check .hdf5 format). Default is 'new_data_set'.
+		# @param extra_save_parameters dict of additional parameters to be save. For example {'description':'This is a description of the data'}
+		#
+		# @return data, times: observables and times at the initial state and after the words of generation 0,...,n_generations
+
+		if not os.path.exists(save_dir):
+			os.mkdir(save_dir)
+
+		assert isinstance(observable,list), 'observables should be input as list of quspin.operators.hamiltonian objects'
+
+		for obs in observable:
+			assert isinstance(obs,hamiltonian) , 'observable input not understood: must be of type quspin.operators.hamiltonian'
+
+		save_parameters = {'quasi_periodic_drive':self.kind}
+		if extra_save_parameters!=None:
+			save_parameters.update(extra_save_parameters)
+
+		data = np.zeros((len(observable),n_generations+2)+initial_state.shape[1:])
+		times = np.zeros(n_generations+2)
+
+		psi = initial_state.copy().astype(self.nv_dynamics.dtype)
+		work_array = np.zeros((2*psi.size,), dtype=psi.dtype)
+		measure = self.nv_dynamics.measurement(observable)
+		try:
+			measure(psi,data[:,0])
+
+			checkpoints = self.__checkpoints(psi,work_array)
+			for n in range(n_generations+1):
+				psi_n, duration = next(checkpoints)
+				self.nv_dynamics.renormalize_step(psi_n,n+1)
+				measure(psi_n,data[:,n+1])
+				times[n+1] = duration
+				with self.nv_dynamics.phase('print'):
+					print('finished generation {0:d}'.format(n))
+		finally:
+			measure.close()
+			self.nv_dynamics.measurement_report = measure.report()
+
+		self.nv_dynamics.save_data_tuple((data,times),file_name,save_dir,folder,
+										('observables','times'),
+										overwrite=False,
+										extra_save_parameters=save_parameters)
+
+		return data, times
@@ -0,0 +1,152 @@
+import os, weakref
+import numpy as np
+from scipy import sparse
+from multiprocessing import shared_memory, resource_tracker
+
+
+##
+# @file shared.py Contains the class Shared_csr
+#
+
+
+## alignment (bytes) of the arrays within a shared memory segment
+ALIGNMENT = 64
+
+## names of the arrays of a csr matrix
+CSR_ARRAYS = ['data','indices','indptr']
+
+
+
+def _attach(name):
+	# attaches to an existing segment without registering it with the resource tracker of this process
+	# (otherwise the segment is unlinked when the first worker exits)
+	try:
+		return shared_memory.SharedMemory(name=name,track=False)
+	except TypeError:
+		# python < 3.13
+		segment = shared_memory.SharedMemory(name=name)
+		resource_tracker.unregister(segment._name,'shared_memory')
+		return segment
+
+
+def _unlink(name):
+	segment = shared_memory.SharedMemory(name=name)
+	segment.close()
+	segment.unlink()
+
+
+
+class Shared_csr():
+	"""! CSR matrix whose arrays (data, indices, indptr) live in a multiprocessing.shared_memory segment or in memory-mapped .npy files.
+		Pickling transfers a handle (name of the segment or directory) instead of the arrays, i.e. worker processes attach to the same
+		physical memory and tocsr() returns a zero-copy scipy csr_matrix of it """
+
+	def __init__(self,matrix,path=None):
+
+		##
+		# @param matrix scipy sparse matrix (converted to csr) to be shared
+		# @param path directory of the memory-mapped files data.npy, indices.npy and indptr.npy (created if needed).
+		# Default is None, i.e. an (anonymous) shared memory segment
+
+		matrix = sparse.csr_matrix(matrix)
+		arrays = [np.ascontiguousarray(getattr(matrix,name)) for name in CSR_ARRAYS]
+
+		## shape of the matrix
+		self.shape = matrix.shape
+
+		## directory of the memory-mapped files (None for shared memory)
+		self.path = path
+
+		## (dtype, size, offset) of data, indices and indptr within the segment
+		self.layout = []
+		offset = 0
+		for array in arrays:
+			self.layout += [(array.dtype.str,array.size,offset)]
+			offset += -(-array.nbytes//ALIGNMENT)*ALIGNMENT
+
+		## name of the shared memory segment (None for memory-mapped files)
+		self.name = None
+		self.__owner = True
+		self.__segment = None
+
+		if path == None:
+			self.__segment = shared_memory.SharedMemory(create=True,size=max(offset,1))
+			self.name = self.__segment.name
+			# the segment is freed with this object (or at exit), processes attached to it keep their mapping
+			self.__finalizer = weakref.finalize(self,_unlink,self.name)
+			for array, view in zip(arrays,self.__views()):
+				view[...] = array
+		else:
+			if not os.path.exists(path):
+				os.makedirs(path)
+			for name, array in zip(CSR_ARRAYS,arrays):
+				np.save(os.path.join(path,name+'.npy'),array)
+		self.__open()
+		self.__release()
+
+
+	def __views(self):
+		# data, indices, indptr as views of the mapping of the segment. The views reference the mapping itself, i.e. it is
+		# released with the last of them and not by closing (or garbage collecting) the SharedMemory object
+		return [np.frombuffer(self.__segment._mmap,dtype=np.dtype(dtype),count=size,offset=offset) for dtype, size, offset in self.layout]
+
+
+	def __release(self):
+		# hands the mapping over to the views (the SharedMemory object is not needed anymore)
+		if self.__segment != None:
+			self.__segment._buf.release()
+			self.__segment._buf = None
+			self.__segment._mmap = None
+			self.__segment.close()
+			self.__segment = None
+
+
+	def __open(self):
+		if self.path == None:
+			self.__arrays = self.__views()
+		else:
+			# copy-on-write mapping: pages are shared with all processes mapping the files as long as they are only read
+			self.__arrays = [np.load(os.path.join(self.path,name+'.npy'),mmap_mode='c') for name in CSR_ARRAYS]
+
+
+	def tocsr(self):
+		"""! scipy csr_matrix referencing the shared arrays (no copy, read-only) """
+		matrix = sparse.csr_matrix(self.shape,dtype=self.__arrays[0].dtype)
+		matrix.data, matrix.indices, matrix.indptr = self.__arrays
+		return matrix
+
+
+	@property
+	def nbytes(self):
+		"""! Size of the shared arrays in bytes """
+		return sum(array.nbytes for array in self.__arrays)
+
+
+	def __getstate__(self):
+		# handle only: the arrays are attached by the receiving process
+		return {'shape':self.shape,'path':self.path,'layout':self.layout,'name':self.name}
+
+
+	def __setstate__(self,state):
+		self.__dict__.update(state)
+		self.__owner = False
+		self.__segment = None if self.name == None else _attach(self.name)
+		self.__open()
+		self.__release()
+
+
+	def close(self):
+		"""! Detaches this object from the shared arrays. The segment stays mapped in this process as long as matrices returned by tocsr() are alive """
+		self.__arrays = None
+
+
+	def unlink(self):
+		"""! Closes and frees the shared memory segment (or deletes the memory-mapped files). Only the creating object may unlink.
+			Shared memory segments are also freed when the creating object is garbage collected """
+		assert self.__owner, 'only the process which created the shared arrays can unlink them'
+		self.close()
+		if self.path == None:
+			self.__finalizer()
+		else:
+			for array_name in CSR_ARRAYS:
+				os.remove(os.path.join(self.path,array_name+'.npy'))
@@ -0,0 +1,226 @@
+import os, io, contextlib, tempfile, shutil
+import numpy as np
+import h5py
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from QNV4py.nv_dynamics import NV_dynamics
+from QNV4py.program import Propagator_cache, Noise_stream
+
+
+##
+# @file sweep.py Contains the class Parameter_sweep
+#
+
+
+## inputs of NV_dynamics that can be swept
+SWEEP_AXES = ['rabi_freq','detuning','noise','kick_building_blocks']
+
+# sweep and run inputs of a worker process (see Parameter_sweep.run)
+_worker = {}
+
+
+
+def coordinates(values):
+	"""! Values of a grid axis as stored in the hdf5 file: floats (None as nan) or, e.g. for building blocks, strings """
+	try:
+		return np.array([np.nan if value is None else value for value in values],dtype=np.float64)
+	except (TypeError,ValueError):
+		return np.array([str(value) for value in values],dtype=h5py.string_dtype())
+
+
+
+def _init_worker(sweep,run_inputs):
+	_worker['sweep'] = sweep
+	_worker['run_inputs'] = run_inputs
+
+
+def _run_worker_point(task):
+	index, noise_stream = task
+	return (index,) + _worker['sweep'].run_point(index,noise_stream,*_worker['run_inputs'])
+
+
+
+class Parameter_sweep():
+	"""! Runs an evolve_* method of NV_dynamics on a grid of drive parameters (rabi_freq, detuning, noise, kick_building_blocks) of a single NV_system.
+		Propagators of elements whose parameters coincide are shared among the grid points, the points are distributed over a process pool
+		and the results are stored in a single hdf5 file indexed by the grid coordinates """
+
+	def __init__(self,nv_instance,grid,rabi_freq=None,kick_building_blocks=None,**kwargs):
+
+		##
+		# @param nv_instance NV_system object, shared by all grid points (the graph and H_dd are built once)
+		# @param grid dict {axis: list of values} with axes out of 'rabi_freq', 'detuning', 'noise' and 'kick_building_blocks'
+		# (e.g. building blocks with different durations). The sweep runs all combinations of the values
+		# @param rabi_freq Rabi frequency, if not swept
+		# @param kick_building_blocks building blocks of the drive, if not swept
+		# @param kwargs further (fixed) inputs of NV_dynamics, e.g. engine, precision, AC_function or noise_bins
+
+		for axis in grid:
+			assert axis in SWEEP_AXES, 'axis {0} not understood, the axes must be out of {1}'.format(axis,SWEEP_AXES)
+			assert axis not in kwargs, '{0} is swept and fixed at the same time'.format(axis)
+			assert len(grid[axis])>0, 'axis {0} has no values'.format(axis)
+		assert 'propagator_cache' not in kwargs, 'the propagator caches are managed by the sweep'
+
+		## NV_system object of all grid points
+		self.nv_instance = nv_instance
+
+		## dict {axis: list of values}
+		self.grid = dict(grid)
+
+		## names of the grid axes
+		self.axes = list(grid)
+
+		## number of values along each axis
+		self.shape = tuple(len(grid[axis]) for axis in self.axes)
+
+		## fixed inputs of NV_dynamics
+		self.fixed = dict(kwargs)
+		if rabi_freq != None:
+			self.fixed['rabi_freq'] = rabi_freq
+		if kick_building_blocks != None:
+			self.fixed['kick_building_blocks'] = kick_building_blocks
+		for name in ['rabi_freq','kick_building_blocks']:
+			assert name in self.fixed or name in self.grid, '{0} must either be given or swept'.format(name)
+
+		self.__caches = {}
+
+
+	def points(self):
+		"""! Grid indices of all points, in the order they are run """
+		return list(np.ndindex(*self.shape))
+
+
+	def parameters(self,index):
+		"""! Inputs of NV_dynamics at the grid point index """
+		parameters = dict(self.fixed)
+		for axis, i in zip(self.axes,index):
+			parameters[axis] = self.grid[axis][i]
+		return parameters
+
+
+	def dynamics(self,index):
+		"""! NV_dynamics object of the grid point index. Its propagators are taken from (and added to) a Propagator_cache shared by all points
+			of the sweep with the same engine, precision and tolerance (in this process) """
+		parameters = self.parameters(index)
+		rabi_freq = parameters.pop('rabi_freq')
+		kick_building_blocks = parameters.pop('kick_building_blocks')
+		if parameters.get('noise') is None:
+			# points without noise (e.g. None on a noise axis) have no quantized noise pool
+			parameters.pop('noise_bins',None)
+			parameters.pop('noise_tol',None)
+		engine = parameters.get('engine','auto')
+		if engine == 'auto':
+			# resolved for the cache only: NV_dynamics resolves 'auto' itself (see NV_dynamics.time_dependent_engine)
+			engine = 'dense' if self.nv_instance.L <= NV_dynamics.dense_max_L else 'krylov'
+
+		key = (engine,parameters.get('precision','double'),parameters.get('tol'))
+		if key not in self.__caches:
+			self.__caches[key] = Propagator_cache(max_bytes=parameters.get('cache_memory',2**28),dense=engine=='dense')
+		return NV_dynamics(self.nv_instance,rabi_freq,kick_building_blocks,propagator_cache=self.__caches[key],**parameters)
+
+
+	def run_point(self,index,noise_stream,initial_state,n_steps,observable,driver,driver_kwargs):
+		"""! Runs driver at the grid point index (output of the evolve_* method suppressed, its data file discarded). Returns data, times """
+		nv_dynamics = self.dynamics(index)
+		kwargs = dict(driver_kwargs)
+		if nv_dynamics.noise != None:
+			kwargs['seed'] = noise_stream
+		save_dir = tempfile.mkdtemp() + '/'
+		try:
+			with contextlib.redirect_stdout(io.StringIO()):
+				data, times = getattr(nv_dynamics,driver)(initial_state,n_steps,observable,file_name='sweep_point',
+															save_every=n_steps+1,save_dir=save_dir,**kwargs)
+		finally:
+			shutil.rmtree(save_dir)
+		return data, times
+
+
+	def run(self,initial_state,n_steps,observable,file_name,driver='evolve_periodic',save_dir='./data/',folder='new_sweep',
+				extra_save_parameters=None,n_workers=1,seed=1,**driver_kwargs):
+
+		"""! Runs driver at all grid points and stores the results in save_dir+file_name+'.hdf5' """
+
+		##
+		# @param initial_state initial state of the system (see NV_dynamics.evolve_periodic)
+		# @param n_steps number of steps of every run
+		# @param observable observables of interest. Must be list of QuSpin Hamiltonian objects.
+		# @param file_name filename (without ending) to save the data.
+		# @param driver name of the evolve_* method of NV_dynamics, e.g. 'evolve_periodic', 'evolve_random' or 'evolve_sequential'. Default is 'evolve_periodic'
+		# @param save_dir directory to save the data in. Default is './data/'.
+		# @param folder group of the sweep in the file. folder/observables and folder/times have the grid axes first, followed by the axes of the data of
+		# a single run. folder/grid/<axis> holds the values of the axes (strings for building blocks), folder/done marks finished points.
+		# An existing folder is not overwritten (a number is appended). Default is 'new_sweep'.
+		# @param extra_save_parameters dict of additional parameters to be save. For example {'description':'This is a description of the data'}
+		# @param n_workers number of worker processes. Contiguous chunks of points are run by the same worker to share propagators.
+		# 1 runs all points in this process. Default is 1
+		# @param seed seed of the noise. Point i (in the order of points) uses stream i of Noise_stream(seed).spawn(number of points),
+		# i.e. the results do not depend on n_workers. Default is 1
+		# @param driver_kwargs further inputs of driver, e.g. sequence, discrete_functions, n_multipole or seed_random_seq
+		#
+		# @return observables, times with the grid axes first
+
+		assert driver.startswith('evolve_') and hasattr(NV_dynamics,driver), 'driver {0} not understood'.format(driver)
+		if not os.path.exists(save_dir):
+			os.mkdir(save_dir)
+
+		points = self.points()
+		tasks = list(zip(points,Noise_stream(seed).spawn(len(points))))
+		run_inputs = (initial_state,n_steps,observable,driver,driver_kwargs)
+
+		if n_workers == 1:
+			results = (( index, ) + self.run_point(index,noise_stream,*run_inputs) for index, noise_stream in tasks)
+			return self.__store(results,file_name,save_dir,folder,driver,n_steps,extra_save_parameters)
+
+		chunksize = max(1,len(tasks)//(4*n_workers))
+		with ProcessPoolExecutor(max_workers=n_workers,mp_context=mp.get_context('fork'),
+									initializer=_init_worker,initargs=(self,run_inputs)) as executor:
+			results = executor.map(_run_worker_point,tasks,chunksize=chunksize)
+			return self.__store(results,file_name,save_dir,folder,driver,n_steps,extra_save_parameters)
+
+
+	def __store(self,results,file_name,save_dir,folder,driver,n_steps,extra_save_parameters):
+		# writes the results (index, data, times) into the hdf5 file as they arrive
+		file_path = save_dir + file_name + '.hdf5'
+		observables = None
+		with h5py.File(file_path,'a') as file:
+			folder_old = folder
+			j = 0
+			while folder in file:
+				folder = folder_old + str(j)
+				j += 1
+			if folder != folder_old:
+				print("\ndata group_name '" + folder_old + "' exists already in " + file_path + "\n group  has been changed to " + folder + "\n")
+			group = file.create_group(folder)
+			for axis in self.axes:
+				group.create_dataset('grid/'+axis,data=coordinates(self.grid[axis]))
+			done = group.create_dataset('done',data=np.zeros(self.shape,dtype=bool))
+
+			for index, data, times in results:
+				if observables is None:
+					observables = group.create_dataset('observables',shape=self.shape+data.shape,dtype=data.dtype,fillvalue=np.nan)
+					times_set = group.create_dataset('times',shape=self.shape+times.shape,dtype=times.dtype,fillvalue=np.nan)
+				assert observables.shape[len(self.shape):] == data.shape, 'all grid points must have the same number of data points'
+				observables[index] = data
+				times_set[index] = times
+				done[index] = True
+				file.flush()
+				print('finished grid point {0} of {1}'.format(index,self.shape))
+
+			# parameters of the system and the fixed inputs of the drive (see NV_dynamics.save_attributes)
+			self.nv_instance.save_system_attributes(group)
+			fixed = {'detuning':None,'noise':None,'noise_bins':None,'engine':'auto','precision':'double','tol':None}
+			fixed.update(self.fixed)
+			for name, value in fixed.items():
+				if name in ['kick_building_blocks','AC_function']:
+					value = str(value)
+				group.attrs[name] = 'None' if value is None else value
+			for axis in self.axes:
+				group.attrs[axis] = 'swept, see grid/' + axis
+			if extra_save_parameters!=None:
+				for key in extra_save_parameters:
+					group.attrs[key] = extra_save_parameters[key]
+			group.attrs['sweep_axes'] = self.axes
+			group.attrs['driver'] = driver
+			group.attrs['n_steps'] = n_steps
+
+			return observables[()], times_set[()]
@@ -0,0 +1,45 @@
+##
+# @file program_throughput.py Small-L throughput of the compiled execution loop shared by the evolve_* methods
+#
+# Usage:
+# ~~~~~~~~~~~~~{.py}
+# python benchmarks/program_throughput.py 6 8 10
+# ~~~~~~~~~~~~~
+# prints the number of applied sequence elements per second of evolve_periodic for each system size and engine.
+
+import os, sys, time, io, contextlib, shutil, tempfile
+import numpy as np
+import QNV4py as qnv
+
+
+def throughput(L,n_steps,kick_building_blocks,engine='krylov',n_states=1):
+	"""! Elements (times states) per second of evolve_periodic for a system of size L """
+
+	c13_spins = qnv.NV_system('z',L,0.9,1.1,1)
+	c13_dynamics = qnv.NV_dynamics(c13_spins,np.pi/2,kick_building_blocks,engine=engine)
+	observables = c13_spins.SP_observable(['x','z'])
+	psi_i = c13_spins.initial_state('x')
+	if n_states>1:
+		psi_i = np.stack(n_states*[psi_i],axis=1)
+
+	save_dir = tempfile.mkdtemp() + '/'
+	with contextlib.redirect_stdout(io.StringIO()):
+		t = time.time()
+		c13_dynamics.evolve_periodic(psi_i,n_steps,observables,'throughput',save_every=n_steps+1,save_dir=save_dir)
+		elapsed = time.time()-t
+	shutil.rmtree(save_dir)
+
+	return n_states*n_steps*sum(c13_dynamics.sequence_elements())/elapsed
+
+
+
+if __name__ == '__main__':
+
+	kick_building_blocks = [ [[('dd',0.05),('x',0.5)],10], [[('z',1.0)],1] ]
+	sizes = [int(L) for L in sys.argv[1:]] if len(sys.argv)>1 else [6,8,10]
+
+	for L in sizes:
+		n_steps = 2000 if L<10 else 500
+		for engine in ['krylov','dense']:
+			print('L={0:d}, {1}: {2:0.0f} elements/s'.format(L,engine,throughput(L,n_steps,kick_building_blocks,engine=engine)))
+		print('L={0:d}, dense, batch of 16 states: {1:0.0f} elements/s'.format(L,throughput(L,n_steps//4,kick_building_blocks,engine='dense',n_states=16)))
@@ -0,0 +1,234 @@
+##
+# @file suite.py Benchmark suite of system construction, propagator application and all evolve_* drivers
+#
+# Usage:
+# ~~~~~~~~~~~~~{.py}
+# python benchmarks/suite.py --L 6 8 10 --output results.json
+# python benchmarks/suite.py --L 6 8 10 --output new.json --baseline results.json
+# ~~~~~~~~~~~~~
+# Every case runs in a forked process, such that its peak resident set size (ru_maxrss, including the interpreter and imported modules)
+# is measured separately. The cases are
+# - construction: graph sampling, H_dd and estimate_scales of NV_system (wall time per phase, see Profiler)
+# - apply: applications per second of a single kick ('x') and a single 'dd' propagator
+# - evolve_periodic, evolve_random, evolve_sequential, evolve_time_dependent, evolve_random_multipolar: steps (calls of the
+#   building blocks of a step) per second, parametrized over L, noise on/off, AC field on/off and the number of observables
+#
+# Each case is run --repeat times and the fastest run is reported. The results are written as JSON {'meta':{...},'results':{case:{...}}}. With --baseline, the throughput of every case is compared to
+# the baseline file and cases slower by more than --threshold (relative) are reported as regressions (exit code 1).
+
+import os, sys, io, time, json, argparse, resource, platform, contextlib, itertools, shutil, tempfile, queue
+import multiprocessing as mp
+import numpy as np
+import QNV4py as qnv
+
+
+## building blocks of the drives: block 0 and 1 are used by the random, sequential and multipolar drives
+kick_building_blocks = [ [[('dd',0.05),('x',0.5)],10], [[('dd',0.05),('y',0.5)],10] ]
+
+
+def AC_field(t,amplitude,frequency):
+	"""! AC field used by the cases with AC on """
+	return amplitude*np.cos(frequency*t)
+
+
+def ramp(init_val,n,steps):
+	"""! Linear ramp of the element durations used by evolve_time_dependent """
+	return init_val + 0.1*n/steps
+
+
+def peak_rss():
+	"""! Peak resident set size of the current process in MB """
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# kilobytes on linux, bytes on macOS
+	return rss/2**20 if sys.platform=='darwin' else rss/2**10
+
+
+def system(L):
+	"""! NV_system of size L used by all cases """
+	return qnv.NV_system('z',L,0.9,1.1,1,profile=True)
+
+
+def dynamics(c13_spins,noise=False,AC=False,engine='krylov'):
+	"""! NV_dynamics of c13_spins with the benchmark building blocks """
+	return qnv.NV_dynamics(c13_spins,np.pi/2,kick_building_blocks,
+						AC_function=[AC_field,0.1,2.0] if AC else None,noise=0.05 if noise else None,engine=engine)
+
+
+def construction_case(L):
+	"""! Wall time of the construction phases of NV_system """
+	t = time.time()
+	c13_spins = system(L)
+	result = {'seconds':time.time()-t}
+	for phase in ['sampling','hamiltonian','estimate_scales']:
+		result[phase+'_seconds'] = c13_spins.profiler.total('NV_system/'+phase)[0]
+	return result
+
+
+def apply_case(L,label,n_apply):
+	"""! Applications per second of the propagator of the first element with label label """
+	c13_dynamics = dynamics(system(L))
+	expH = [element[2] for element in c13_dynamics.building_blocks[0][0] if element[0]==label][0]
+	psi = c13_dynamics.initial_state('x').astype(c13_dynamics.dtype)
+	work_array = np.zeros((2*psi.size,),dtype=psi.dtype)
+	t = time.time()
+	for _ in range(n_apply):
+		expH.dot(psi,work_array,True)
+	elapsed = time.time()-t
+	return {'seconds':elapsed,'applications_per_second':n_apply/elapsed}
+
+
+def evolve_case(L,driver,noise,AC,n_obs,n_steps,engine):
+	"""! Steps per second of the evolve_* method driver (construction of NV_dynamics excluded) """
+	c13_spins = system(L)
+	t = time.time()
+	c13_dynamics = dynamics(c13_spins,noise=noise,AC=AC,engine=engine)
+	setup_seconds = time.time()-t
+	observables = c13_spins.SP_observable(['x','y','z'][:n_obs])
+	psi_i = c13_spins.initial_state('x')
+
+	save_dir = tempfile.mkdtemp() + '/'
+	options = {'save_every':n_steps+1,'save_dir':save_dir}
+	t = time.time()
+	if driver=='evolve_periodic':
+		c13_dynamics.evolve_periodic(psi_i,n_steps,observables,'benchmark',**options)
+	elif driver=='evolve_random':
+		c13_dynamics.evolve_random(psi_i,n_steps,observables,'benchmark',**options)
+	elif driver=='evolve_sequential':
+		c13_dynamics.evolve_sequential(psi_i,n_steps,observables,[0,1]*n_steps,'benchmark',**options)
+	elif driver=='evolve_time_dependent':
+		c13_dynamics.evolve_time_dependent(psi_i,n_steps,observables,[None,[ramp,n_steps]],'benchmark',**options)
+	elif driver=='evolve_random_multipolar':
+		c13_dynamics.evolve_random_multipolar(psi_i,n_steps,observables,1,'benchmark',**options)
+	elapsed = time.time()-t
+	shutil.rmtree(save_dir)
+
+	return {'seconds':elapsed,'setup_seconds':setup_seconds,'steps_per_second':n_steps/elapsed}
+
+
+def run_case(results,function,args):
+	# runs in the forked process
+	try:
+		with contextlib.redirect_stdout(io.StringIO()):
+			result = function(*args)
+		result['peak_rss_mb'] = peak_rss()
+		results.put(result)
+	except Exception as error:
+		results.put({'error':repr(error)})
+
+
+def isolated(function,*args,timeout=None):
+	"""! Runs function(*args) in a forked process and returns its result (dict) including the peak RSS of the process.
+		A process that dies without a result (e.g. killed for running out of memory) or runs longer than timeout seconds yields {'error':...} """
+	context = mp.get_context('fork')
+	results = context.Queue()
+	process = context.Process(target=run_case,args=(results,function,args))
+	process.start()
+	start = time.time()
+	result = None
+	while result is None:
+		try:
+			result = results.get(timeout=1.0)
+		except queue.Empty:
+			if not process.is_alive():
+				# the result may have been put just before the process exited
+				try:
+					result = results.get(timeout=1.0)
+				except queue.Empty:
+					result = {'error':'process exited with code {0} without a result'.format(process.exitcode)}
+			elif timeout != None and time.time()-start > timeout:
+				process.kill()
+				result = {'error':'timed out after {0:g} s'.format(timeout)}
+	process.join()
+	return result
+
+
+def cases(sizes,n_steps,n_apply,drivers,engines):
+	"""! Generator over (name, function, args) of all benchmark cases """
+	for L in sizes:
+		yield 'construction[L={0:d}]'.format(L), construction_case, (L,)
+		for label in ['x','dd']:
+			yield 'apply[L={0:d},{1}]'.format(L,label), apply_case, (L,label,n_apply)
+		for driver, engine, noise, AC, n_obs in itertools.product(drivers,engines,[False,True],[False,True],[1,3]):
+			if driver=='evolve_random_multipolar' and noise:
+				continue
+			name = '{0}[L={1:d},engine={2},noise={3},AC={4},n_obs={5:d}]'.format(driver,L,engine,'on' if noise else 'off','on' if AC else 'off',n_obs)
+			yield name, evolve_case, (L,driver,noise,AC,n_obs,n_steps,engine)
+
+
+## throughput metric of the results, compared against the baseline
+THROUGHPUT = ['steps_per_second','applications_per_second']
+
+
+def throughput(result):
+	"""! (metric, value) of a result: steps or applications per second, or inverse wall time for construction """
+	for key in THROUGHPUT:
+		if key in result:
+			return key, result[key]
+	return '1/seconds', 1/result['seconds']
+
+
+def compare(results,baseline,threshold):
+	"""! Prints the relative throughput of all cases present in both results and baseline. Returns the names of regressed cases """
+	regressions = []
+	for name, result in results.items():
+		if name not in baseline or 'error' in result or 'error' in baseline[name]:
+			continue
+		metric, value = throughput(result)
+		ratio = value/throughput(baseline[name])[1]
+		rss_ratio = result['peak_rss_mb']/baseline[name]['peak_rss_mb']
+		flag = ''
+		if ratio < 1-threshold:
+			flag = '  REGRESSION'
+			regressions += [name]
+		print('{0:6.2f}x {1:<18s} {2:6.2f}x RSS  {3}{4}'.format(ratio,metric,rss_ratio,name,flag))
+	return regressions
+
+
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='benchmark suite of QNV4py')
+	parser.add_argument('--L',type=int,nargs='+',default=[6,8,10],help='system sizes')
+	parser.add_argument('--steps',type=int,default=50,help='number of steps of the evolve_* cases')
+	parser.add_argument('--apply',type=int,default=200,help='number of propagator applications of the apply cases')
+	parser.add_argument('--drivers',nargs='+',default=['evolve_periodic','evolve_random','evolve_sequential','evolve_time_dependent','evolve_random_multipolar'])
+	parser.add_argument('--engines',nargs='+',default=['krylov'],help="engines of NV_dynamics ('krylov', 'dense')")
+	parser.add_argument('--repeat',type=int,default=3,help='number of runs per case, the fastest is reported')
+	parser.add_argument('--timeout',type=float,default=None,help='seconds after which a run is killed and reported as failed')
+	parser.add_argument('--filter',default='',help='only run cases whose name contains this string')
+	parser.add_argument('--output',default='benchmark.json',help='JSON file the results are written to')
+	parser.add_argument('--baseline',default=None,help='JSON file of a previous run to compare with')
+	parser.add_argument('--threshold',type=float,default=0.2,help='relative slow down reported as regression')
+	args = parser.parse_args()
+
+	import scipy, quspin
+	meta = {'date':time.strftime('%Y-%m-%d %H:%M:%S'),'python':platform.python_version(),'platform':platform.platform(),
+			'numpy':np.__version__,'scipy':scipy.__version__,'quspin':getattr(quspin,'__version__','unknown'),
+			'cpu_count':os.cpu_count(),'OMP_NUM_THREADS':os.environ.get('OMP_NUM_THREADS'),
+			'steps':args.steps,'apply':args.apply,'repeat':args.repeat}
+
+	results = {}
+	for name, function, case_args in cases(args.L,args.steps,args.apply,args.drivers,args.engines):
+		if args.filter not in name:
+			continue
+		# best of repeat runs (each in its own process)
+		runs = [isolated(function,*case_args,timeout=args.timeout) for _ in range(args.repeat)]
+		runs = [run for run in runs if 'error' not in run] or runs[:1]
+		results[name] = max(runs,key=lambda run: throughput(run)[1] if 'error' not in run else 0)
+		if 'error' in results[name]:
+			print('{0}: failed with {1}'.format(name,results[name]['error']))
+		else:
+			metric, value = throughput(results[name])
+			print('{0}: {1:0.2f} {2}, {3:0.1f} MB peak RSS'.format(name,value,metric,results[name]['peak_rss_mb']))
+
+	with open(args.output,'w') as f:
+		json.dump({'meta':meta,'results':results},f,indent=1)
+
+	if args.baseline!=None:
+		with open(args.baseline) as f:
+			baseline = json.load(f)['results']
+		print('\ncomparison with {0} (throughput and peak RSS relative to the baseline):'.format(args.baseline))
+		regressions = compare(results,baseline,args.threshold)
+		if len(regressions)>0:
+			print('{0:d} regression(s)'.format(len(regressions)))
+			sys.exit(1)
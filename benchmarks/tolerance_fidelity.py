@@ -0,0 +1,46 @@
+##
+# @file tolerance_fidelity.py Steps per second of the krylov engine versus the fidelity of the final state for different propagator tolerances
+#
+# Usage:
+# ~~~~~~~~~~~~~{.py}
+# python benchmarks/tolerance_fidelity.py 12
+# ~~~~~~~~~~~~~
+# prints, for each tolerance, the number of Floquet periods per second and the (normalized) fidelity \f$ |\langle\psi_{ref}|\psi_{tol}\rangle|^2 \f$
+# of the final state with respect to the default (machine precision) tolerance.
+
+import sys, time
+import numpy as np
+import QNV4py as qnv
+
+
+def final_state(c13_dynamics,psi_i,n_steps):
+	"""! Applies n_steps Floquet periods of c13_dynamics to psi_i (without measurements). Returns the final state and the steps per second """
+
+	psi = psi_i.copy().astype(c13_dynamics.dtype)
+	work_array = np.zeros((2*psi.size,),dtype=psi.dtype)
+	t = time.time()
+	for step in range(n_steps):
+		for block in c13_dynamics.program.blocks:
+			block.apply(psi,work_array)
+	return psi, n_steps/(time.time()-t)
+
+
+
+if __name__ == '__main__':
+
+	L = int(sys.argv[1]) if len(sys.argv)>1 else 12
+	n_steps = 20
+	kick_building_blocks = [ [[('dd',0.05),('x',0.5)],10], [[('z',1.0)],1] ]
+	tolerances = [None,1e-12,1e-10,1e-8,1e-6,1e-4]
+
+	c13_spins = qnv.NV_system('z',L,0.9,1.1,1)
+	psi_i = c13_spins.initial_state('x')
+
+	psi_ref = None
+	for tol in tolerances:
+		c13_dynamics = qnv.NV_dynamics(c13_spins,np.pi/2,kick_building_blocks,engine='krylov',tol=tol)
+		psi, steps_per_second = final_state(c13_dynamics,psi_i,n_steps)
+		if psi_ref is None:
+			psi_ref = psi
+		fidelity = np.abs(np.vdot(psi_ref,psi))**2/(np.vdot(psi_ref,psi_ref).real*np.vdot(psi,psi).real)
+		print('L={0:d}, tol={1}: {2:0.2f} steps/s, 1-fidelity={3:0.2e}'.format(L,tol,steps_per_second,1-fidelity))